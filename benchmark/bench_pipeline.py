@@ -0,0 +1,248 @@
+import argparse
+import json
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "salt_viewer"))
+
+import fixtures  # noqa: E402
+
+# metrics compared with --compare. larger is worse for all of them.
+compared_metrics = [
+    "open_ms",
+    "first_image_ms",
+    "sequential.p50",
+    "sequential.p90",
+    "random.p50",
+    "random.p90",
+    "peak_rss_mb",
+]
+
+
+def make_engine():
+    from page_engine import PageEngine
+
+    # same as the viewer in Both fit mode with Lanczos
+    engine = PageEngine()
+    engine.select_fit_mode("Both")
+    engine.select_up_scale_algorithm("Lanczos")
+    engine.select_down_scale_algorithm("Lanczos")
+    return engine
+
+
+def percentiles(values):
+    if len(values) == 0:
+        return {}
+    values = sorted(values)
+
+    def p(q):
+        return values[min(len(values) - 1, int(len(values) * q))]
+
+    return {
+        "p50": p(0.5),
+        "p90": p(0.9),
+        "p99": p(0.99),
+        "max": values[-1],
+        "mean": sum(values) / len(values),
+    }
+
+
+def page_ms(engine, archive, i, target, preload):
+    if not preload:
+        # without preload thread, cache is never trimmed. clear it so that
+        # every access reads the page.
+        archive.cache = {}
+    start = time.perf_counter()
+    archive.i = i
+    engine.render(archive, i, target)
+    return (time.perf_counter() - start) * 1000
+
+
+def run_child(args):
+    from archive import ArchiveBase, open_archive
+
+    if not args.preload:
+        ArchiveBase.prev_cache = 0
+        ArchiveBase.next_cache = 0
+
+    target = parse_size(args.target)
+    engine = make_engine()
+    start = time.perf_counter()
+    archive = open_archive(args.path)
+    open_ms = (time.perf_counter() - start) * 1000
+    try:
+        engine.render(archive, archive.i, target)
+        first_image_ms = (time.perf_counter() - start) * 1000
+
+        sequential = [
+            page_ms(engine, archive, i, target, args.preload)
+            for i in range(len(archive))
+        ]
+        rng = random.Random(args.seed)
+        random_pages = [rng.randrange(len(archive)) for _ in range(args.random)]
+        random_ms = [
+            page_ms(engine, archive, i, target, args.preload) for i in random_pages
+        ]
+    finally:
+        archive.close()
+
+    result = {
+        "pages": len(sequential),
+        "open_ms": open_ms,
+        "first_image_ms": first_image_ms,
+        "sequential": percentiles(sequential),
+        "random": percentiles(random_ms),
+        # KB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    print(json.dumps(result))
+
+
+def run_format(fmt, path, args):
+    # each format runs in a new process, so that open is cold and peak RSS is
+    # measured per format.
+    command = [
+        sys.executable,
+        __file__,
+        "--child",
+        str(path),
+        "--target",
+        args.target,
+        "--random",
+        str(args.random),
+        "--seed",
+        str(args.seed),
+    ]
+    if args.preload:
+        command.append("--preload")
+    p = subprocess.run(command, capture_output=True, text=True)
+    if p.returncode != 0:
+        return {"error": p.stderr.strip().splitlines()[-1:]}
+    return json.loads(p.stdout.strip().splitlines()[-1])
+
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def lookup(result, metric):
+    for key in metric.split("."):
+        result = result.get(key, {}) if isinstance(result, dict) else {}
+    return result if isinstance(result, (int, float)) else None
+
+
+def compare(results, baseline_path, threshold):
+    baseline = json.loads(Path(baseline_path).read_text())["results"]
+    regressions = []
+    for fmt, result in results.items():
+        if fmt not in baseline:
+            continue
+        for metric in compared_metrics:
+            new = lookup(result, metric)
+            old = lookup(baseline[fmt], metric)
+            if new is None or old is None or old <= 0:
+                continue
+            if new / old > threshold:
+                regressions.append(
+                    {"format": fmt, "metric": metric, "baseline": old, "value": new}
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark of SaltViewer page pipeline without display."
+    )
+    parser.add_argument(
+        "--formats",
+        help=f"comma separated formats. Default is all. {','.join(fixtures.formats)}",
+        default=",".join(fixtures.formats),
+    )
+    parser.add_argument("--pages", help="number of pages", type=int, default=50)
+    parser.add_argument(
+        "--size", help="resolution of pages. Default is 2480x3508", default="2480x3508"
+    )
+    parser.add_argument(
+        "--target", help="window size. Default is 1920x1080", default="1920x1080"
+    )
+    parser.add_argument(
+        "--random", help="number of random page reads", type=int, default=30
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--preload", help="run with preload thread as the viewer", action="store_true"
+    )
+    parser.add_argument(
+        "--work_dir", help="directory of fixtures. Default is temporary", default=None
+    )
+    parser.add_argument("--output", help="write results as JSON", default=None)
+    parser.add_argument(
+        "--compare", help="baseline JSON. exit 1 if regressed", default=None
+    )
+    parser.add_argument(
+        "--threshold",
+        help="ratio to baseline regarded as regression. Default is 1.25",
+        type=float,
+        default=1.25,
+    )
+    parser.add_argument("--child", help=argparse.SUPPRESS, default=None)
+    parser.add_argument("path", nargs="?", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        args.path = args.child
+        run_child(args)
+        return
+
+    size = parse_size(args.size)
+    pages = [fixtures.page_bytes(i, size) for i in range(args.pages)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = Path(args.work_dir or tmp_dir)
+        work_dir.mkdir(parents=True, exist_ok=True)
+        results = {}
+        for fmt in args.formats.split(","):
+            path = fixtures.make_fixture(fmt, work_dir, pages)
+            if path is None:
+                results[fmt] = {"skipped": "not supported in this environment"}
+            else:
+                results[fmt] = run_format(fmt, path, args)
+            print(fmt, json.dumps(results[fmt]), file=sys.stderr)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "pages": args.pages,
+            "size": args.size,
+            "target": args.target,
+            "preload": args.preload,
+        },
+        "results": results,
+    }
+    if args.output is not None:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare is not None:
+        regressions = compare(results, args.compare, args.threshold)
+        for r in regressions:
+            print(
+                f"regression: {r['format']} {r['metric']}"
+                + f" {r['baseline']:.2f} -> {r['value']:.2f}",
+                file=sys.stderr,
+            )
+        if len(regressions) != 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
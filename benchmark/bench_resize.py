@@ -0,0 +1,114 @@
+import argparse
+import io
+import json
+import math
+import platform
+import sys
+import time
+from pathlib import Path
+from PIL import Image, ImageChops, ImageStat
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "salt_viewer"))
+
+import fixtures  # noqa: E402
+
+# Time and quality of downscaling a large page with and without reducing gap.
+# Quality is PSNR against the same algorithm from full size. Higher is closer,
+# and over 40dB is hard to tell apart.
+
+
+def psnr(image, reference):
+    diff = ImageChops.difference(image.convert("RGB"), reference.convert("RGB"))
+    stat = ImageStat.Stat(diff)
+    pixels = image.width * image.height
+    mse = sum(stat.sum2) / (pixels * len(stat.sum2))
+    if mse == 0:
+        return None
+    return 10 * math.log10(255 * 255 / mse)
+
+
+def resize_ms(engine, image, target, runs):
+    times = []
+    resized = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        resized = engine.resize_image(image, target)
+        times.append((time.perf_counter() - start) * 1000)
+    return sorted(times)[len(times) // 2], resized
+
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def main():
+    from page_engine import PageEngine
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark of downscale with reducing gap."
+    )
+    parser.add_argument(
+        "--size", help="resolution of page. Default is 6000x9000", default="6000x9000"
+    )
+    parser.add_argument(
+        "--target", help="window size. Default is 1920x1080", default="1920x1080"
+    )
+    parser.add_argument(
+        "--algorithms",
+        help="comma separated algorithms. Default is Bilinear,Hamming,Bicubic,Lanczos",
+        default="Bilinear,Hamming,Bicubic,Lanczos",
+    )
+    parser.add_argument(
+        "--gaps", help="comma separated gaps. Default is 1.5,2,3", default="1.5,2,3"
+    )
+    parser.add_argument("--runs", help="median of runs", type=int, default=5)
+    parser.add_argument("--output", help="write results as JSON", default=None)
+    args = parser.parse_args()
+
+    size = parse_size(args.size)
+    target = parse_size(args.target)
+    image = Image.open(io.BytesIO(fixtures.page_bytes(0, size)))
+    image.load()
+
+    results = {}
+    for name in args.algorithms.split(","):
+        engine = PageEngine()
+        engine.select_down_scale_algorithm(name)
+        algo = engine.down_scale
+        engine.reducing_gap = {}
+        full_ms, reference = resize_ms(engine, image, target, args.runs)
+        result = {"full_ms": round(full_ms, 1)}
+        for gap in args.gaps.split(","):
+            engine.reducing_gap = {algo: float(gap)}
+            ms, resized = resize_ms(engine, image, target, args.runs)
+            quality = psnr(resized, reference)
+            result[f"gap{gap}"] = {
+                "ms": round(ms, 1),
+                "speedup": round(full_ms / ms, 2),
+                "psnr_db": None if quality is None else round(quality, 1),
+            }
+        default = PageEngine.default_reducing_gap.get(algo)
+        result["default_gap"] = default
+        results[name] = result
+        print(name, json.dumps(result), file=sys.stderr)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "pillow": Image.__version__,
+            "size": args.size,
+            "target": args.target,
+            "runs": args.runs,
+        },
+        "results": results,
+    }
+    if args.output is not None:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
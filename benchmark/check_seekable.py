@@ -0,0 +1,208 @@
+import argparse
+import bz2
+import lzma
+import random
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "salt_viewer"))
+
+import fixtures  # noqa: E402
+import seekable  # noqa: E402
+from archive import CompressedTarArchive  # noqa: E402
+
+# Round trip .tar.zst, .tar.xz and .tar.bz2 made of many blocks and of one
+# block through seekable streams and compare every member byte for byte.
+
+
+def make_members(count, seed):
+    rng = random.Random(seed)
+    names = [fixtures.page_name(i) for i in range(count)]
+    pages = []
+    for i in range(count):
+        size = rng.randrange(1, 160 * 1024)
+        match i % 3:
+            case 0:
+                page = rng.randbytes(size)
+            case 1:
+                # runs of one byte make rle blocks
+                page = bytes([i % 256]) * size
+            case _:
+                page = fixtures.page_bytes(i, (64 + i, 48))
+        pages.append(page)
+    # empty member
+    pages[-1] = b""
+    return names, pages
+
+
+def chunks(data, size):
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+def compress_cases(tar_path, small_path, work_dir, frame_size):
+    # yield name, path of compressed tar and whether it holds small tar.
+    # bzip2 block holds 900k at most, so single block is made of small tar.
+    data = tar_path.read_bytes()
+    work_dir = Path(work_dir)
+
+    def write(name, payload):
+        path = work_dir / name
+        path.write_bytes(payload)
+        return path
+
+    try:
+        import zstandard
+    except ImportError:
+        print("zst: skipped. zstandard is not installed")
+    else:
+        path = work_dir / "seekable.tar.zst"
+        fixtures.write_seekable_zstd(tar_path, path, frame_size)
+        yield "zst seek table", path, False
+        c = zstandard.ZstdCompressor()
+        frames = [c.compress(d) for d in chunks(data, frame_size)]
+        yield "zst frames", write("frames.tar.zst", b"".join(frames)), False
+        # frames without content size are decompressed to find their size
+        frames = []
+        for d in chunks(data, frame_size):
+            obj = c.compressobj()
+            frames.append(obj.compress(d) + obj.flush())
+        yield "zst frames no size", write("nosize.tar.zst", b"".join(frames)), False
+        yield "zst single frame", write("single.tar.zst", c.compress(data)), False
+
+    if shutil.which("xz") is not None:
+        path = work_dir / "blocks.tar.xz"
+        with open(path, "wb") as f:
+            subprocess.run(
+                ["xz", "-c", "-T0", f"--block-size={frame_size}", str(tar_path)],
+                stdout=f,
+                check=True,
+            )
+        yield "xz blocks", path, False
+    else:
+        print("xz blocks: skipped. xz is not found")
+    yield "xz streams", write(
+        "streams.tar.xz",
+        # stream padding between streams
+        b"\0\0\0\0".join(lzma.compress(d) for d in chunks(data, frame_size)),
+    ), False
+    yield "xz single block", write("single.tar.xz", lzma.compress(data)), False
+
+    # level 1 makes blocks of 100k
+    yield "bz2 blocks", write("blocks.tar.bz2", bz2.compress(data, 1)), False
+    yield "bz2 streams", write(
+        "streams.tar.bz2",
+        b"".join(bz2.compress(d, 1) for d in chunks(data, frame_size)),
+    ), False
+    yield "bz2 single block", write(
+        "single.tar.bz2", bz2.compress(small_path.read_bytes())
+    ), True
+
+
+def check_case(path, expected, members, seed):
+    # return number of blocks and list of errors
+    errors = []
+    rng = random.Random(seed)
+    suffix = path.suffix.lower()
+
+    # random reads first, before any block size is known
+    with seekable.open_stream(path, suffix) as stream:
+        blocks = len(stream.blocks)
+        for _ in range(200):
+            offset = rng.randrange(len(expected) + 10)
+            size = rng.randrange(300 * 1024)
+            if stream.pread(offset, size) != expected[offset : offset + size]:
+                errors.append(f"pread({offset}, {size}) differs")
+                break
+        if stream.size() != len(expected):
+            errors.append(f"size {stream.size()} != {len(expected)}")
+
+    with seekable.open_stream(path, suffix) as stream:
+        with tarfile.open(fileobj=stream, mode="r:") as f:
+            found = 0
+            for info in f:
+                found += 1
+                if f.extractfile(info).read() != members[info.name]:
+                    errors.append(f"tarfile member {info.name} differs")
+        if found != len(members):
+            errors.append(f"tarfile found {found} of {len(members)} members")
+
+    archive = CompressedTarArchive(path, preload=False)
+    try:
+        order = list(range(len(archive)))
+        rng.shuffle(order)
+        for i in order:
+            file_name, f = archive.getitem(i)
+            if f.read() != members[str(file_name)]:
+                errors.append(f"archive member {file_name} differs")
+    finally:
+        archive.close()
+    return blocks, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check seekable readers of tar.zst, tar.xz and tar.bz2"
+        + " against the original tar. Exit 1 if any byte differs."
+    )
+    parser.add_argument(
+        "--members",
+        help="number of tar members. Default is %(default)s",
+        type=int,
+        default=40,
+    )
+    parser.add_argument(
+        "--frame_size",
+        help="bytes of a zstd frame or xz block. Default is %(default)s",
+        type=int,
+        default=256 * 1024,
+    )
+    parser.add_argument(
+        "--seed", help="random seed. Default is %(default)s", type=int, default=0
+    )
+    args = parser.parse_args()
+
+    names, pages = make_members(args.members, args.seed)
+    members = dict(zip(names, pages))
+    failed = False
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tar_path = Path(tmp_dir) / "pages.tar"
+        fixtures.write_tar(tar_path, names, pages)
+        small_path = Path(tmp_dir) / "small.tar"
+        small = {}
+        for name, page in members.items():
+            if sum(map(len, small.values())) + len(page) > 600 * 1024:
+                break
+            small[name] = page
+        fixtures.write_tar(small_path, small.keys(), small.values())
+        data = tar_path.read_bytes()
+        small_data = small_path.read_bytes()
+        print(f"tar: {len(data)} bytes, {len(names)} members")
+
+        for spill in (False, True):
+            if spill:
+                # small cache and spilled blocks
+                seekable.BlockStream.cache_bytes = args.frame_size
+                seekable.BlockStream.max_memory_block = args.frame_size // 4
+            cases = compress_cases(tar_path, small_path, tmp_dir, args.frame_size)
+            for name, path, is_small in cases:
+                if is_small:
+                    blocks, errors = check_case(path, small_data, small, args.seed)
+                else:
+                    blocks, errors = check_case(path, data, members, args.seed)
+                label = f"{name}{' (spill)' if spill else ''}"
+                print(f"{label}: {blocks} blocks, {'ok' if not errors else 'NG'}")
+                for error in errors:
+                    print(f"  {error}", file=sys.stderr)
+                    failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
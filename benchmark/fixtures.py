@@ -0,0 +1,170 @@
+from pathlib import Path
+import io
+import bz2
+import shutil
+import struct
+import subprocess
+import tarfile
+import zipfile
+from PIL import Image, ImageDraw
+
+
+formats = [
+    "directory",
+    "zip_stored",
+    "zip_deflated",
+    "tar",
+    "tar_gz",
+    "tar_zst",
+    "tar_xz",
+    "tar_bz2",
+    "7z_solid",
+    "7z_nonsolid",
+    "pdf",
+]
+
+
+def page_bytes(i, size, quality=90):
+    # noise makes file size and decode time close to real scans.
+    image = Image.effect_noise(size, 40).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    color = ((i * 37) % 256, (i * 71) % 256, (i * 113) % 256)
+    draw.rectangle((size[0] // 8, size[1] // 8, size[0] // 2, size[1] // 2), fill=color)
+    draw.text((size[0] // 4, size[1] * 3 // 4), f"page {i + 1}", fill=(255, 255, 255))
+    b = io.BytesIO()
+    image.save(b, "JPEG", quality=quality)
+    return b.getvalue()
+
+
+def page_name(i):
+    return f"{i + 1:05d}.jpg"
+
+
+def seven_zip_command():
+    for name in ["7z", "7za", "7zz"]:
+        command = shutil.which(name)
+        if command is not None:
+            return command
+    return None
+
+
+def write_tar(path, names, pages):
+    with tarfile.open(path, "w") as f:
+        for name, page in zip(names, pages):
+            info = tarfile.TarInfo(name)
+            info.size = len(page)
+            f.addfile(info, io.BytesIO(page))
+
+
+def write_seekable_zstd(src, dst, frame_size=4 * 1024 * 1024):
+    # frames of frame_size and seek table of zstd seekable format
+    import zstandard
+
+    c = zstandard.ZstdCompressor()
+    table = b""
+    frames = 0
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        while True:
+            chunk = fin.read(frame_size)
+            if len(chunk) == 0:
+                break
+            frame = c.compress(chunk)
+            fout.write(frame)
+            table += struct.pack("<II", len(frame), len(chunk))
+            frames += 1
+        table += struct.pack("<IBI", frames, 0, 0x8F92EAB1)
+        fout.write(struct.pack("<II", 0x184D2A5E, len(table)) + table)
+
+
+def make_fixture(fmt, work_dir, pages):
+    # pages is a list of jpeg bytes. return path to open or None if the
+    # format can not be made in this environment.
+    work_dir = Path(work_dir)
+    names = [page_name(i) for i in range(len(pages))]
+    match fmt:
+        case "directory":
+            d = work_dir / "directory"
+            d.mkdir(exist_ok=True)
+            for name, page in zip(names, pages):
+                (d / name).write_bytes(page)
+            return d / names[0]
+        case "zip_stored" | "zip_deflated":
+            path = work_dir / f"{fmt}.zip"
+            compression = zipfile.ZIP_STORED
+            if fmt == "zip_deflated":
+                compression = zipfile.ZIP_DEFLATED
+            with zipfile.ZipFile(path, "w", compression=compression) as f:
+                for name, page in zip(names, pages):
+                    f.writestr(name, page)
+            return path
+        case "tar" | "tar_gz":
+            path = work_dir / ("pages.tar" if fmt == "tar" else "pages.tar.gz")
+            with tarfile.open(path, "w" if fmt == "tar" else "w:gz") as f:
+                for name, page in zip(names, pages):
+                    info = tarfile.TarInfo(name)
+                    info.size = len(page)
+                    f.addfile(info, io.BytesIO(page))
+            return path
+        case "tar_zst":
+            try:
+                import zstandard  # noqa: F401
+            except ImportError:
+                return None
+            tar_path = work_dir / "zst.tar"
+            write_tar(tar_path, names, pages)
+            path = work_dir / "pages.tar.zst"
+            write_seekable_zstd(tar_path, path)
+            return path
+        case "tar_xz":
+            # lzma module writes one block. xz command splits blocks.
+            command = shutil.which("xz")
+            if command is None:
+                return None
+            tar_path = work_dir / "xz.tar"
+            write_tar(tar_path, names, pages)
+            path = work_dir / "pages.tar.xz"
+            with open(path, "wb") as f:
+                subprocess.run(
+                    [command, "-c", "-T0", "--block-size=4MiB", str(tar_path)],
+                    stdout=f,
+                    check=True,
+                )
+            return path
+        case "tar_bz2":
+            tar_path = work_dir / "bz2.tar"
+            write_tar(tar_path, names, pages)
+            path = work_dir / "pages.tar.bz2"
+            path.write_bytes(bz2.compress(tar_path.read_bytes()))
+            return path
+        case "7z_solid":
+            import py7zr
+
+            path = work_dir / "solid.7z"
+            with py7zr.SevenZipFile(path, "w") as f:
+                for name, page in zip(names, pages):
+                    f.writestr(page, name)
+            return path
+        case "7z_nonsolid":
+            # py7zr always writes solid archive.
+            command = seven_zip_command()
+            if command is None:
+                return None
+            d = work_dir / "nonsolid"
+            d.mkdir(exist_ok=True)
+            for name, page in zip(names, pages):
+                (d / name).write_bytes(page)
+            path = work_dir / "nonsolid.7z"
+            path.unlink(missing_ok=True)
+            subprocess.run(
+                [command, "a", "-ms=off", str(path), *names],
+                cwd=d,
+                check=True,
+                stdout=subprocess.DEVNULL,
+            )
+            return path
+        case "pdf":
+            path = work_dir / "pages.pdf"
+            images = [Image.open(io.BytesIO(page)) for page in pages]
+            images[0].save(path, "PDF", save_all=True, append_images=images[1:])
+            return path
+    raise ValueError(f"unknown format {fmt}")
@@ -0,0 +1,176 @@
+import argparse
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "salt_viewer"))
+
+import fixtures  # noqa: E402
+
+salt_viewer_dir = Path(__file__).resolve().parent.parent / "salt_viewer"
+
+# modules only needed for some formats or operations.
+# they must be imported on first use, not at startup.
+lazy_modules = [
+    "pillow_avif",
+    "rarfile",
+    "py7zr",
+    "pdf2image",
+    "PyPDF3",
+    "cairosvg",
+    "send2trash",
+    "natsort",
+    "zstandard",
+    "seekable",
+    "tkinter.filedialog",
+    "tkinter.messagebox",
+    "multiprocessing",
+    "concurrent.futures",
+    "gallery",
+    "thumbnail",
+    "decode_pool",
+    "random_ahead",
+    "file_ops",
+    "instance",
+    "cache_daemon",
+]
+
+
+def import_time():
+    # return (ms to import salt_viewer, names of imported modules)
+    p = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import salt_viewer"],
+        cwd=salt_viewer_dir,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # import time: self [us] | cumulative | imported package
+    total = None
+    modules = set()
+    for line in p.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:") :].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name = fields[2].strip()
+        modules.add(name)
+        if name == "salt_viewer":
+            total = int(fields[1]) / 1000
+    return total, modules
+
+
+def first_pixel_child(image_path):
+    import salt_viewer
+
+    sv = salt_viewer.SaltViewer(
+        "/nonexistent/.svrc", {"DefaultFullScreen": "False", "CacheDir": ""}
+    )
+    sv.open(Path(image_path))
+    while True:
+        sv.update()
+        image = sv.image.image
+        if not sv.loading and image is not None and image.size != (10, 10):
+            break
+        time.sleep(0.001)
+    print("first pixel", flush=True)
+    sv.destroy()
+
+
+def first_pixel_time(image_path):
+    # ms from starting python to showing the first image
+    start = time.perf_counter()
+    p = subprocess.Popen(
+        [sys.executable, __file__, "--child", str(image_path)],
+        cwd=salt_viewer_dir,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    line = p.stdout.readline()
+    elapsed = (time.perf_counter() - start) * 1000
+    p.wait()
+    if line.strip() != "first pixel":
+        return None
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check startup of SaltViewer against time budgets."
+        + " Exit 1 if over budget."
+    )
+    parser.add_argument(
+        "--import_budget",
+        help="ms to import salt_viewer. Default is %(default)s",
+        type=float,
+        default=150,
+    )
+    parser.add_argument(
+        "--first_pixel_budget",
+        help="ms from start to the first image. Needs display. Default is %(default)s",
+        type=float,
+        default=1000,
+    )
+    parser.add_argument(
+        "--runs", help="median of runs. Default is %(default)s", type=int, default=5
+    )
+    parser.add_argument("--child", help=argparse.SUPPRESS, default=None)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        first_pixel_child(args.child)
+        return
+
+    failed = False
+
+    results = [import_time() for _ in range(args.runs)]
+    total = statistics.median(t for t, _ in results)
+    print(f"import salt_viewer: {total:.1f}ms (budget {args.import_budget:.0f}ms)")
+    if total > args.import_budget:
+        print("over budget", file=sys.stderr)
+        failed = True
+
+    loaded = sorted(set(lazy_modules) & results[0][1])
+    for name in loaded:
+        print(f"imported at startup: {name}", file=sys.stderr)
+        failed = True
+
+    try:
+        import tkinter
+
+        tkinter.Tk().destroy()
+        has_display = True
+    except tkinter.TclError:
+        has_display = False
+
+    if has_display:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            image_path = Path(tmp_dir) / fixtures.page_name(0)
+            image_path.write_bytes(fixtures.page_bytes(0, (1200, 1700)))
+            times = [first_pixel_time(image_path) for _ in range(args.runs)]
+        if None in times:
+            print("first pixel: viewer failed", file=sys.stderr)
+            failed = True
+        else:
+            first_pixel = statistics.median(times)
+            print(
+                f"first pixel: {first_pixel:.1f}ms"
+                + f" (budget {args.first_pixel_budget:.0f}ms)"
+            )
+            if first_pixel > args.first_pixel_budget:
+                print("over budget", file=sys.stderr)
+                failed = True
+    else:
+        print("first pixel: skipped. no display")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,78 @@
 from abc import abstractmethod
 from pathlib import Path
 import shutil
-import logging
 import random
 import threading
 import time
-import tkinter.messagebox as messagebox
 import io
-import natsort as ns
+import mmap
+import os
+import struct
 import tempfile
+from page_cache import file_identity, data_identity
+from metrics import metrics, nbytes
+from prefetch import AdaptivePrefetch
+from tracing import tracer
+from log import get_logger
 
 
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-ch = logging.StreamHandler()
-formatter = logging.Formatter(
-    "%(asctime)s:%(name)s:%(funcName)s:%(lineno)d:%(levelname)s:%(message)s"
-)
-ch.setFormatter(formatter)
-logger.addHandler(ch)
+logger = get_logger(__name__)
+
+
+def register_plugin(file_name):
+    # import PIL plugin of file_name before Image.open. pillow_avif is slow
+    # to import, so it is imported on the first AVIF page.
+    if Path(file_name).suffix.lower() == ".avif" and "pillow_avif" not in globals():
+        global pillow_avif
+        import pillow_avif  # noqa: F401
+
+
+def image_dimension(data, file_name):
+    # (width, height, mode) from image header. pixels are not decoded.
+    if "Image" not in globals():
+        global Image
+        from PIL import Image
+    register_plugin(file_name)
+    image = Image.open(data)
+    return image.width, image.height, image.mode
+
+
+def stale_render(image):
+    # render made for other window size, fit mode or page mode. renders of
+    # disk cache and decode pool have render_key. raw pages do not.
+    key = getattr(image, "render_key", None)
+    if key is None:
+        return False
+    # spread is shown alone in double page mode
+    if ArchiveBase.spread_render_key is not None and image.width > image.height:
+        return key != ArchiveBase.spread_render_key
+    return key != ArchiveBase.render_key
 
 
 class ArchiveBase:
     prev_cache = 2
     next_cache = 10
 
+    # bytes enough to read image header. SOF of JPEG can be after EXIF.
+    header_size = 64 * 1024
+    # read headers of pages not in cache. False for archives which
+    # decompress many pages to read one, like solid 7z.
+    index_headers = False
+
+    # DiskCache or SharedCache of display-ready renders. None means disabled.
+    disk_cache = None
+    # SharedCache sharing dimensions with other SaltViewer processes.
+    shared_cache = None
+    # target size of renders. SaltViewer updates it before reading pages.
+    render_key = None
+    # target size of spreads in double page mode, same as single page mode.
+    # None in single page mode.
+    spread_render_key = None
+    # DecodePool decoding pages read ahead in processes. None means disabled.
+    decode_pool = None
+    # (frame size, div) of renders. SaltViewer updates it with render_key.
+    render_size = None
+
     support_image_type = [
         ".bmp",
         ".dib",
@@ -49,27 +97,65 @@ class ArchiveBase:
         ".avif",
         ".webp",
     ]
-    support_archive_type = [".zip", ".rar", ".7z", ".pdf", ".gz", ".tar"]
+    support_archive_type = [
+        ".zip",
+        ".rar",
+        ".7z",
+        ".pdf",
+        ".gz",
+        ".tar",
+        ".zst",
+        ".xz",
+        ".bz2",
+    ]
     support_type = support_image_type + support_archive_type
 
     def __init__(self, multi_read=False):
         self.file_path = None
         self.data = None
         self.file_list: list[Path] = []
+        # set when current page changes
+        self.moved = threading.Event()
         self.i = 0
 
         self.multi_read = multi_read
         self.thread_run = False
+        self.stop = False
 
         self.images: dict[str, bytes] = {}
 
         self.cache = {}
+        # pages read by preload thread and not shown yet
+        self.preloaded = set()
 
         self.is_directory = False
 
+        self._identity = None
+
+        # reading direction. 1 is next, -1 is prev.
+        self.direction = 1
+
+        # size of cache around current page
+        self.lookahead = AdaptivePrefetch(self.prev_cache, self.next_cache)
+
+        # page: (width, height, mode) or None if not an image.
+        # indexed from headers on idle time of preload.
+        self.dimensions = {}
+        # number of dimensions sent to shared cache
+        self.published = 0
+
     def __del__(self):
         self.close()
 
+    @property
+    def i(self):
+        return self._i
+
+    @i.setter
+    def i(self, i):
+        self._i = i
+        self.moved.set()
+
     def filtering_file_list(self):
         self.file_list = [
             f
@@ -97,9 +183,80 @@ class ArchiveBase:
     def get_data(self, start, end):
         return int(), int(), [], []
 
+    def identity(self):
+        if self._identity is None:
+            if self.data is None:
+                self._identity = file_identity(self.file_path)
+            else:
+                self._identity = data_identity(self.file_path, self.data)
+        return self._identity
+
+    def render_id(self, i):
+        return f"{self.identity()}/{self.file_list[i]}"
+
+    def page_render_key(self, i):
+        if self.spread_render_key is not None and self.is_spread(i):
+            return self.spread_render_key
+        return self.render_key
+
+    def load_render(self, i):
+        if self.disk_cache is None or self.render_key is None:
+            return None
+        render_key = self.page_render_key(i)
+        try:
+            render_id = self.render_id(i)
+        except OSError:
+            return None
+        render = self.disk_cache.get(render_id, render_key)
+        if render is not None:
+            render.render_key = render_key
+        return render
+
+    def fetch(self, i):
+        # a render in disk cache skips reading and decoding the page.
+        render = None if self.is_directory else self.load_render(i)
+        if render is not None:
+            return Path(self.file_list[i]), render
+        return self.getitem(i)
+
+    def pool_decode(self, pages):
+        # decode pages in decode pool. yield (page, render) in order of pages.
+        # pages not accepted by the pool or failed to decode are skipped.
+        pool = self.decode_pool
+        if pool is None or self.render_size is None:
+            return
+        size, div = self.render_size
+        render_key = self.render_key
+        spread_render_key = self.spread_render_key
+        futures = []
+        for j in pages:
+            if not self.is_image(j) or not pool.accepts(self.file_list[j]):
+                continue
+            source = self.source(j)
+            if source is None:
+                continue
+            # spread is shown alone in double page mode
+            d = 1 if div == 2 and self.is_spread(j) else div
+            futures.append((j, d, pool.submit(source, size, d)))
+        # take all results even if stopped, so that shared memory is freed
+        for j, d, future in futures:
+            image = pool.result(future)
+            if image is not None:
+                image.render_key = render_key if d == div else spread_render_key
+                yield j, image
+
     def in_range(self, i):
         return max(0, min(len(self), i))
 
+    def memory(self):
+        # bytes held by this archive.
+        cache = list(self.cache.values())
+        return {
+            "cache_bytes": sum(nbytes(c[1]) for c in cache if c is not None),
+            "cache_pages": sum(1 for c in cache if c is not None),
+            "data_bytes": nbytes(self.data),
+        }
+
     @abstractmethod
     def getitem(self, i) -> tuple[Path, io.BytesIO | None]:
         return Path(), io.BytesIO()
@@ -108,54 +265,273 @@ class ArchiveBase:
     def getitems(self, start, end):
         return [], []
 
+    def is_image(self, i):
+        return Path(self.file_list[i]).suffix.lower() in self.support_image_type
+
+    def source(self, i):
+        # picklable description of page i for worker processes.
+        # see thumbnail.open_source
+        if not self.is_image(i):
+            return None
+        cached = self.cache.get(i)
+        if cached is not None and hasattr(cached[1], "getvalue"):
+            file_name, data = cached
+        else:
+            file_name, data = self.getitem(i)
+        if not hasattr(data, "getvalue"):
+            return None
+        return ("bytes", str(file_name), data.getvalue())
+
+    def read_header(self, i):
+        # file object starting with the header of page i
+        return self.getitem(i)[1]
+
+    def reader(self):
+        # path or file object of the archive for one reader. pages are read
+        # by main, preload and thumbnail threads at once, and position of
+        # BytesIO can not be shared between threads.
+        if self.data is None:
+            return self.file_path
+        if isinstance(self.data, MappedFile):
+            # view of the same memory with its own position
+            return MappedFile(self.data.getbuffer())
+        # BytesIO shares the bytes until it is written.
+        return io.BytesIO(self.data.getvalue())
+
+    def read_dimension(self, i):
+        cached = self.cache.get(i)
+        if cached is not None and hasattr(cached[1], "getbuffer"):
+            # do not move position of cached page
+            return image_dimension(MappedFile(cached[1].getbuffer()), cached[0])
+        if not self.index_headers:
+            return None
+        try:
+            dimension = image_dimension(self.read_header(i), self.file_list[i])
+            metrics.count("index.header")
+            return dimension
+        except Exception:
+            # header is not in the first header_size bytes
+            metrics.count("index.full")
+            return image_dimension(self.getitem(i)[1], self.file_list[i])
+
+    def dimension(self, i):
+        return self.dimensions.get(i)
+
+    def is_spread(self, i):
+        # wide page shown alone in double page mode
+        dimension = self.dimensions.get(i)
+        return dimension is not None and dimension[0] > dimension[1]
+
+    def index_order(self):
+        # pages from current page, alternately ahead and behind
+        d = 1 if self.direction >= 0 else -1
+        i = self.i
+        for k in range(len(self)):
+            yield i + d * k
+            yield i - d * (k + 1)
+
+    def indexed_all(self):
+        return len(self.dimensions) >= len(self)
+
+    def index_dimensions(self, n=4):
+        # index n pages near current page. return number of indexed pages.
+        if self.indexed_all():
+            return 0
+        done = 0
+        for j in self.index_order():
+            if done >= n or self.stop:
+                break
+            if not 0 <= j < len(self) or j in self.dimensions:
+                continue
+            if not self.is_image(j) or Path(self.file_list[j]).suffix.lower() == ".svg":
+                self.dimensions[j] = None
+                continue
+            try:
+                dimension = self.read_dimension(j)
+            except Exception as e:
+                logger.debug("index %s failed: %s", j, e)
+                dimension = None
+            else:
+                if dimension is None:
+                    # not cached yet
+                    continue
+            self.dimensions[j] = dimension
+            done += 1
+        return done
+
+    def load_index(self):
+        # dimensions indexed by other SaltViewer processes
+        if self.shared_cache is None or self.is_directory or self.stop:
+            return
+        try:
+            index = self.shared_cache.get_index(self.identity())
+        except OSError:
+            return
+        if index is None:
+            return
+        for j, dimension in index.items():
+            self.dimensions.setdefault(j, dimension)
+        self.published = len(self.dimensions)
+        logger.debug("loaded %s dimensions", len(index))
+
+    def publish_index(self):
+        if self.shared_cache is None or self.is_directory:
+            return
+        if len(self.dimensions) == self.published:
+            return
+        self.published = len(self.dimensions)
+        try:
+            self.shared_cache.put_index(self.identity(), dict(self.dimensions))
+        except OSError:
+            pass
+
     def start_preload(self):
-        t = threading.Thread(target=self.preload_thread)
+        # set here, not in the thread. if close() is called before the thread
+        # starts, the thread must see stop and exit.
+        self.stop = False
+        t = threading.Thread(
+            target=self.preload_thread, name=f"preload {self.file_path}", daemon=True
+        )
         t.start()
 
     def preload_thread(self):
-        self.stop = False
+        self.load_index()
         while True:
             if self.stop:
                 break
 
-            start = self.in_range(self.i - self.prev_cache)
-            end = self.in_range(self.i + self.next_cache)
+            start, end = self.lookahead.window(self.i, self.direction, len(self))
 
             # logger.debug(f"start, end = {start}, {end}")
 
             yet = []
 
+            evicted = [
+                j
+                for j, c in list(self.cache.items())
+                if c is not None and not start <= j < end
+            ]
+            if len(evicted) != 0:
+                metrics.count("cache.evict", len(evicted))
+                wasted = self.preloaded.intersection(evicted)
+                metrics.count("preload.wasted", len(wasted))
+                self.preloaded -= wasted
             self.cache = {i: self.cache.get(i) for i in range(start, end)}
+            # renders for old window size or fit mode are read again
+            for j, c in list(self.cache.items()):
+                if c is not None and stale_render(c[1]):
+                    self.cache[j] = None
             yet = [i for i in range(start, end) if self.cache.get(i) is None]
 
             if len(yet) == 0:
                 logger.debug("cache is full.")
-                logger.debug(f"file_path = {self.file_path}")
-                logger.debug(f"cached page is {self.cache.keys()}")
-                time.sleep(0.1)
+                logger.debug("file_path = %s", self.file_path)
+                logger.debug("cached page is %s", self.cache.keys())
+                try:
+                    indexed = self.index_dimensions()
+                except Exception:
+                    if self.stop:
+                        break
+                    raise
+                if indexed == 0:
+                    self.publish_index()
+                    time.sleep(0.1)
                 continue
 
+            for j in yet:
+                render = self.load_render(j)
+                if render is not None:
+                    self.cache[j] = (Path(self.file_list[j]), render)
+            yet = [j for j in yet if self.cache.get(j) is None]
+            if len(yet) == 0:
+                continue
+
+            if self.decode_pool is not None:
+                first, last = self.preload_range(yet)
+                # keep batch small, so that pages are cached as they are done
+                pages = [j for j in range(first, last) if self.cache.get(j) is None]
+                pages = pages[: self.decode_pool.max_workers * 2]
+                images = []
+                try:
+                    started = time.perf_counter()
+                    with tracer.span("decode_pool", start=first, end=last):
+                        for j, image in self.pool_decode(pages):
+                            self.cache[j] = (Path(self.file_list[j]), image)
+                            self.preloaded.add(j)
+                            metrics.count("preload.fetched")
+                            images.append(image)
+                except Exception:
+                    if self.stop:
+                        break
+                    raise
+                if len(images) != 0:
+                    self.lookahead.fetched(
+                        time.perf_counter() - started,
+                        len(images),
+                        sum(nbytes(image) for image in images),
+                    )
+                    continue
+
             if self.multi_read:
                 logger.debug("getitems")
-                logger.debug(f"yet = {yet}")
-                # read more because self.i is update till calling getitems
-                file_names, images = self.getitems(
-                    yet[0], self.in_range(yet[0] + int(self.next_cache / 2))
+                logger.debug("yet = %s", yet)
+                first, last = self.preload_range(yet)
+                try:
+                    started = time.perf_counter()
+                    with tracer.span("preload", start=first, end=last):
+                        file_names, images = self.getitems(first, last)
+                except Exception:
+                    # archive is closed while reading
+                    if self.stop:
+                        break
+                    raise
+                self.lookahead.fetched(
+                    time.perf_counter() - started,
+                    len(images),
+                    sum(nbytes(image) for image in images),
                 )
-                logger.debug(f"yet[0], yet[-1] = {yet[0]}, {yet[-1]}")
-                for j, file_name, image in zip(
-                    list(range(yet[0], yet[-1] + 1)), file_names, images
-                ):
-                    logger.debug(f"cache: {j}, {file_name}")
+                logger.debug("first, last = %s, %s", first, last)
+                for j, file_name, image in zip(range(first, last), file_names, images):
+                    if self.cache.get(j) is not None:
+                        continue
+                    logger.debug("cache: %s, %s", j, file_name)
                     self.cache[j] = (file_name, image)
+                    self.preloaded.add(j)
+                    metrics.count("preload.fetched")
             else:
                 logger.debug("read single")
                 for j in yet:
                     if self.cache[j] is not None:
                         continue
-                    self.cache[j] = self.getitem(j)
-
-            logger.debug(f"cache {len(yet)} files. : {self.cache.keys()}")
+                    try:
+                        started = time.perf_counter()
+                        with tracer.span("preload", page=j):
+                            self.cache[j] = self.fetch(j)
+                    except Exception:
+                        if self.stop:
+                            break
+                        raise
+                    self.lookahead.fetched(
+                        time.perf_counter() - started, 1, nbytes(self.cache[j][1])
+                    )
+                    self.preloaded.add(j)
+                    metrics.count("preload.fetched")
+
+            logger.debug("cache %s files. : %s", len(yet), self.cache.keys())
+
+    def preload_range(self, yet):
+        # pages read by one getitems. start from the first missing page in
+        # reading direction, so that a fast reader does not catch up with
+        # preload reading pages behind.
+        # read more because self.i is update till calling getitems
+        n = self.lookahead.batch()
+        if self.direction >= 0:
+            ahead = [j for j in yet if j >= self.i]
+            first = ahead[0] if len(ahead) != 0 else yet[0]
+            return first, self.in_range(first + n)
+        behind = [j for j in yet if j <= self.i]
+        last = behind[-1] if len(behind) != 0 else yet[-1]
+        return max(0, last - n + 1), last + 1
 
     def __getitem__(self, i):
         if len(self) == 0:
@@ -163,13 +539,22 @@ class ArchiveBase:
 
         i = self.in_range(i)
 
-        if self.cache.get(i) is not None:
+        if self.cache.get(i) is not None and not stale_render(self.cache[i][1]):
             logger.debug("cache hit")
+            tracer.instant("cache hit", page=i)
+            metrics.count("cache.hit")
+            if i in self.preloaded:
+                self.preloaded.discard(i)
+                metrics.count("preload.used")
             return self.cache[i]
 
         self.i = i
-        logger.debug(f"cache failed:{i}")
-        file_name, data = self.getitem(i)
+        logger.debug("cache failed:%s", i)
+        metrics.count("cache.miss")
+        started = time.perf_counter()
+        with tracer.span("read", page=i):
+            file_name, data = self.fetch(i)
+        self.lookahead.fetched(time.perf_counter() - started, 1, nbytes(data))
         self.cache[i] = (file_name, data)
 
         return file_name, data
@@ -187,11 +572,13 @@ class ArchiveBase:
 
     def next(self, c=1):
         c = max(1, c)
+        self.direction = 1
         self.i = min(self.i + c, len(self) - 1)
         return self[self.i]
 
     def prev(self, c=1):
         c = max(1, c)
+        self.direction = -1
         self.i = max(self.i - c, 0)
         return self[self.i]
 
@@ -199,15 +586,37 @@ class ArchiveBase:
         return self[self.i]
 
     def sort_file_list(self):
+        # natsort takes long to import. archives are opened on worker thread,
+        # so importing here does not delay showing window.
+        if "ns" not in globals():
+            global ns
+            import natsort as ns
         self.file_list = ns.natsorted(
             self.file_list, key=lambda x: str(x), alg=ns.ns.PATH | ns.ns.IGNORECASE
         )
 
 
 class DirectoryArchive(ArchiveBase):
+    index_headers = True
+    # read and decode images around current page on other thread.
+    prefetch = False
+    # bytes of decoded images
+    prefetch_memory = 512 * 1024 * 1024
+
+    # decoded images are shared by all instances, so that they survive
+    # reopening directory after trash, rename and move.
+    # path -> ((size, mtime), image)
+    decoded = {}
+    # paths in decoded which are shown
+    decoded_used = set()
+    decoded_lock = threading.Lock()
+
     def __init__(self, file_path, data=None):
         super().__init__()
         self.is_directory = True
+        self.lookahead = AdaptivePrefetch(
+            self.prev_cache, self.next_cache, self.prefetch_memory
+        )
         self.random_list = []
         self.open(file_path, data)
         self.gen_random_list()
@@ -218,6 +627,15 @@ class DirectoryArchive(ArchiveBase):
         self.random_list = [i for i in range(len(self))]
         random.shuffle(self.random_list)
 
+    def render_id(self, i):
+        # each file in directory is identified by itself.
+        return file_identity(self.file_list[i])
+
+    def source(self, i):
+        if not self.is_image(i):
+            return None
+        return ("path", str(self.file_list[i]))
+
     def search(self, file_path):
         self.i = self.file_list.index(Path(file_path))
         self.cache = {}
@@ -225,8 +643,10 @@ class DirectoryArchive(ArchiveBase):
 
     def remove(self, file_path):
         i = self.search(file_path)
-        logger.debug(f"remove {i}:{file_path}")
+        logger.debug("remove %s:%s", i, file_path)
         self.cache = {}
+        with self.decoded_lock:
+            self.decoded.pop(Path(file_path), None)
         del self.file_list[i]
         if int(i) in self.random_list:
             logger.debug("i in self.random_list")
@@ -237,6 +657,21 @@ class DirectoryArchive(ArchiveBase):
         else:
             logger.debug("i is not in self.random_list")
 
+    def add(self, file_path):
+        # put back a file removed by remove(). current page is kept.
+        file_path = Path(file_path)
+        if file_path in self.file_list:
+            return
+        current = self.file_list[self.i] if 0 <= self.i < len(self) else None
+        self.file_list.append(file_path)
+        self.sort_file_list()
+        i = self.file_list.index(file_path)
+        self.random_list = [n if n < i else n + 1 for n in self.random_list]
+        self.random_list.insert(random.randint(0, len(self.random_list)), i)
+        if current is not None:
+            self.i = self.file_list.index(current)
+        self.cache = {}
+
     def open(self, file_path, data=None):
         _ = data
         # you cannot path data, ignored
@@ -251,7 +686,7 @@ class DirectoryArchive(ArchiveBase):
         logger.debug("get index")
         try:
             self.i = self.file_list.index(Path(file_path))
-            logger.debug(f"self.i = {self.i}")
+            logger.debug("self.i = %s", self.i)
         except ValueError:
             logger.debug("search failed. such file does not exist")
 
@@ -266,30 +701,267 @@ class DirectoryArchive(ArchiveBase):
         # disable cache because trash not works well.
         # Other way is is_directory and set file_path as same
         self.cache = {}
-        logger.debug(f"i = {i}")
+        logger.debug("i = %s", i)
         if 0 <= i < len(self):
             self.i = i
             self.file_path = self.file_list[i]
-            return self.file_path, None
+            data = self.load_render(i)
+            if data is None:
+                data = self.take_decoded(self.file_path)
+            return self.file_path, data
         else:
             return Path(), None
 
+    def read_dimension(self, i):
+        # PIL reads only header from file
+        with open(self.file_list[i], "rb") as f:
+            return image_dimension(f, self.file_list[i])
+
+    def start_prefetch(self):
+        if "Image" not in globals():
+            global Image
+            from PIL import Image
+        self.stop = False
+        t = threading.Thread(
+            target=self.prefetch_thread, name=f"prefetch {self.file_path}", daemon=True
+        )
+        t.start()
+
+    def prefetch_pages(self):
+        # current page, pages in reading direction, then pages behind.
+        d = self.direction
+        i = self.i
+        prev_cache, next_cache = self.lookahead.pages()
+        ahead = [i + d * n for n in range(next_cache + 1)]
+        behind = [i - d * n for n in range(1, prev_cache + 1)]
+        return [
+            j
+            for j in ahead + behind
+            if 0 <= j < len(self)
+            and self.is_image(j)
+            and self.file_list[j].suffix.lower() != ".svg"
+        ]
+
+    def prefetch_thread(self):
+        while not self.stop:
+            i = self.i
+            pages = self.prefetch_pages()
+            paths = {self.file_list[j] for j in pages}
+            with self.decoded_lock:
+                for path, (_, image) in list(self.decoded.items()):
+                    if path not in paths or stale_render(image):
+                        del self.decoded[path]
+                        if path in self.decoded_used:
+                            self.decoded_used.discard(path)
+                        else:
+                            metrics.count("prefetch.wasted")
+                size = sum(
+                    image.width * image.height * len(image.getbands())
+                    for _, image in self.decoded.values()
+                    if image is not None
+                )
+
+            if size <= self.prefetch_memory and self.prefetch_pool(pages) != 0:
+                continue
+
+            done = 0
+            for j in pages:
+                path = self.file_list[j]
+                if self.stop or self.i != i:
+                    break
+                if size > self.prefetch_memory:
+                    logger.debug("prefetch_memory is full")
+                    break
+                if path in self.decoded:
+                    continue
+                # do not decode image which does not fit in memory
+                dimension = self.dimension(j)
+                if dimension is not None:
+                    width, height, mode = dimension
+                    bands = Image.getmodebands(mode)
+                    if size + width * height * bands > self.prefetch_memory:
+                        logger.debug("prefetch_memory is full")
+                        break
+                started = time.perf_counter()
+                with tracer.span("prefetch", path=path.name):
+                    stat_key, image = self.decode(path)
+                self.lookahead.fetched(time.perf_counter() - started, 1, nbytes(image))
+                with self.decoded_lock:
+                    self.decoded[path] = (stat_key, image)
+                metrics.count("prefetch.decoded")
+                if image is not None:
+                    size += image.width * image.height * len(image.getbands())
+                done += 1
+
+            if done != 0 or self.index_dimensions() != 0:
+                continue
+            if self.indexed_all():
+                # nothing to do until page moves. stop may be set without
+                # waking, so wake up once in a while to see it.
+                self.moved.wait(1)
+                self.moved.clear()
+            else:
+                time.sleep(0.05)
+
+    def prefetch_pool(self, pages):
+        # decode pages accepted by decode pool in processes. return pages
+        # decoded. others and failed ones are decoded by prefetch_thread.
+        if self.decode_pool is None:
+            return 0
+        todo = []
+        stat_keys = {}
+        for j in pages:
+            path = self.file_list[j]
+            if path in self.decoded:
+                continue
+            if len(todo) >= self.decode_pool.max_workers * 2:
+                break
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            stat_keys[j] = (stat.st_size, stat.st_mtime_ns)
+            todo.append(j)
+        done = 0
+        size = 0
+        started = time.perf_counter()
+        with tracer.span("decode_pool", pages=len(todo)):
+            for j, image in self.pool_decode(todo):
+                path = self.file_list[j]
+                with self.decoded_lock:
+                    self.decoded[path] = (stat_keys[j], image)
+                metrics.count("prefetch.decoded")
+                size += nbytes(image)
+                done += 1
+        if done != 0:
+            self.lookahead.fetched(time.perf_counter() - started, done, size)
+        return done
+
+    def decode(self, path):
+        try:
+            stat = path.stat()
+            register_plugin(path)
+            image = Image.open(path)
+            image.load()
+        except Exception as e:
+            logger.debug("decode failed: %s: %s", path, e)
+            return None, None
+        return (stat.st_size, stat.st_mtime_ns), image
+
+    def take_decoded(self, path):
+        with self.decoded_lock:
+            entry = self.decoded.get(path)
+        if entry is None or entry[1] is None or stale_render(entry[1]):
+            metrics.count("prefetch.miss")
+            return None
+        stat_key, image = entry
+        try:
+            stat = path.stat()
+        except OSError:
+            return None
+        # file is changed after decoding
+        if (stat.st_size, stat.st_mtime_ns) != stat_key:
+            with self.decoded_lock:
+                self.decoded.pop(path, None)
+            return None
+        logger.debug("prefetch hit")
+        metrics.count("prefetch.hit")
+        with self.decoded_lock:
+            if path not in self.decoded_used:
+                self.decoded_used.add(path)
+                metrics.count("prefetch.used")
+        return image
+
+    @classmethod
+    def prefetch_memory_used(cls):
+        with cls.decoded_lock:
+            images = [image for _, image in cls.decoded.values()]
+        return sum(nbytes(image) for image in images)
+
     def random_select(self):
         if len(self.random_list) == 0:
             self.gen_random_list()
-            messagebox.showwarning("reset random_list", "reset random_list")
+            logger.warning("reset random_list")
         i = self.random_list.pop()
         return self.getitem(i)
 
 
+# Read-only file object over a memoryview, like BytesIO without copying.
+# Pages of stored zip members are views of the mmap of the archive.
+class MappedFile(io.RawIOBase):
+    def __init__(self, view):
+        super().__init__()
+        self.view = view
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        else:
+            self.pos = len(self.view) + offset
+        return self.pos
+
+    def read(self, size=-1):
+        end = len(self.view) if size is None or size < 0 else self.pos + size
+        data = bytes(self.view[self.pos : end])
+        self.pos += len(data)
+        return data
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, b):
+        data = self.view[self.pos : self.pos + len(b)]
+        b[: len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def getbuffer(self):
+        # new view, so that releasing it keeps self.view
+        return self.view[:]
+
+    def getvalue(self):
+        return bytes(self.view)
+
+
 class ZipArchive(ArchiveBase):
-    def __init__(self, file_path, data=None):
+    index_headers = True
+    # zlib releases GIL while inflating, so pages are read by threads.
+    # each thread has its own ZipFile because reading one ZipFile from several
+    # threads is not safe.
+    workers = min(4, os.cpu_count() or 1)
+
+    def __init__(self, file_path, data=None, preload=True):
         if "zipfile" not in globals():
             global zipfile
             import zipfile
-        super().__init__()
+        if "concurrent" not in globals():
+            global concurrent
+            import concurrent.futures
+        super().__init__(multi_read=True)
+        self.local = threading.local()
+        self.handles = []
+        self.handles_lock = threading.Lock()
+        self.executor = None
+        # mmap of file_path or bytes of nested archive
+        self.mapped = None
+        self.view = None
+        # name: (offset, size) of data of members stored without compression
+        self.stored = {}
         self.open(file_path, data)
-        self.start_preload()
+        if preload:
+            self.start_preload()
 
     def open(self, file_path, data=None):
         logger.debug("called")
@@ -297,57 +969,133 @@ class ZipArchive(ArchiveBase):
         self.data = data
         self.file_list = []
 
-        logger.debug("to byte")
-        # fp = self.file_path if data is None else io.BytesIO(self.data)
-        if self.data is not None:
-            self.data.seek(0)
-        fp = self.file_path if data is None else self.data
-
         logger.debug("zip open")
-        with zipfile.ZipFile(fp) as f:
+        with zipfile.ZipFile(self.reader()) as f:
             # self.file_list = f.namelist()
             self.file_list = [Path(s) for s in f.namelist()]
+            infos = f.infolist()
         logger.debug("to list")
         self.sort_file_list()
         self.filtering_file_list()
-        logger.debug(self.file_list)
+        self.map_stored(infos)
+        logger.debug("%s", self.file_list)
         logger.debug("return")
 
-    def getitem(self, i):
-        logger.debug("__getitem__")
-        file_name = Path()
-        file_byte = None
+    def map_stored(self, infos):
+        # stored members are served as views of the archive without reading.
+        # nested archive is already in memory, so its bytes are sliced.
+        infos = [
+            info
+            for info in infos
+            if info.compress_type == zipfile.ZIP_STORED and info.flag_bits & 1 == 0
+        ]
+        if len(infos) == 0:
+            return
+        if self.data is None:
+            try:
+                with open(self.file_path, "rb") as f:
+                    self.mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError) as e:
+                logger.debug("mmap failed: %s", e)
+                return
+            self.view = memoryview(self.mapped)
+        elif isinstance(self.data, MappedFile):
+            # stored in parent archive. getvalue would copy it.
+            self.view = self.data.getbuffer()
+        else:
+            self.view = memoryview(self.data.getvalue())
 
-        logger.debug("to byte")
-        # fp = self.file_path if self.data is None else io.BytesIO(self.data)
-        fp = self.file_path if self.data is None else self.data
+        for info in infos:
+            # local header has its own lengths of name and extra field
+            header = self.view[info.header_offset : info.header_offset + 30]
+            if len(header) != 30 or header[:4] != b"PK\x03\x04":
+                continue
+            name_size, extra_size = struct.unpack("<HH", header[26:30])
+            offset = info.header_offset + 30 + name_size + extra_size
+            if offset + info.file_size > len(self.view):
+                continue
+            self.stored[info.filename] = (offset, info.file_size)
+        logger.debug("%s stored members", len(self.stored))
+
+    def handle(self):
+        f = getattr(self.local, "zip_file", None)
+        if f is None:
+            f = zipfile.ZipFile(self.reader())
+            self.local.zip_file = f
+            with self.handles_lock:
+                self.handles.append(f)
+        return f
+
+    def read_header(self, i):
+        file_name = str(self.file_list[i])
+        stored = self.stored.get(file_name)
+        if stored is not None:
+            offset, size = stored
+            size = min(size, self.header_size)
+            return MappedFile(self.view[offset : offset + size])
+        with self.handle().open(file_name) as f:
+            return io.BytesIO(f.read(self.header_size))
+
+    def read(self, i):
+        file_name = str(self.file_list[i])
+        stored = self.stored.get(file_name)
+        if stored is not None:
+            offset, size = stored
+            metrics.count("zip.mapped")
+            return Path(file_name), MappedFile(self.view[offset : offset + size])
+        return Path(file_name), io.BytesIO(self.handle().read(file_name))
 
-        logger.debug("open zip")
-        if 0 <= i < len(self):
-            with zipfile.ZipFile(fp) as f:
-                file_name = str(self.file_list[i])
-                file_byte = f.read(file_name)
+    def close(self):
+        super().close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        with self.handles_lock:
+            handles, self.handles = self.handles, []
+        for f in handles:
+            f.close()
+        self.stored = {}
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self.mapped is not None:
+            try:
+                self.mapped.close()
+            except BufferError:
+                # pages in caches still refer it. unmapped when they are freed.
+                pass
+            self.mapped = None
 
-            logger.debug(f"i={i}")
-            if i < len(self.file_list):
-                logger.debug(self.file_list[i])
-        else:
+    def getitems(self, start, end):
+        start = self.in_range(start)
+        end = self.in_range(end)
+        logger.debug("start, end = %s, %s", start, end)
+        if self.file_path is None:
+            raise RuntimeError("archive is closed")
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="zip"
+            )
+        items = list(self.executor.map(self.read, range(start, end)))
+        return [item[0] for item in items], [item[1] for item in items]
+
+    def getitem(self, i):
+        logger.debug("__getitem__")
+        if not 0 <= i < len(self):
             raise ValueError("index out of range")
-        logger.debug(file_name)
-        logger.debug("return")
-        if file_byte is None:
-            raise ValueError("file_byte is None. file not found in zip.")
-        return Path(file_name), io.BytesIO(file_byte)
+        logger.debug("i=%s", i)
+        return self.read(i)
 
 
 class RarArchive(ArchiveBase):
-    def __init__(self, file_path, data=None):
-        if "rarfile" not in "globals":
+    def __init__(self, file_path, data=None, preload=True):
+        if "rarfile" not in globals():
             global rarfile
             import rarfile
         super().__init__()
         self.open(file_path, data)
-        self.start_preload()
+        if preload:
+            self.start_preload()
 
     def open(self, file_path, data=None):
         logger.debug("called")
@@ -355,80 +1103,66 @@ class RarArchive(ArchiveBase):
         self.data = data
         self.file_list = []
 
-        logger.debug("to byte")
-        if self.data is not None:
-            self.data.seek(0)
-        fp = self.file_path if data is None else self.data
-
         logger.debug("open rar")
-        with rarfile.RarFile(fp) as f:
+        with rarfile.RarFile(self.reader()) as f:
             # self.file_list = f.namelist()
             self.file_list = [Path(s) for s in f.namelist()]
 
         logger.debug("open rar")
         self.sort_file_list()
         self.filtering_file_list()
-        logger.debug(self.file_list)
+        logger.debug("%s", self.file_list)
 
     def getitem(self, i):
         logger.debug("__getitem__")
         file_name = Path()
         file_byte = None
-        logger.debug("to byte")
-        fp = self.file_path if self.data is None else self.data
         logger.debug("read file")
         if 0 <= i < len(self):
-            with rarfile.RarFile(fp) as f:
+            with rarfile.RarFile(self.reader()) as f:
                 file_name = str(self.file_list[i])
                 file_byte = f.read(file_name)
 
         if file_byte is None:
             raise ValueError("file_byte is None. file not found in rar.")
-        logger.debug(f"i={i}")
-        logger.debug(self.file_list[i])
-        logger.debug(file_name)
+        logger.debug("i=%s", i)
+        logger.debug("%s", self.file_list[i])
+        logger.debug("%s", file_name)
         logger.debug("return")
         return Path(file_name), io.BytesIO(file_byte)
 
 
 class SevenZipArchive(ArchiveBase):
-    def __init__(self, file_path, data=None):
+    def __init__(self, file_path, data=None, preload=True):
         if "py7zr" not in globals():
             global py7zr
             import py7zr
         super().__init__()
         self.open(file_path, data)
         self.multi_read = True
-        self.start_preload()
+        if preload:
+            self.start_preload()
 
     def open(self, file_path, data=None):
         logger.debug("called")
         self.file_path = file_path
         self.data = data
         self.file_list = []
-        logger.debug("to bytes")
-        if self.data is not None:
-            self.data.seek(0)
-        fp = self.file_path if self.data is None else self.data
         logger.debug("open 7z")
-        with py7zr.SevenZipFile(fp, mode="r") as f:
+        with py7zr.SevenZipFile(self.reader(), mode="r") as f:
             self.file_list = f.getnames()
             logger.debug("getnames")
-            logger.debug(self.file_list)
+            logger.debug("%s", self.file_list)
 
         self.sort_file_list()
         self.filtering_file_list()
-        logger.debug(self.file_list)
+        logger.debug("%s", self.file_list)
         logger.debug("return")
 
     def getitems(self, start, end):
-        if self.data is not None:
-            self.data.seek(0)
-        fp = self.file_path if self.data is None else self.data
-
         file_names = []
         file_bytes = []
-        with py7zr.SevenZipFile(fp) as f:
+        with py7zr.SevenZipFile(self.reader()) as f:
             file_names = [Path(name) for name in self.file_list[start:end]]
             logger.debug("read")
             file_list = [str(name) for name in self.file_list[start:end]]
@@ -448,18 +1182,16 @@ class SevenZipArchive(ArchiveBase):
 
     def getitem(self, i):
         logger.debug("called")
-        logger.debug(f"i = {i}")
+        logger.debug("i = %s", i)
         file_name = Path()
         file_byte = None
-        logger.debug("to byte")
-        fp = self.file_path if self.data is None else io.BytesIO(self.data)
         logger.debug("open 7z")
         if 0 <= i < len(self):
             logger.debug("with open")
             file_name = Path(self.file_list[i])
-            logger.debug(f"file_name＝ {file_name}")
+            logger.debug("file_name＝ %s", file_name)
             logger.debug("read")
-            with py7zr.SevenZipFile(fp, mode="r") as f:
+            with py7zr.SevenZipFile(self.reader(), mode="r") as f:
                 temp_dir = tempfile.mkdtemp()
                 f.extract(path=temp_dir, targets=[self.file_list[i]])
 
@@ -473,16 +1205,79 @@ class SevenZipArchive(ArchiveBase):
         if file_byte is None:
             raise ValueError("file_byte is None. file not found in 7z.")
 
-        logger.debug(f"file_bype = {file_byte}")
-        logger.debug(f"i={i}")
-        logger.debug(self.file_list[i])
-        logger.debug(file_name)
+        logger.debug("file_bype = %s", file_byte)
+        logger.debug("i=%s", i)
+        logger.debug("%s", self.file_list[i])
+        logger.debug("%s", file_name)
         logger.debug("return")
         return file_name, file_byte
 
 
+def ccitt_tiff(data, width, height, params, black_is_1):
+    # TIFF file holding CCITT fax data of PDF image, so that PIL can decode it.
+    # K < 0 is Group 4, K = 0 is Group 3 1D and K > 0 is Group 3 2D.
+    k = params.get("/K", 0)
+    compression = 4 if k < 0 else 3
+    # black runs are 1 with WhiteIsZero. BlackIs1 inverts it.
+    photometric = 1 if black_is_1 else 0
+    entries = [
+        (256, 4, width),
+        (257, 4, height),
+        (258, 3, 1),
+        (259, 3, compression),
+        (262, 3, photometric),
+        (273, 4, 0),
+        (277, 3, 1),
+        (278, 4, height),
+        (279, 4, len(data)),
+    ]
+    if compression == 3:
+        entries.append((292, 4, 1 if k > 0 else 0))
+    else:
+        entries.append((293, 4, 0))
+    ifd_size = 2 + 12 * len(entries) + 4
+    data_offset = 8 + ifd_size
+    ifd = struct.pack("<H", len(entries))
+    for tag, kind, value in entries:
+        if tag == 273:
+            value = data_offset
+        if kind == 3:
+            ifd += struct.pack("<HHIHH", tag, kind, 1, value, 0)
+        else:
+            ifd += struct.pack("<HHII", tag, kind, 1, value)
+    ifd += struct.pack("<I", 0)
+    return b"II*\x00" + struct.pack("<I", 8) + ifd + data
+
+
+def pdf_bool(obj):
+    # PyPDF3 BooleanObject(False) is truthy
+    return bool(getattr(obj, "value", obj))
+
+
+def multiply(m, n):
+    # PDF matrices [a b c d e f]. m is applied first.
+    a, b, c, d, e, f = m
+    a2, b2, c2, d2, e2, f2 = n
+    return [
+        a * a2 + b * c2,
+        a * b2 + b * d2,
+        c * a2 + d * c2,
+        c * b2 + d * d2,
+        e * a2 + f * c2 + e2,
+        e * b2 + f * d2 + f2,
+    ]
+
+
 class PdfArchive(ArchiveBase):
-    def __init__(self, file_path, data=None):
+    index_headers = True
+    # dpi of pdf2image
+    dpi = 200
+    # operators allowed in content of a page showing one image
+    image_page_operators = [b"q", b"Q", b"cm", b"gs", b"Do"]
+    # part of page the image must cover
+    full_page = 0.9
+
+    def __init__(self, file_path, data=None, preload=True):
         if "pdf2image" not in globals():
             global pdf2image
             import pdf2image
@@ -491,102 +1286,259 @@ class PdfArchive(ArchiveBase):
             import PyPDF3
         super().__init__()
         self.images = []
+        # PyPDF3 reader made in open. reused to read embedded images.
+        self.pdf = None
+        self.pdf_file = None
+        self.pdf_lock = threading.Lock()
+        # nested pdf written for worker processes
+        self.temp_path = None
 
         self.multi_read = True
 
         self.open(file_path, data)
-        self.start_preload()
+        if preload:
+            self.start_preload()
 
     def open(self, file_path, data=None):
         self.file_path = file_path
         self.data = data
 
-        page_num = 0
         if data is not None:
             data.seek(0)
-            pdf = PyPDF3.PdfFileReader(self.data)
-            page_num = pdf.getNumPages()
+            # reader seeks data. copy it not to move position of parent.
+            self.pdf_file = io.BytesIO(data.getvalue())
         else:
-            with open(self.file_path, "rb") as f:
-                pdf = PyPDF3.PdfFileReader(f)
-                page_num = pdf.getNumPages()
+            self.pdf_file = open(self.file_path, "rb")
+        self.pdf = PyPDF3.PdfFileReader(self.pdf_file, strict=False)
+        page_num = self.pdf.getNumPages()
 
         self.file_list = [Path(str(i + 1) + ".png") for i in range(page_num)]
 
+    def close(self):
+        super().close()
+        with self.pdf_lock:
+            if self.pdf_file is not None:
+                self.pdf_file.close()
+            self.pdf_file = None
+            self.pdf = None
+            if self.temp_path is not None:
+                self.temp_path.unlink(missing_ok=True)
+                self.temp_path = None
+
+    def embedded_image(self, i):
+        # bytes of the image if page i shows only one image covering the page,
+        # else None.
+        with self.pdf_lock:
+            if self.pdf is None:
+                return None
+            try:
+                return self.read_embedded_image(i)
+            except Exception as e:
+                logger.debug("page %s: %s", i, e)
+                return None
+
+    def read_embedded_image(self, i):
+        page = self.pdf.getPage(i)
+        if page.get("/Rotate", 0) % 360 != 0:
+            return None
+        contents = page.getContents()
+        if contents is None:
+            return None
+        ops = PyPDF3.pdf.ContentStream(contents, self.pdf).operations
+
+        ctm = [1, 0, 0, 1, 0, 0]
+        stack = []
+        shown = []
+        for operands, operator in ops:
+            if operator not in self.image_page_operators:
+                return None
+            match operator:
+                case b"q":
+                    stack.append(ctm)
+                case b"Q":
+                    ctm = stack.pop() if len(stack) != 0 else ctm
+                case b"cm":
+                    ctm = multiply([float(x) for x in operands], ctm)
+                case b"Do":
+                    shown.append((operands[0], ctm))
+        if len(shown) != 1:
+            return None
+        name, ctm = shown[0]
+
+        xobjects = page["/Resources"].getObject()["/XObject"].getObject()
+        image = xobjects[name].getObject()
+        if image.get("/Subtype") != "/Image":
+            return None
+        if "/SMask" in image or pdf_bool(image.get("/ImageMask", False)):
+            return None
+        if not self.covers_page(page, ctm):
+            return None
+
+        filters = image.get("/Filter")
+        params = image.get("/DecodeParms", {})
+        if isinstance(filters, list):
+            if len(filters) != 1:
+                return None
+            filters = filters[0]
+            params = params[0] if isinstance(params, list) else params
+        params = params.getObject() if params else {}
+        decode = [float(x) for x in image.get("/Decode", [])]
+
+        match filters:
+            case "/DCTDecode" | "/JPXDecode":
+                if len(decode) != 0:
+                    return None
+                metrics.count("pdf.embedded")
+                return image._data
+            case "/CCITTFaxDecode":
+                if pdf_bool(params.get("/EncodedByteAlign", False)):
+                    return None
+                metrics.count("pdf.embedded")
+                if image._data[:4] in [b"II*\x00", b"MM\x00*"]:
+                    # Pillow writes whole TIFF file instead of CCITT data.
+                    return image._data
+                black_is_1 = pdf_bool(params.get("/BlackIs1", False))
+                if decode == [1, 0]:
+                    black_is_1 = not black_is_1
+                return ccitt_tiff(
+                    image._data,
+                    int(params.get("/Columns", 1728)),
+                    int(image["/Height"]),
+                    params,
+                    black_is_1,
+                )
+        return None
+
+    def covers_page(self, page, ctm):
+        # image is drawn in unit square transformed by ctm.
+        # rotated or flipped images are rasterized.
+        a, b, c, d, e, f = ctm
+        if b != 0 or c != 0 or a <= 0 or d <= 0:
+            return False
+        box = [float(x) for x in page.cropBox]
+        x0, x1 = sorted([box[0], box[2]])
+        y0, y1 = sorted([box[1], box[3]])
+        w = min(x1, e + a) - max(x0, e)
+        h = min(y1, f + d) - max(y0, f)
+        if w <= 0 or h <= 0:
+            return False
+        return w * h >= self.full_page * (x1 - x0) * (y1 - y0)
+
+    def read_dimension(self, i):
+        # size of rasterized page
+        with self.pdf_lock:
+            if self.pdf is None:
+                return None
+            page = self.pdf.getPage(i)
+            box = [float(x) for x in page.cropBox]
+            rotate = page.get("/Rotate", 0) % 180
+        width = abs(box[2] - box[0]) * self.dpi / 72
+        height = abs(box[3] - box[1]) * self.dpi / 72
+        if rotate != 0:
+            width, height = height, width
+        return round(width), round(height), "RGB"
+
+    def rasterize(self, start, end):
+        # PIL images of pages start <= i < end. pdf2image pages start from 1.
+        metrics.count("pdf.rasterized", end - start)
+        if self.data is None:
+            logger.debug("read images from file_path")
+            return pdf2image.convert_from_path(
+                self.file_path, first_page=start + 1, last_page=end
+            )
+        logger.debug("read images from data")
+        self.data.seek(0)
+        return pdf2image.convert_from_bytes(
+            self.data.read(), first_page=start + 1, last_page=end
+        )
+
+    def source(self, i):
+        data = self.embedded_image(i)
+        if data is not None:
+            return ("bytes", str(self.file_list[i]), data)
+        if self.data is None:
+            return ("pdf", str(self.file_path), None, i + 1)
+        # nested pdf is written once, not pickled for every page
+        temp_path = self.write_temp()
+        if temp_path is None:
+            return ("pdf", None, self.data.getvalue(), i + 1)
+        return ("pdf", str(temp_path), None, i + 1)
+
+    def write_temp(self):
+        with self.pdf_lock:
+            if self.temp_path is not None or self.pdf is None:
+                return self.temp_path
+            fd, path = tempfile.mkstemp(suffix=".pdf")
+            try:
+                with os.fdopen(fd, "wb") as f, self.data.getbuffer() as buf:
+                    f.write(buf)
+            except OSError as e:
+                logger.debug("failed to write nested pdf: %s", e)
+                Path(path).unlink(missing_ok=True)
+                return None
+            self.temp_path = Path(path)
+            return self.temp_path
+
     def getitems(self, start, end):
         end += 1
         logger.debug("called")
-        logger.debug(f"start, end = {start}, {end}")
+        logger.debug("start, end = %s, %s", start, end)
 
         file_names = self.file_list[start:end]
-        logger.debug(f"file_names = {file_names}")
+        logger.debug("file_names = %s", file_names)
 
         if len(self.images) != 0:
             logger.debug("return cached images")
             return file_names, self.images[start:end]
 
-        logger.debug(f"page = {start}:{end}")
+        logger.debug("page = %s:%s", start, end)
+        images = []
+        for i in range(start, start + len(file_names)):
+            data = self.embedded_image(i)
+            images.append(None if data is None else io.BytesIO(data))
 
-        if self.data is None:
-            logger.debug("read images from file_path")
-            images = pdf2image.convert_from_path(
-                self.file_path, first_page=start, last_page=end + 1
-            )
-        else:
-            logger.debug("read images from data")
-            self.data.seek(0)
-            images = pdf2image.convert_from_bytes(
-                self.data.read(), first_page=start, last_page=end + 1
-            )
+        # rasterize pages without embedded image by one call
+        missing = [j for j, image in enumerate(images) if image is None]
+        if len(missing) != 0:
+            rasterized = self.rasterize(start + missing[0], start + missing[-1] + 1)
+            for j in missing:
+                images[j] = rasterized[j - missing[0]]
 
-        logger.debug(f"return. {len(file_names)} == {len(images)}")
+        logger.debug("return. %s == %s", len(file_names), len(images))
         return file_names, images
 
     def getitem(self, i):
         logger.debug("called")
         file_name: Path = self.file_list[i]
-        logger.debug(f"file_name = {file_name}")
+        logger.debug("file_name = %s", file_name)
 
         if len(self.images) != 0:
             return file_name, self.images[i]
 
-        image = None
-
-        logger.debug(f"page = {i}")
+        logger.debug("page = %s", i)
 
-        if self.data is None:
-            logger.debug("read from file_path")
-            images = pdf2image.convert_from_path(
-                self.file_path, first_page=i, last_page=i + 1
-            )
-        else:
-            logger.debug("read from data")
-            self.data.seek(0)
-            images = pdf2image.convert_from_bytes(
-                self.data.read(), first_page=i, last_page=i + 1
-            )
-
-        if len(images) != 0:
-            image = images[0]
-        else:
-            logger.debug("images is not empty.")
+        data = self.embedded_image(i)
+        if data is not None:
+            return file_name, io.BytesIO(data)
 
-        if image is None:
+        images = self.rasterize(i, i + 1)
+        if len(images) == 0:
             raise ValueError("image is None. file not found in pdf.")
 
         logger.debug("return")
-        return file_name, image
+        return file_name, images[0]
 
 
 class TarArchive(ArchiveBase):
-    def __init__(self, file_path, data=None):
-        if "tarfile" not in "globals":
+    def __init__(self, file_path, data=None, preload=True):
+        if "tarfile" not in globals():
             global tarfile
             import tarfile
         super().__init__()
         self.multi_read = True
         self.open(file_path, data)
-        self.start_preload()
+        if preload:
+            self.start_preload()
 
     def open(self, file_path, data=None):
         logger.debug("called")
@@ -594,32 +1546,31 @@ class TarArchive(ArchiveBase):
         self.data = data
         self.file_list = []
 
-        logger.debug("to byte")
-        if self.data is not None:
-            self.data.seek(0)
-        file_path = self.file_path if data is None else self.data
-
         logger.debug("open tar")
-        logger.debug(f"file_path = {file_path}")
-        logger.debug(f"type(file_path) = {type(file_path)}")
-        with tarfile.open(file_path) as f:
+        with self.tar_file() as f:
             self.file_list = [Path(s) for s in f.getnames()]
 
         logger.debug("open tar")
         self.sort_file_list()
         self.filtering_file_list()
-        logger.debug(self.file_list)
+        logger.debug("%s", self.file_list)
+
+    def tar_file(self):
+        # TarFile of its own reader. nested tar is given as file object.
+        fp = self.reader()
+        if hasattr(fp, "read"):
+            return tarfile.open(fileobj=fp)
+        return tarfile.open(fp)
 
     def getitems(self, start, end):
         end += 1
         logger.debug("called")
-        logger.debug(f"start, end = {start}, {end}")
+        logger.debug("start, end = %s, %s", start, end)
 
         file_names = self.file_list[start:end]
-        logger.debug(f"file_names = {file_names}")
-        fp = self.file_path if self.data is None else self.data
+        logger.debug("file_names = %s", file_names)
 
-        with tarfile.open(fp) as f:
+        with self.tar_file() as f:
             file_bytes = []
             for name in file_names:
                 file = f.extractfile(str(name))
@@ -629,19 +1580,16 @@ class TarArchive(ArchiveBase):
 
             # file_bytes = [io.BytesIO(f.extractfile(name).read()) for name in file_names]
 
-        logger.debug(f"return. {len(file_names)}")
+        logger.debug("return. %s", len(file_names))
         return file_names, file_bytes
 
     def getitem(self, i):
         logger.debug("__getitem__")
         file_name = Path()
         file_byte = None
-        logger.debug("to byte")
-        fp = self.file_path if self.data is None else self.data
-
         logger.debug("read file")
         if 0 <= i < len(self):
-            with tarfile.open(fp) as f:
+            with self.tar_file() as f:
                 file_name = str(self.file_list[i])
                 file = f.extractfile(file_name)
                 if file is None:
@@ -651,13 +1599,102 @@ class TarArchive(ArchiveBase):
         if file_byte is None:
             raise ValueError("file_byte is None. file not found in tar.")
 
-        logger.debug(f"i={i}")
-        logger.debug(self.file_list[i])
-        logger.debug(file_name)
+        logger.debug("i=%s", i)
+        logger.debug("%s", self.file_list[i])
+        logger.debug("%s", file_name)
         logger.debug("return")
         return Path(file_name), io.BytesIO(file_byte)
 
 
+# .tar.zst, .tar.xz and .tar.bz2.
+# Members are listed once on open, then read through seekable.BlockStream,
+# which decompresses only the compressed blocks holding the member.
+class CompressedTarArchive(ArchiveBase):
+    index_headers = True
+
+    def __init__(self, file_path, data=None, preload=True):
+        if "tarfile" not in globals():
+            global tarfile
+            import tarfile
+        if "seekable" not in globals():
+            global seekable
+            import seekable
+        super().__init__()
+        self.stream = None
+        # name: (offset, size) in decompressed tar
+        self.members = {}
+        self.open(file_path, data)
+        if preload:
+            self.start_preload()
+
+    def open(self, file_path, data=None):
+        logger.debug("called")
+        self.file_path = file_path
+        self.data = data
+        self.file_list = []
+
+        suffix = Path(file_path).suffix.lower()
+        fp = self.file_path if data is None else self.data
+        self.stream = seekable.open_stream(fp, suffix)
+
+        # reading headers decompresses every block once.
+        with tarfile.open(fileobj=self.stream, mode="r:") as f:
+            for info in f:
+                if info.isfile():
+                    self.members[str(Path(info.name))] = (info.offset_data, info.size)
+        self.file_list = [Path(name) for name in self.members]
+        logger.debug("%s members", len(self.members))
+
+        self.sort_file_list()
+        self.filtering_file_list()
+
+    def close(self):
+        super().close()
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def getitem(self, i):
+        logger.debug("i=%s", i)
+        if not 0 <= i < len(self):
+            raise ValueError("file not found in tar.")
+        file_name = self.file_list[i]
+        offset, size = self.members[str(file_name)]
+        return file_name, io.BytesIO(self.stream.pread(offset, size))
+
+    def read_header(self, i):
+        offset, size = self.members[str(self.file_list[i])]
+        return io.BytesIO(self.stream.pread(offset, min(size, self.header_size)))
+
+
+def open_archive(file_path, data=None, preload=True):
+    # preload is False to start preload thread later by start_preload
+    suffix = Path(file_path).suffix.lower()
+
+    match suffix:
+        case ".zip":
+            logger.debug("zip")
+            return ZipArchive(file_path, data, preload)
+        case ".rar":
+            logger.debug("rar")
+            return RarArchive(file_path, data, preload)
+        case ".7z":
+            logger.debug("7z")
+            return SevenZipArchive(file_path, data, preload)
+        case ".pdf":
+            logger.debug("pdf")
+            return PdfArchive(file_path, data, preload)
+        case ".tar" | ".gz":
+            logger.debug("tar or gz")
+            return TarArchive(file_path, data, preload)
+        case ".zst" | ".xz" | ".bz2":
+            logger.debug("compressed tar")
+            return CompressedTarArchive(file_path, data, preload)
+        case _:
+            logger.debug("directory")
+            return DirectoryArchive(file_path, data)
+
+
 class ArchiveTree:
     def __init__(self):
         self.root = []
@@ -699,7 +1736,7 @@ class ArchiveTree:
             file_path = archive.file_path
             next_file_path, data = archive.next()
             logger.debug(
-                f"i,file_path,next_file_path = {i},{file_path},{next_file_path}"
+                "i,file_path,next_file_path = %s,%s,%s", i, file_path, next_file_path
             )
             if file_path == next_file_path:
                 logger.debug("go to parent")
@@ -707,7 +1744,7 @@ class ArchiveTree:
                 continue
 
             # archive.start_preload()
-            logger.debug(f"next_file_path = {next_file_path}")
+            logger.debug("next_file_path = %s", next_file_path)
             return next_file_path, data, archive
 
         logger.debug("not found")
@@ -723,7 +1760,7 @@ class ArchiveTree:
             file_path = archive.file_path
             next_file_path, data = archive.prev()
             logger.debug(
-                f"i,file_path,next_file_path = {i},{file_path},{next_file_path}"
+                "i,file_path,next_file_path = %s,%s,%s", i, file_path, next_file_path
             )
             if file_path == next_file_path:
                 logger.debug("go to parent")
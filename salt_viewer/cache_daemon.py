@@ -0,0 +1,461 @@
+from pathlib import Path
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import queue
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import weakref
+from multiprocessing import resource_tracker, shared_memory
+from PIL import Image
+from decode_pool import SharedPixels, shared_mode
+from instance import remove_stale, socket_path
+from metrics import metrics
+import log
+from log import get_logger
+
+# __name__ is "__main__" when the daemon is started as script
+logger = get_logger("cache_daemon")
+
+
+def render_name(render_id, render_key):
+    # same key as DiskCache
+    return hashlib.sha1(f"{render_id}\0{render_key}".encode()).hexdigest()
+
+
+# Cache shared by SaltViewer processes of one user.
+# Renders are kept in shared memory segments and indexes of archives in
+# memory of this process. Viewers talk to it over a Unix domain socket with
+# JSON lines. A viewer holds a reference to each render it maps, and renders
+# are evicted in least recently used order only when no viewer holds them.
+# References of a viewer are dropped when its connection is closed, so a
+# crashed viewer does not pin memory.
+class CacheDaemon:
+    max_indexes = 1000
+    # exit after no viewer is connected for this seconds
+    idle_exit = 60.0
+
+    def __init__(self, path, max_size):
+        self.path = Path(path)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # key: {"shm", "name", "mode", "size", "nbytes", "refs"}. dict order is LRU.
+        self.renders = {}
+        # segment name: key
+        self.names = {}
+        # archive identity: {page: [width, height, mode] or None}
+        self.indexes = {}
+        self.total = 0
+        self.clients = 0
+        self.last_client = time.monotonic()
+
+        remove_stale(self.path)
+        # listen on a name of this process, then link it to path, as
+        # InstanceServer does. link fails if another daemon has made path.
+        tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}")
+        tmp.unlink(missing_ok=True)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # --socket can be out of the private directory of socket_path.
+        # the socket must not be accessible by others even for a moment.
+        umask = os.umask(0o077)
+        try:
+            self.sock.bind(str(tmp))
+            self.sock.listen(16)
+            os.link(tmp, self.path)
+        except OSError:
+            self.sock.close()
+            raise
+        finally:
+            os.umask(umask)
+            tmp.unlink(missing_ok=True)
+        self.inode = self.path.stat().st_ino
+        logger.info("listening %s, %sMB", self.path, max_size // (1024 * 1024))
+
+    def serve(self):
+        self.sock.settimeout(1.0)
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.timeout:
+                with self.lock:
+                    idle = self.clients == 0
+                    since = time.monotonic() - self.last_client
+                if idle and since > self.idle_exit:
+                    logger.info("no viewer for %ss. exit", self.idle_exit)
+                    return
+                continue
+            conn.settimeout(None)
+            with self.lock:
+                self.clients += 1
+            t = threading.Thread(target=self.client_thread, args=(conn,), daemon=True)
+            t.start()
+
+    def client_thread(self, conn):
+        # segment name: number of references held by this viewer
+        held = {}
+        try:
+            with conn, conn.makefile("rb") as reader:
+                for line in reader:
+                    try:
+                        request = json.loads(line)
+                        reply = self.handle(request, held)
+                    except (ValueError, KeyError, TypeError) as e:
+                        reply = {"error": str(e)}
+                    conn.sendall(json.dumps(reply).encode() + b"\n")
+        except OSError as e:
+            logger.debug("viewer disconnected: %s", e)
+        with self.lock:
+            for name, n in held.items():
+                self.release(name, n)
+            self.clients -= 1
+            self.last_client = time.monotonic()
+
+    def handle(self, request, held):
+        with self.lock:
+            for name in request.get("release", []):
+                if held.get(name, 0) > 0:
+                    held[name] -= 1
+                    self.release(name, 1)
+            match request["op"]:
+                case "get":
+                    return self.get(request["key"], held)
+                case "put":
+                    return self.put(request)
+                case "get_index":
+                    index = self.indexes.pop(request["key"], None)
+                    if index is not None:
+                        self.indexes[request["key"]] = index
+                    return {"index": index}
+                case "put_index":
+                    self.indexes.pop(request["key"], None)
+                    self.indexes[request["key"]] = request["index"]
+                    while len(self.indexes) > self.max_indexes:
+                        del self.indexes[next(iter(self.indexes))]
+                    return {"ok": True}
+                case "release":
+                    return {"ok": True}
+                case "stats":
+                    return {
+                        "bytes": self.total,
+                        "renders": len(self.renders),
+                        "held": sum(1 for e in self.renders.values() if e["refs"]),
+                        "indexes": len(self.indexes),
+                        "viewers": self.clients,
+                    }
+                case op:
+                    raise ValueError(f"unknown op {op}")
+
+    def get(self, key, held):
+        entry = self.renders.pop(key, None)
+        if entry is None:
+            return {"name": None}
+        self.renders[key] = entry
+        entry["refs"] += 1
+        held[entry["name"]] = held.get(entry["name"], 0) + 1
+        return {k: entry[k] for k in ["name", "mode", "size"]}
+
+    def put(self, request):
+        # the viewer wrote the segment. this process owns it from now.
+        name, nbytes = request["name"], request["nbytes"]
+        if request["key"] in self.renders or not self.make_room(nbytes):
+            unlink(name)
+            return {"ok": False}
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            return {"ok": False}
+        # the mapping is not used here. keep the object to unlink it.
+        shm.close()
+        self.renders[request["key"]] = {
+            "shm": shm,
+            "name": name,
+            "mode": request["mode"],
+            "size": request["size"],
+            "nbytes": nbytes,
+            "refs": 0,
+        }
+        self.names[name] = request["key"]
+        self.total += nbytes
+        return {"ok": True}
+
+    def make_room(self, nbytes):
+        # evict renders no viewer holds until nbytes fits
+        if nbytes > self.max_size:
+            return False
+        for key in list(self.renders):
+            if self.total + nbytes <= self.max_size:
+                break
+            if self.renders[key]["refs"] == 0:
+                self.evict(key)
+        return self.total + nbytes <= self.max_size
+
+    def evict(self, key):
+        entry = self.renders.pop(key)
+        del self.names[entry["name"]]
+        self.total -= entry["nbytes"]
+        try:
+            entry["shm"].unlink()
+        except FileNotFoundError:
+            pass
+        logger.debug("evict %s", key)
+
+    def release(self, name, n):
+        key = self.names.get(name)
+        if key is not None:
+            self.renders[key]["refs"] -= n
+
+    def close(self):
+        self.sock.close()
+        with self.lock:
+            for key in list(self.renders):
+                self.evict(key)
+        try:
+            if self.path.stat().st_ino == self.inode:
+                self.path.unlink()
+        except OSError:
+            pass
+
+
+def unlink(name):
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+# Client of CacheDaemon in SaltViewer.
+# It is used in place of DiskCache, and DiskCache of CacheDir, if any, is
+# asked on miss. The daemon is started on first use if it is not running.
+# Renders are mapped without copying, and released when the image is freed.
+class SharedCache:
+    # seconds before connecting again after the daemon is gone
+    retry = 5.0
+
+    def __init__(self, max_size, fallback=None, path=None):
+        self.max_size = max_size
+        self.fallback = fallback
+        # OSError if the directory of sockets is not private
+        self.path = path or socket_path("cache")
+        self.lock = threading.Lock()
+        self.sock = None
+        self.reader = None
+        self.retry_at = 0.0
+        self.spawned = False
+        # names of freed renders. sent with next request. finalizers do not
+        # take the lock, which can be held by the thread running them.
+        self.released = []
+        self.counter = itertools.count()
+
+        self.queue = queue.Queue(maxsize=8)
+        t = threading.Thread(target=self.write_thread, name="shared cache", daemon=True)
+        t.start()
+
+    def connect(self):
+        if self.sock is not None:
+            return True
+        if time.monotonic() < self.retry_at:
+            return False
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(2.0)
+        try:
+            sock.connect(str(self.path))
+        except OSError as e:
+            sock.close()
+            logger.debug("no cache daemon: %s", e)
+            self.retry_at = time.monotonic() + (1.0 if not self.spawned else self.retry)
+            if not self.spawned:
+                self.spawned = True
+                self.spawn()
+            return False
+        self.sock = sock
+        self.reader = sock.makefile("rb")
+        # references of the old connection were dropped by the daemon
+        self.released = []
+        logger.debug("connected %s", self.path)
+        return True
+
+    def spawn(self):
+        # the daemon outlives this process and exits when no viewer is left
+        args = [sys.executable, str(Path(__file__).resolve())]
+        args += ["--socket", str(self.path), "--size", str(self.max_size)]
+        try:
+            subprocess.Popen(
+                args,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+        except OSError as e:
+            logger.warning(f"failed to start cache daemon: {e}")
+
+    def request(self, request):
+        # reply of the daemon, or None if it is not available
+        with self.lock:
+            if not self.connect():
+                return None
+            released, self.released = self.released, []
+            request["release"] = released
+            try:
+                self.sock.sendall(json.dumps(request).encode() + b"\n")
+                line = self.reader.readline()
+                if len(line) == 0:
+                    raise ConnectionError("cache daemon is closed")
+                return json.loads(line)
+            except (OSError, ValueError) as e:
+                logger.debug("cache daemon failed: %s", e)
+                self.disconnect()
+                return None
+
+    def disconnect(self):
+        self.reader.close()
+        self.sock.close()
+        self.sock = None
+        self.reader = None
+        self.retry_at = time.monotonic() + self.retry
+
+    def get(self, render_id, render_key):
+        reply = self.request({"op": "get", "key": render_name(render_id, render_key)})
+        if reply is not None and reply.get("name") is not None:
+            try:
+                image = self.attach(reply["name"], reply["mode"], tuple(reply["size"]))
+            except OSError as e:
+                logger.debug("attach failed: %s", e)
+                self.release(reply["name"])
+            else:
+                logger.debug("shared cache hit")
+                metrics.count("shared_cache.hit")
+                image.from_disk_cache = True
+                return image
+        metrics.count("shared_cache.miss")
+        if self.fallback is None:
+            return None
+        image = self.fallback.get(render_id, render_key)
+        if image is not None and reply is not None:
+            # other viewers get it from memory
+            self.put_shared(render_id, render_key, image)
+        return image
+
+    def attach(self, name, mode, size):
+        shm = SharedPixels(name=name)
+        # the daemon unlinks it. resource tracker of this process must not.
+        resource_tracker.unregister(shm._name, "shared_memory")
+        image = Image.frombuffer(mode, size, shm.buf, "raw", mode, 0, 1)
+        image.shared_memory = shm
+        weakref.finalize(image, self.release, name)
+        return image
+
+    def release(self, name):
+        # called when a render from attach is freed
+        self.released.append(name)
+
+    def put(self, render_id, render_key, image):
+        if getattr(image, "is_animated", False):
+            return
+        if self.fallback is not None:
+            self.fallback.put(render_id, render_key, image)
+        self.put_shared(render_id, render_key, image)
+
+    def put_shared(self, render_id, render_key, image):
+        try:
+            self.queue.put_nowait((render_name(render_id, render_key), image))
+        except queue.Full:
+            logger.debug("write queue is full. skipping")
+            metrics.count("shared_cache.skip")
+
+    def write_thread(self):
+        while True:
+            key, image = self.queue.get()
+            try:
+                self.write(key, image)
+            except OSError as e:
+                logger.warning(f"failed to write shared cache: {e}")
+
+    def write(self, key, image):
+        mode = shared_mode(image)
+        if image.mode != mode:
+            image = image.convert(mode)
+        nbytes = image.width * image.height * len(mode)
+        name = f"svc_{os.getpid()}_{next(self.counter)}"
+        shm = shared_memory.SharedMemory(name=name, create=True, size=nbytes)
+        try:
+            shm.buf[:nbytes] = image.tobytes()
+        finally:
+            # the daemon owns it after put
+            resource_tracker.unregister(shm._name, "shared_memory")
+            shm.close()
+        request = {"op": "put", "key": key, "name": name, "mode": mode}
+        request.update({"size": list(image.size), "nbytes": nbytes})
+        reply = self.request(request)
+        if reply is None:
+            unlink(name)
+        elif reply.get("ok"):
+            metrics.count("shared_cache.write")
+        else:
+            metrics.count("shared_cache.reject")
+
+    def get_index(self, identity):
+        reply = self.request({"op": "get_index", "key": identity})
+        if reply is None or reply.get("index") is None:
+            return None
+        metrics.count("shared_cache.index_hit")
+        return {
+            int(j): None if dimension is None else tuple(dimension)
+            for j, dimension in reply["index"].items()
+        }
+
+    def put_index(self, identity, dimensions):
+        self.request({"op": "put_index", "key": identity, "index": dimensions})
+
+    def stats(self):
+        stats = {} if self.fallback is None else dict(self.fallback.stats())
+        stats["shared_write_queue"] = self.queue.qsize()
+        if self.sock is not None:
+            reply = self.request({"op": "stats"})
+            for k, v in (reply or {}).items():
+                stats[f"shared_{k}"] = v
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Cache daemon sharing renders between SaltViewer processes."
+    )
+    parser.add_argument("--socket", help="path of socket", default=None)
+    parser.add_argument(
+        "--size",
+        help="max size of renders in MB. Default is 1024",
+        type=int,
+        default=1024,
+    )
+    parser.add_argument("--debug", help="print debug log", action="store_true")
+    args = parser.parse_args()
+    if args.debug:
+        log.enable_debug("cache_daemon")
+
+    # exit through finally, so that segments are unlinked
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        path = args.socket or socket_path("cache")
+        daemon = CacheDaemon(path, args.size * 1024 * 1024)
+    except OSError as e:
+        logger.info("%s", e)
+        return
+    try:
+        daemon.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+from pathlib import Path
+import concurrent.futures
+import io
+import itertools
+import os
+import threading
+from multiprocessing import resource_tracker, shared_memory
+from PIL import Image
+from metrics import metrics
+from thumbnail import mp_context
+from log import get_logger
+
+logger = get_logger(__name__)
+
+
+def shared_mode(image):
+    # modes which Image.frombuffer can wrap without copying.
+    # RGB has 3 bytes per pixel but PIL stores 4, so RGBX is used instead.
+    if image.mode in ["L", "RGBA", "RGBX"]:
+        return image.mode
+    if image.mode in ["1", "I;16"]:
+        return "L"
+    if "A" in image.mode or "transparency" in image.info:
+        return "RGBA"
+    return "RGBX"
+
+
+def open_page(source):
+    # source is made by ArchiveBase.source. see thumbnail.open_source
+    from page_engine import PageEngine
+
+    kind = source[0]
+    if kind == "pdf":
+        import pdf2image
+
+        _, file_path, data, page = source
+        if file_path is not None:
+            images = pdf2image.convert_from_path(
+                file_path, first_page=page, last_page=page
+            )
+        else:
+            images = pdf2image.convert_from_bytes(data, first_page=page, last_page=page)
+        return images[0] if len(images) != 0 else None
+    if kind == "path":
+        return PageEngine().decode(source[1])
+    return PageEngine().decode(source[1], io.BytesIO(source[2]))
+
+
+def decode_page(name, source, size, div, settings):
+    # run in worker process. decode and resize page, write pixels to shared
+    # memory of name and return (name, mode, size).
+    from page_engine import PageEngine
+
+    engine = PageEngine()
+    engine.fit_width, engine.fit_height = settings[:2]
+    engine.up_scale, engine.down_scale, engine.reducing_gap = settings[2:]
+    image = open_page(source)
+    if image is None:
+        return None
+    image = engine.resize_image(image, size, div)
+    mode = shared_mode(image)
+    if image.mode != mode:
+        image = image.convert(mode)
+
+    nbytes = image.width * image.height * len(mode)
+    shm = shared_memory.SharedMemory(name=name, create=True, size=nbytes)
+    # an image made by frombuffer is readonly, and paste into it would write
+    # to its copy instead of shared memory.
+    shm.buf[:nbytes] = image.tobytes()
+    # UI process unlinks it. resource tracker must not remove it when this
+    # worker exits.
+    resource_tracker.unregister(shm._name, "shared_memory")
+    shm.close()
+    return shm.name, mode, image.size
+
+
+class SharedPixels(shared_memory.SharedMemory):
+    # image made by frombuffer can be freed after this at exit.
+    # the mapping is freed with the image then.
+    def __del__(self):
+        try:
+            self.close()
+        except BufferError:
+            pass
+
+
+def attach(name, mode, size):
+    # image sharing pixels with shared memory written by worker
+    shm = SharedPixels(name=name)
+    # name is not needed after mapping. memory is freed with the image.
+    shm.unlink()
+    image = Image.frombuffer(mode, size, shm.buf, "raw", mode, 0, 1)
+    image.shared_memory = shm
+    return image
+
+
+# Decode and resize pages in worker processes.
+# Preload thread submits pages read ahead, and the results are display-ready
+# renders like the ones in disk cache. Pixels are returned through shared
+# memory instead of pickling.
+class DecodePool:
+    # formats slow to decode in Python process
+    suffixes = [".avif", ".webp", ".png"]
+
+    def __init__(self, engine, max_workers=None):
+        # engine of ImageFrame. fit mode and algorithms are read on submit.
+        self.engine = engine
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.max_workers, mp_context=mp_context()
+        )
+        # names of shared memory not attached yet. they are removed on
+        # shutdown if results are not taken.
+        self.lock = threading.Lock()
+        self.names = set()
+        self.counter = itertools.count()
+
+    def settings(self):
+        engine = self.engine
+        return (
+            engine.fit_width,
+            engine.fit_height,
+            engine.up_scale,
+            engine.down_scale,
+            engine.reducing_gap,
+        )
+
+    def accepts(self, file_name):
+        return Path(file_name).suffix.lower() in self.suffixes
+
+    def submit(self, source, size, div):
+        name = f"sv_{os.getpid()}_{next(self.counter)}"
+        with self.lock:
+            self.names.add(name)
+        try:
+            return self.executor.submit(
+                decode_page, name, source, size, div, self.settings()
+            )
+        except RuntimeError:
+            # executor is shutdown
+            return None
+
+    def result(self, future):
+        # image or None if decoding failed
+        if future is None:
+            return None
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.debug("decode failed: %s", e)
+            metrics.count("decode_pool.failed")
+            return None
+        if result is None:
+            return None
+        with self.lock:
+            self.names.discard(result[0])
+        metrics.count("decode_pool.decoded")
+        return attach(*result)
+
+    def shutdown(self):
+        # wait running decodes, so that their shared memory can be removed
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        with self.lock:
+            names, self.names = self.names, set()
+        for name in names:
+            try:
+                shared_memory.SharedMemory(name=name).unlink()
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,137 @@
+from pathlib import Path
+import errno
+import os
+import queue
+import shutil
+import threading
+from metrics import metrics
+from log import get_logger
+
+logger = get_logger(__name__)
+
+
+# Trash, move and rename files on a worker thread.
+# SaltViewer removes the file from root_dir and opens the next file at once,
+# and operations run here one by one. Moving to another filesystem is a copy,
+# which is done in chunks to report progress. Results are polled by
+# SaltViewer, which puts failed files back to root_dir.
+class FileOps:
+    chunk_size = 8 * 1024 * 1024
+    # suffix of file being copied. it is renamed when the copy is complete.
+    part_suffix = ".svpart"
+
+    def __init__(self):
+        # (op, src, dst)
+        self.queue = queue.Queue()
+        # (op, src, dst, error or None)
+        self.results = queue.Queue()
+        self.lock = threading.Lock()
+        # (op, src, bytes done, bytes total) of running operation
+        self.running = None
+        self.thread = threading.Thread(target=self.worker, name="file ops", daemon=True)
+        self.thread.start()
+
+    def submit(self, op, src, dst=None):
+        # op is "trash", "move" or "rename"
+        logger.debug("submit %s %s -> %s", op, src, dst)
+        self.queue.put((op, Path(src), None if dst is None else Path(dst)))
+
+    def busy(self):
+        # queued or running
+        return self.queue.unfinished_tasks != 0
+
+    def progress(self):
+        # text for status bar, or None if idle
+        with self.lock:
+            running = self.running
+        queued = self.queue.qsize()
+        if running is None:
+            return None if queued == 0 else f"{queued} file operations queued"
+        op, src, done, total = running
+        text = f"{op} {src.name}"
+        if total > 0:
+            text += f" {done * 100 // total}%"
+        if queued != 0:
+            text += f" (+{queued})"
+        return text
+
+    def take_results(self):
+        results = []
+        while not self.results.empty():
+            results.append(self.results.get_nowait())
+        return results
+
+    def worker(self):
+        while True:
+            op, src, dst = self.queue.get()
+            with self.lock:
+                self.running = (op, src, 0, 0)
+            error = None
+            try:
+                self.run(op, src, dst)
+                metrics.count(f"file_ops.{op}")
+            except Exception as e:
+                logger.warning(f"{op} failed: {src}: {e}")
+                metrics.count("file_ops.failed")
+                error = e
+            with self.lock:
+                self.running = None
+            self.results.put((op, src, dst, error))
+            self.queue.task_done()
+
+    def run(self, op, src, dst):
+        match op:
+            case "trash":
+                if "send2trash" not in globals():
+                    global send2trash
+                    from send2trash import send2trash
+                send2trash(str(src))
+            case "move" | "rename":
+                self.move(src, dst)
+            case _:
+                raise ValueError(f"unknown operation {op}")
+
+    def move(self, src, dst):
+        try:
+            os.replace(src, dst)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+        if src.is_dir():
+            shutil.move(src, dst)
+            return
+        self.copy(src, dst)
+        os.unlink(src)
+
+    def copy(self, src, dst):
+        # copy to a temporary name, so that a half copied file is never seen
+        # as dst, even if SaltViewer is killed.
+        part = dst.with_name(dst.name + self.part_suffix)
+        total = src.stat().st_size
+        done = 0
+        try:
+            with open(src, "rb") as fsrc, open(part, "wb") as fdst:
+                while True:
+                    chunk = fsrc.read(self.chunk_size)
+                    if len(chunk) == 0:
+                        break
+                    fdst.write(chunk)
+                    done += len(chunk)
+                    with self.lock:
+                        self.running = (self.running[0], src, done, total)
+            try:
+                shutil.copystat(src, part)
+            except OSError as e:
+                # filesystems like FAT do not keep permissions
+                logger.debug("copystat failed: %s", e)
+            os.replace(part, dst)
+        except BaseException:
+            part.unlink(missing_ok=True)
+            raise
+
+    def join(self):
+        # wait queued operations at exit. files must not be left half moved.
+        if self.busy():
+            logger.info("waiting for file operations: %s", self.progress())
+        self.queue.join()
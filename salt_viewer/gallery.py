@@ -0,0 +1,216 @@
+from pathlib import Path
+import collections
+import itertools
+import tkinter as tk
+from PIL import Image, ImageTk
+from log import get_logger
+
+
+logger = get_logger(__name__)
+
+
+# Scrollable grid of thumbnails of pages in an archive or a directory.
+# Only visible rows have canvas items and thumbnails are requested for visible
+# rows first, then one screen ahead. So 10k pages archive builds only a few
+# dozens of thumbnails.
+class Gallery:
+    label_height = 20
+    margin = 8
+    # number of PhotoImage kept. older ones are dropped.
+    max_thumbnails = 512
+
+    # give each gallery unique keys, so that results of old gallery are ignored.
+    counter = itertools.count()
+
+    def __init__(self, master, pool, archive, on_select):
+        self.master = master
+        self.pool = pool
+        self.archive = archive
+        self.on_select = on_select
+        self.gallery_id = next(self.counter)
+
+        self.cell_width = pool.size[0] + self.margin * 2
+        self.cell_height = pool.size[1] + self.label_height + self.margin * 2
+
+        self.thumbnails = collections.OrderedDict()
+        self.failed = set()
+        self.items = {}
+        self.selected = self.archive.i
+        self.top_row = 0
+        self.after_id = None
+
+        self.child = tk.Toplevel(master)
+        self.child.title(f"Gallery: {archive.file_path}")
+        self.child.geometry(
+            f"{master.winfo_width()}x{master.winfo_height()}"
+            + f"+{master.winfo_rootx()}+{master.winfo_rooty()}"
+        )
+        self.child.focus_force()
+        self.child.grab_set()
+
+        self.canvas = tk.Canvas(self.child, highlightthickness=0, bg="black")
+        self.canvas.pack(expand=True, fill="both")
+
+        self.child.bind("<Configure>", lambda event: self.redraw())
+        self.child.bind("<KeyPress-h>", lambda event: self.move(1))
+        self.child.bind("<KeyPress-l>", lambda event: self.move(-1))
+        self.child.bind("<KeyPress-j>", lambda event: self.move(self.columns()))
+        self.child.bind("<KeyPress-k>", lambda event: self.move(-self.columns()))
+        self.child.bind("<KeyPress-g>", lambda event: self.move(-len(self.archive)))
+        self.child.bind("<KeyPress-G>", lambda event: self.move(len(self.archive)))
+        self.child.bind("<Next>", lambda event: self.scroll(self.visible_rows()))
+        self.child.bind("<Prior>", lambda event: self.scroll(-self.visible_rows()))
+        self.child.bind("<Button-4>", lambda event: self.scroll(-1))
+        self.child.bind("<Button-5>", lambda event: self.scroll(1))
+        self.child.bind(
+            "<MouseWheel>", lambda event: self.scroll(-1 if event.delta > 0 else 1)
+        )
+        self.canvas.bind("<Button-1>", self.click)
+        self.canvas.bind("<Double-Button-1>", lambda event: self.select())
+        self.child.bind("<Return>", lambda event: self.select())
+        self.child.bind("<Escape>", lambda event: self.close())
+        self.child.bind("[", lambda event: self.close())
+        self.child.bind("q", lambda event: self.close())
+        self.child.protocol("WM_DELETE_WINDOW", self.close)
+
+        self.poll()
+
+    def width(self):
+        return max(1, self.canvas.winfo_width())
+
+    def height(self):
+        return max(1, self.canvas.winfo_height())
+
+    def columns(self):
+        return max(1, self.width() // self.cell_width)
+
+    def visible_rows(self):
+        return max(1, -(-self.height() // self.cell_height))
+
+    def rows(self):
+        return -(-len(self.archive) // self.columns())
+
+    def visible_range(self):
+        start = self.top_row * self.columns()
+        end = min(len(self.archive), start + self.visible_rows() * self.columns())
+        return start, end
+
+    def key(self, i):
+        return (self.gallery_id, i)
+
+    def scroll(self, rows):
+        top_row = max(
+            0, min(self.rows() - self.visible_rows() + 1, self.top_row + rows)
+        )
+        if top_row == self.top_row:
+            return
+        self.top_row = top_row
+        self.redraw()
+
+    def move(self, c):
+        if len(self.archive) == 0:
+            return
+        self.selected = max(0, min(len(self.archive) - 1, self.selected + c))
+        row = self.selected // self.columns()
+        if row < self.top_row:
+            self.top_row = row
+        elif row >= self.top_row + self.visible_rows() - 1:
+            self.top_row = max(0, row - self.visible_rows() + 2)
+        self.redraw()
+
+    def click(self, event):
+        column = int(event.x // self.cell_width)
+        row = self.top_row + int(event.y // self.cell_height)
+        if column >= self.columns():
+            return
+        i = row * self.columns() + column
+        if i < len(self.archive):
+            self.selected = i
+            self.redraw()
+
+    def select(self):
+        i = self.selected
+        self.close()
+        self.on_select(i)
+
+    def close(self):
+        if self.after_id is not None:
+            self.child.after_cancel(self.after_id)
+            self.after_id = None
+        self.pool.cancel()
+        self.thumbnails.clear()
+        self.child.destroy()
+
+    def redraw(self):
+        # make the selected page visible when window size is changed.
+        if self.top_row == 0 and self.selected >= self.visible_range()[1]:
+            self.top_row = max(0, self.selected // self.columns() - 1)
+
+        self.canvas.delete("all")
+        self.items = {}
+        start, end = self.visible_range()
+        columns = self.columns()
+        for i in range(start, end):
+            x = (i % columns) * self.cell_width
+            y = (i // columns - self.top_row) * self.cell_height
+            self.draw_cell(i, x, y)
+        self.request(start, end)
+
+    def draw_cell(self, i, x, y):
+        if i == self.selected:
+            self.canvas.create_rectangle(
+                x + 2,
+                y + 2,
+                x + self.cell_width - 2,
+                y + self.cell_height - 2,
+                outline="white",
+                width=2,
+            )
+        cx = x + self.cell_width / 2
+        cy = y + self.margin + self.pool.size[1] / 2
+        thumbnail = self.thumbnails.get(self.key(i))
+        if thumbnail is not None:
+            self.thumbnails.move_to_end(self.key(i))
+            self.items[i] = self.canvas.create_image(cx, cy, image=thumbnail)
+        else:
+            text = "..." if self.key(i) not in self.failed else "-"
+            self.items[i] = self.canvas.create_text(cx, cy, text=text, fill="gray")
+        name = Path(self.archive.file_list[i]).name
+        self.canvas.create_text(
+            cx,
+            y + self.cell_height - self.margin - self.label_height / 2,
+            text=f"{i + 1}: {name}"[:32],
+            fill="white",
+        )
+
+    def request(self, start, end):
+        # visible rows first, then next screen
+        ahead = min(len(self.archive), end + (end - start))
+        requests = []
+        for i in range(start, ahead):
+            key = self.key(i)
+            if key in self.thumbnails or key in self.failed:
+                continue
+            requests.append((key, lambda i=i: self.archive.source(i)))
+        self.pool.request(requests)
+
+    def poll(self):
+        updated = False
+        while not self.pool.results.empty():
+            key, result = self.pool.results.get_nowait()
+            if key[0] != self.gallery_id:
+                continue
+            if result is None:
+                self.failed.add(key)
+            else:
+                mode, size, buf = result
+                image = Image.frombytes(mode, size, buf)
+                self.thumbnails[key] = ImageTk.PhotoImage(image=image)
+                if len(self.thumbnails) > self.max_thumbnails:
+                    self.thumbnails.popitem(last=False)
+            start, end = self.visible_range()
+            if start <= key[1] < end:
+                updated = True
+        if updated:
+            self.redraw()
+        self.after_id = self.child.after(30, self.poll)
@@ -0,0 +1,153 @@
+from pathlib import Path
+import json
+import os
+import queue
+import socket
+import stat
+import tempfile
+import threading
+from log import get_logger
+
+logger = get_logger(__name__)
+
+
+def socket_dir():
+    # directory of sockets only this user can enter. tmp is used without
+    # XDG_RUNTIME_DIR, and a directory made there by others is not trusted.
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    base = Path(runtime_dir) if runtime_dir else Path(tempfile.gettempdir())
+    path = base / f"salt_viewer-{os.getuid()}"
+    try:
+        path.mkdir(mode=0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+        raise OSError(f"{path} is not a directory of this user")
+    if st.st_mode & 0o077 != 0:
+        raise OSError(f"{path} is accessible by other users")
+    return path
+
+
+def socket_path(name="instance"):
+    # one socket per user
+    return socket_dir() / f"{name}.sock"
+
+
+def send(file_path, settings, path=None):
+    # hand file_path and settings to running SaltViewer.
+    # False if no SaltViewer is running.
+    if not hasattr(socket, "AF_UNIX"):
+        return False
+    request = {
+        "path": None if file_path is None else str(Path(file_path).resolve()),
+        "settings": settings,
+    }
+    try:
+        path = path or socket_path()
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(2.0)
+            s.connect(str(path))
+            s.sendall(json.dumps(request).encode() + b"\n")
+            reply = s.recv(16)
+    except OSError as e:
+        logger.debug("no running instance: %s", e)
+        return False
+    return reply.startswith(b"ok")
+
+
+def remove_stale(path):
+    # remove socket left by a killed SaltViewer. only a socket refusing
+    # connections is stale. a live one may be of a SaltViewer started at
+    # the same time, and removing it leaves two servers.
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(2.0)
+            s.connect(str(path))
+    except ConnectionRefusedError:
+        logger.debug("remove stale socket %s", path)
+        Path(path).unlink(missing_ok=True)
+        return
+    except OSError:
+        # no socket, or busy. bind fails if it is in use.
+        return
+    raise OSError(f"another SaltViewer is listening on {path}")
+
+
+# Listen for paths sent by later `salt-viewer` runs.
+# Requests are queued and taken by SaltViewer on Tk thread.
+class InstanceServer:
+    max_request = 64 * 1024
+
+    def __init__(self, path=None):
+        self.path = path or socket_path()
+        self.requests = queue.Queue()
+        remove_stale(self.path)
+        # listen on a name of this process, then link it to path. link
+        # fails if another SaltViewer has made path, and path never refers
+        # to a socket not listening yet.
+        tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}")
+        tmp.unlink(missing_ok=True)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.bind(str(tmp))
+            os.chmod(tmp, 0o600)
+            self.sock.listen(8)
+            os.link(tmp, self.path)
+        except OSError:
+            self.sock.close()
+            raise
+        finally:
+            tmp.unlink(missing_ok=True)
+        self.inode = self.path.stat().st_ino
+        t = threading.Thread(target=self.serve_thread, name="instance", daemon=True)
+        t.start()
+        logger.debug("listening %s", self.path)
+
+    def serve_thread(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                # closed
+                break
+            with conn:
+                try:
+                    self.handle(conn)
+                except (OSError, ValueError) as e:
+                    logger.warning(f"bad request: {e}")
+
+    def handle(self, conn):
+        conn.settimeout(2.0)
+        buf = b""
+        while not buf.endswith(b"\n"):
+            chunk = conn.recv(4096)
+            if len(chunk) == 0:
+                break
+            buf += chunk
+            if len(buf) > self.max_request:
+                raise ValueError("request is too large")
+        if len(buf) == 0:
+            # remove_stale of another SaltViewer checks this is alive
+            return
+        request = json.loads(buf)
+        if not isinstance(request, dict):
+            raise ValueError("request is not an object")
+        logger.debug("request %s", request)
+        self.requests.put(request)
+        conn.sendall(b"ok\n")
+
+    def take(self):
+        requests = []
+        while not self.requests.empty():
+            requests.append(self.requests.get_nowait())
+        return requests
+
+    def close(self):
+        self.sock.close()
+        try:
+            # another SaltViewer may listen on the path after this
+            if self.path.stat().st_ino == self.inode:
+                self.path.unlink()
+        except OSError:
+            pass
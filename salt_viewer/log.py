@@ -0,0 +1,65 @@
+import logging
+
+# Loggers of all modules are children of this logger, so that one handler
+# prints all of them and --debug can enable each module as a subsystem.
+# Debug messages use %-style arguments, which are formatted only when the
+# message is printed. Do not pass f-string to logger.debug in hot paths.
+root_name = "salt_viewer"
+
+subsystems = [
+    "archive",
+    "cache_daemon",
+    "decode_pool",
+    "file_ops",
+    "gallery",
+    "instance",
+    "log",
+    "metrics",
+    "page_cache",
+    "page_engine",
+    "prefetch",
+    "random_ahead",
+    "salt_viewer",
+    "seekable",
+    "session",
+    "thumbnail",
+    "tracing",
+]
+
+
+def subsystem(name):
+    # __name__ is "salt_viewer.archive" when installed as package and
+    # "__main__" when salt_viewer.py is run as script.
+    name = name.rsplit(".", 1)[-1]
+    return "salt_viewer" if name == "__main__" else name
+
+
+def get_logger(name):
+    return logging.getLogger(f"{root_name}.{subsystem(name)}")
+
+
+def enable_debug(spec="all"):
+    # spec is "all" or comma separated subsystems like "archive,page_engine"
+    if spec is None or spec == "all":
+        names = subsystems
+    else:
+        names = [name.strip() for name in spec.split(",") if name.strip() != ""]
+    for name in names:
+        if name not in subsystems:
+            logger.warning(
+                "unknown subsystem %s. choose from %s", name, ",".join(subsystems)
+            )
+            continue
+        get_logger(name).setLevel(logging.DEBUG)
+
+
+_root = logging.getLogger(root_name)
+_root.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+formatter = logging.Formatter(
+    "%(asctime)s:%(name)s:%(funcName)s:%(lineno)d:%(levelname)s:%(message)s"
+)
+ch.setFormatter(formatter)
+_root.addHandler(ch)
+
+logger = get_logger(__name__)
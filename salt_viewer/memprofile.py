@@ -0,0 +1,235 @@
+from pathlib import Path
+import gc
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+import weakref
+from log import get_logger
+
+logger = get_logger(__name__)
+
+# allocations in files of this directory are attributed to the module.
+source_dir = Path(__file__).resolve().parent
+
+
+def rss():
+    # current resident set size in bytes
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # peak on other platforms. bytes on macOS, KB on others.
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def subsystem(traceback):
+    # the newest frame in SaltViewer code is responsible for the allocation.
+    # e.g. PIL decoding called from archive.py is counted as archive.
+    for frame in reversed(traceback):
+        path = Path(frame.filename)
+        if path.parent == source_dir:
+            return path.stem
+    # allocations not called from SaltViewer, like Tk callbacks
+    if traceback[-1].filename.startswith("<"):
+        # <frozen importlib._bootstrap>
+        return traceback[-1].filename
+    path = Path(traceback[-1].filename)
+    for parent in path.parents:
+        if parent.name in ["site-packages", "dist-packages"]:
+            return path.relative_to(parent).parts[0]
+    return path.stem
+
+
+def keys_of(d, obj):
+    keys = []
+    for k, v in d.items():
+        if v is obj:
+            keys.append(str(k))
+    return keys
+
+
+def owner_of(d):
+    # object whose __dict__ is d
+    for o in gc.get_referrers(d):
+        if getattr(o, "__dict__", None) is d:
+            return o
+    return None
+
+
+def describe(obj, depth=2, seen=None):
+    # short description of objects referring obj.
+    # no comprehension here. it makes closure cell referring obj.
+    if seen is None:
+        seen = {id(obj)}
+    lines = []
+    for r in gc.get_referrers(obj):
+        if id(r) in seen:
+            continue
+        if type(r).__name__ in ["frame", "list_iterator"]:
+            continue
+        seen.add(id(r))
+        if isinstance(r, dict):
+            # __dict__ of an object. show the object instead.
+            owner = owner_of(r)
+            if owner is not None:
+                lines.append(f"{type(owner).__name__}.{','.join(keys_of(r, obj))}")
+                continue
+            name = f"dict[{','.join(keys_of(r, obj)[:3])}]"
+        elif isinstance(r, (list, tuple, set)):
+            name = f"{type(r).__name__}(len={len(r)})"
+        elif type(r).__name__ == "method":
+            name = f"bound method {r.__func__.__qualname__}"
+        elif type(r).__name__ == "cell":
+            name = "closure cell"
+        else:
+            name = type(r).__name__
+        if depth > 1:
+            parents = describe(r, depth - 1, seen)
+            if len(parents) != 0:
+                name += " <- " + " | ".join(parents[:3])
+        lines.append(name)
+    return lines
+
+
+# Take tracemalloc snapshots on archive switch and every N page turns, and
+# attribute growth to modules. Archives which are no longer used but still
+# alive are reported with objects referring them.
+class MemProfiler:
+    frames = 16
+    top = 10
+
+    def __init__(self):
+        self.enabled = False
+        self.file_path = None
+        self.every = 20
+        self.turns = 0
+        self.first = None
+        self.previous = None
+        self.records = []
+        self.archives = []
+        # function returning archives in use
+        self.in_use = None
+        self.started = time.time()
+        self.rss_start = None
+
+    def start(self, file_path, every=20):
+        self.file_path = file_path
+        self.every = max(1, every)
+        self.enabled = True
+        self.rss_start = rss()
+        tracemalloc.start(self.frames)
+        self.first = self.snapshot()
+        self.previous = self.first
+
+    def snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces(
+            [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__, all_frames=True),
+            ]
+        )
+
+    def watch(self, archive):
+        if not self.enabled:
+            return
+        self.archives.append((weakref.ref(archive), str(archive.file_path)))
+
+    def page_turn(self):
+        if not self.enabled:
+            return
+        self.turns += 1
+        if self.turns % self.every == 0:
+            self.take(f"{self.turns} pages")
+
+    def archive_switch(self, file_path):
+        if not self.enabled:
+            return
+        self.take(f"open {file_path}")
+
+    def growth(self, snapshot, base):
+        growth = {}
+        for diff in snapshot.compare_to(base, "traceback"):
+            name = subsystem(diff.traceback)
+            growth[name] = growth.get(name, 0) + diff.size_diff
+        return dict(sorted(growth.items(), key=lambda kv: -abs(kv[1])))
+
+    def retained(self):
+        # archives not used anymore but alive
+        gc.collect()
+        in_use = {id(a) for a in (self.in_use() if self.in_use else []) if a}
+        retained = []
+        alive = []
+        for ref, file_path in self.archives:
+            archive = ref()
+            if archive is None:
+                continue
+            alive.append((ref, file_path))
+            if id(archive) in in_use:
+                continue
+            retained.append({"archive": file_path, "referrers": describe(archive)})
+            del archive
+        self.archives = alive
+        return retained
+
+    def take(self, reason):
+        snapshot = self.snapshot()
+        growth = self.growth(snapshot, self.previous)
+        self.previous = snapshot
+        traced, peak = tracemalloc.get_traced_memory()
+        record = {
+            "time": time.time() - self.started,
+            "reason": reason,
+            "rss": rss(),
+            "traced": traced,
+            "traced_peak": peak,
+            "threads": [t.name for t in threading.enumerate()],
+            "growth": dict(list(growth.items())[: self.top]),
+            "retained": self.retained(),
+        }
+        self.records.append(record)
+        logger.info(
+            "%s: rss=%.1fMB traced=%.1fMB growth=%s retained=%d",
+            reason,
+            record["rss"] / 1024 / 1024,
+            traced / 1024 / 1024,
+            {k: f"{v / 1024:+.0f}KB" for k, v in list(growth.items())[:5]},
+            len(record["retained"]),
+        )
+        for r in record["retained"]:
+            logger.info("retained %s: %s", r["archive"], r["referrers"])
+
+    def report(self):
+        if not self.enabled:
+            return
+        self.take("exit")
+        last = self.snapshot()
+        top = last.statistics("lineno")[: self.top]
+        summary = {
+            "pages": self.turns,
+            "duration": time.time() - self.started,
+            "rss_start": self.rss_start,
+            "rss_end": self.records[-1]["rss"],
+            "rss_max": max(r["rss"] for r in self.records),
+            "traced_peak": tracemalloc.get_traced_memory()[1],
+            # growth from start to exit. compare this between runs.
+            "growth": self.growth(last, self.first),
+            "top": [f"{s.traceback[0]}: {s.size}" for s in top],
+            "retained": self.records[-1]["retained"],
+            "records": self.records,
+        }
+        tracemalloc.stop()
+        try:
+            with open(self.file_path, "w") as f:
+                json.dump(summary, f, indent=2)
+        except OSError as e:
+            logger.warning("failed to write memprofile %s: %s", self.file_path, e)
+            return
+        logger.info("memprofile is written to %s", self.file_path)
+
+
+profiler = MemProfiler()
@@ -0,0 +1,112 @@
+import json
+import threading
+import time
+from log import get_logger
+
+
+logger = get_logger(__name__)
+
+
+def nbytes(data):
+    # memory held by a cached page.
+    if data is None:
+        return 0
+    if isinstance(data, (bytes, bytearray)):
+        return len(data)
+    if hasattr(data, "getbuffer"):
+        with data.getbuffer() as b:
+            return b.nbytes
+    if hasattr(data, "getbands"):
+        return data.width * data.height * len(data.getbands())
+    return 0
+
+
+# Counters and gauges to size caches.
+# Counters are incremented where events happen. Gauges are set directly or
+# computed by collectors only when snapshot is taken, so that costly ones
+# like bytes held by caches are not computed on every page turn.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        # name: function returning dict of gauges
+        self.collectors = {}
+        self.started = time.time()
+        # written at exit if set
+        self.file_path = None
+
+    def start(self, file_path):
+        self.file_path = file_path
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def collector(self, name, fn):
+        with self.lock:
+            self.collectors[name] = fn
+
+    def ratio(self, counters, hit, miss):
+        total = counters.get(hit, 0) + counters.get(miss, 0)
+        if total == 0:
+            return None
+        return counters.get(hit, 0) / total
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            collectors = list(self.collectors.items())
+        for name, fn in collectors:
+            try:
+                for k, v in fn().items():
+                    gauges[f"{name}.{k}"] = v
+            except Exception as e:
+                logger.debug("collector %s failed: %s", name, e)
+        rates = {
+            "cache.hit_rate": self.ratio(counters, "cache.hit", "cache.miss"),
+            "disk_cache.hit_rate": self.ratio(
+                counters, "disk_cache.hit", "disk_cache.miss"
+            ),
+            "preload.useful_rate": self.ratio(
+                counters, "preload.used", "preload.wasted"
+            ),
+            "prefetch.useful_rate": self.ratio(
+                counters, "prefetch.used", "prefetch.wasted"
+            ),
+        }
+        return {
+            "uptime": time.time() - self.started,
+            "counters": dict(sorted(counters.items())),
+            "gauges": dict(sorted(gauges.items())),
+            "rates": {k: v for k, v in rates.items() if v is not None},
+        }
+
+    def text(self):
+        s = self.snapshot()
+        lines = [f"{k:<32}{v:>10.1%}" for k, v in s["rates"].items()]
+        lines += [f"{k:<32}{v:>10}" for k, v in s["counters"].items()]
+        for k, v in s["gauges"].items():
+            if k.endswith("bytes"):
+                v = f"{v / 1024 / 1024:.1f}MB"
+            lines.append(f"{k:<32}{v:>10}")
+        return "\n".join(lines)
+
+    def save(self):
+        if self.file_path is None:
+            return
+        try:
+            with open(self.file_path, "w") as f:
+                json.dump(self.snapshot(), f, indent=2, default=str)
+        except OSError as e:
+            logger.warning(f"failed to write stats {self.file_path}: {e}")
+            return
+        logger.info(f"stats are written to {self.file_path}")
+
+
+metrics = Metrics()
@@ -0,0 +1,201 @@
+from pathlib import Path
+import hashlib
+import os
+import queue
+import struct
+import threading
+import time
+from PIL import Image
+from metrics import metrics
+from log import get_logger
+
+
+logger = get_logger(__name__)
+
+
+def file_identity(file_path):
+    # same path, size and mtime means same file.
+    file_path = Path(file_path)
+    stat = file_path.stat()
+    return f"{file_path.resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def data_identity(name, data):
+    # nested archive has no stat. Use head and tail of its bytes instead of
+    # hashing all because nested archive can be very large.
+    buf = data.getbuffer()
+    try:
+        h = hashlib.sha1()
+        h.update(buf[:65536])
+        h.update(buf[-65536:])
+        return f"{Path(name).name}:{len(buf)}:{h.hexdigest()}"
+    finally:
+        buf.release()
+
+
+# Renders are written as raw pixels with a small header, so reading back is
+# only a file read and no decode.
+render_magic = b"SVPC"
+
+
+def encode_render(image):
+    if image.mode not in ["RGB", "RGBA", "L"]:
+        has_alpha = "A" in image.mode or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+    mode = image.mode.encode()
+    header = render_magic + struct.pack("<B", len(mode)) + mode
+    header += struct.pack("<II", image.width, image.height)
+    return header + image.tobytes()
+
+
+def decode_render(buf):
+    if buf[:4] != render_magic:
+        raise ValueError("not a render file")
+    n = buf[4]
+    mode = buf[5 : 5 + n].decode()
+    width, height = struct.unpack_from("<II", buf, 5 + n)
+    offset = 5 + n + 8
+    size = (width, height)
+    raw = memoryview(buf)[offset:]
+    if len(raw) != width * height * len(mode):
+        raise ValueError("truncated render file")
+    return Image.frombuffer(mode, size, raw, "raw", mode, 0, 1)
+
+
+# Store display-ready renders on disk.
+# Renders are written by encode_render. Files are written to a temporary
+# name and renamed, so several processes can share one directory.
+# The least recently used files are evicted when total size exceeds max_size.
+class DiskCache:
+    suffix = ".svpc"
+    tmp_suffix = ".tmp"
+    # temporary files older than this are left by dead processes
+    tmp_expire = 3600
+
+    def __init__(self, cache_dir, max_size=1024 * 1024 * 1024):
+        self.cache_dir = Path(cache_dir).expanduser()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+
+        self.total_size = None
+        self.queue = queue.Queue(maxsize=8)
+
+        t = threading.Thread(target=self.write_thread, daemon=True)
+        t.start()
+
+    def path(self, render_id, render_key):
+        name = hashlib.sha1(f"{render_id}\0{render_key}".encode()).hexdigest()
+        return self.cache_dir / name[:2] / (name + self.suffix)
+
+    def get(self, render_id, render_key):
+        path = self.path(render_id, render_key)
+        try:
+            with open(path, "rb") as f:
+                buf = f.read()
+        except OSError:
+            logger.debug("disk cache miss")
+            metrics.count("disk_cache.miss")
+            return None
+
+        try:
+            # update mtime for LRU. atime is not reliable on noatime mount.
+            os.utime(path)
+        except OSError:
+            pass
+
+        try:
+            image = decode_render(buf)
+        except (ValueError, struct.error):
+            logger.warning(f"broken cache file. remove {path}")
+            self._unlink(path)
+            return None
+
+        logger.debug("disk cache hit")
+        metrics.count("disk_cache.hit")
+        image.from_disk_cache = True
+        return image
+
+    def put(self, render_id, render_key, image):
+        if getattr(image, "is_animated", False):
+            return
+        try:
+            self.queue.put_nowait((self.path(render_id, render_key), image))
+        except queue.Full:
+            logger.debug("write queue is full. skipping")
+            metrics.count("disk_cache.skip")
+
+    def write_thread(self):
+        while True:
+            path, image = self.queue.get()
+            try:
+                self.write(path, image)
+            except OSError as e:
+                logger.warning(f"failed to write cache: {e}")
+
+    def write(self, path, image):
+        buf = encode_render(image)
+        path.parent.mkdir(exist_ok=True)
+        tmp = path.with_name(
+            f"{path.name}.{os.getpid()}.{threading.get_ident()}{self.tmp_suffix}"
+        )
+        with open(tmp, "wb") as f:
+            f.write(buf)
+        # rename is atomic. readers never see a half written file.
+        os.replace(tmp, path)
+        metrics.count("disk_cache.write")
+
+        if self.total_size is None:
+            self.total_size = self.scan_size()
+        self.total_size += len(buf)
+        if self.total_size > self.max_size:
+            self.evict()
+
+    def stats(self):
+        return {"write_queue": self.queue.qsize(), "bytes": self.total_size or 0}
+
+    def scan(self):
+        files = []
+        now = time.time()
+        for shard in self.cache_dir.iterdir():
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    # removed by other process
+                    continue
+                if entry.name.endswith(self.tmp_suffix):
+                    if now - stat.st_mtime > self.tmp_expire:
+                        self._unlink(Path(entry.path))
+                    continue
+                if entry.name.endswith(self.suffix):
+                    files.append((stat.st_mtime, stat.st_size, Path(entry.path)))
+        return files
+
+    def scan_size(self):
+        return sum(size for _, size, _ in self.scan())
+
+    def evict(self):
+        files = sorted(self.scan())
+        total = sum(size for _, size, _ in files)
+        # evict a little more than needed so that eviction does not run on
+        # every write.
+        limit = self.max_size * 0.9
+        evicted = 0
+        for _, size, path in files:
+            if total <= limit:
+                break
+            self._unlink(path)
+            total -= size
+            evicted += 1
+        logger.debug("evicted %s files", evicted)
+        metrics.count("disk_cache.evict", evicted)
+        self.total_size = total
+
+    def _unlink(self, path):
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            # other process already removed
+            pass
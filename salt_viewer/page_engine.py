@@ -0,0 +1,253 @@
+from pathlib import Path
+import io
+from PIL import Image
+from archive import ArchiveBase, register_plugin
+from log import get_logger
+
+
+logger = get_logger(__name__)
+
+
+# Decode and resize pages without display.
+# ImageFrame uses this with its window size, and benchmark or batch tools can
+# use this with any size.
+class PageEngine:
+    algorithm = {
+        "Nearest": Image.Resampling.NEAREST,
+        "Box": Image.Resampling.BOX,
+        "Bilinear": Image.Resampling.BILINEAR,
+        "Hamming": Image.Resampling.HAMMING,
+        "Bicubic": Image.Resampling.BICUBIC,
+        "Lanczos": Image.Resampling.LANCZOS,
+    }
+
+    # Large reduction is done in two steps. Image.reduce averages blocks of
+    # pixels down to this many times of target size, then the algorithm
+    # resamples the rest. Cost of Lanczos from a 9000 pixel tall scan is
+    # proportional to source pixels, and reduce is much cheaper.
+    # Algorithms not here resample from full size.
+    default_reducing_gap = {
+        Image.Resampling.BILINEAR: 2.0,
+        Image.Resampling.HAMMING: 2.0,
+        Image.Resampling.BICUBIC: 2.5,
+        Image.Resampling.LANCZOS: 2.5,
+    }
+
+    # fit_width, fit_height
+    fit_mode = {
+        "Both": (True, True),
+        "Width": (True, False),
+        "Height": (False, True),
+        "None": (False, False),
+    }
+
+    def __init__(self):
+        self.fit_width = True
+        self.fit_height = True
+
+        self.up_scale = Image.Resampling.NEAREST
+        self.down_scale = Image.Resampling.NEAREST
+        # algorithm: gap
+        self.reducing_gap = dict(self.default_reducing_gap)
+
+    def select_up_scale_algorithm(self, up):
+        algo = self.algorithm.get(up)
+        if algo is not None:
+            self.up_scale = algo
+        else:
+            logger.warning(f"UpScale = {up} is not supported.")
+
+    def select_down_scale_algorithm(self, down):
+        algo = self.algorithm.get(down)
+        if algo is not None:
+            self.down_scale = algo
+        else:
+            logger.warning(f"DownScale = {down} is not supported.")
+
+    def select_reducing_gap(self, spec):
+        # spec is comma separated "algorithm:gap" like "Lanczos:3,Bicubic:2".
+        # gap 0 resamples from full size.
+        for item in spec.split(","):
+            if item.strip() == "":
+                continue
+            name, _, gap = item.partition(":")
+            algo = self.algorithm.get(name.strip())
+            try:
+                gap = float(gap)
+            except ValueError:
+                algo = None
+            if algo is None:
+                logger.warning(f"ReducingGap = {item} is not supported.")
+                continue
+            if gap > 0:
+                self.reducing_gap[algo] = gap
+            else:
+                self.reducing_gap.pop(algo, None)
+
+    def select_fit_mode(self, mode):
+        fit = self.fit_mode.get(mode)
+        if fit is not None:
+            self.fit_width, self.fit_height = fit
+        else:
+            logger.warning(f"FitMode = {mode} is not supported.")
+
+    def fit_mode_name(self):
+        for name, fit in self.fit_mode.items():
+            if fit == (self.fit_width, self.fit_height):
+                return name
+        return None
+
+    def render_key(self, size, div=1):
+        # renders with same key are same size and same quality.
+        return (
+            f"{size[0]}x{size[1]}/{div}:"
+            + f"{self.fit_width}:{self.fit_height}:{self.up_scale}:{self.down_scale}"
+            + f":{self.reducing_gap.get(self.down_scale)}"
+        )
+
+    def render(
+        self, archive, i, size, fit_mode=None, up_scale=None, down_scale=None, div=1
+    ):
+        # return (file_path, resized image) of page i.
+        # image is None if page i is not an image, like nested archive.
+        engine = self
+        if fit_mode is not None or up_scale is not None or down_scale is not None:
+            engine = PageEngine()
+            engine.fit_width, engine.fit_height = self.fit_width, self.fit_height
+            engine.up_scale, engine.down_scale = self.up_scale, self.down_scale
+            engine.reducing_gap = dict(self.reducing_gap)
+            if fit_mode is not None:
+                engine.select_fit_mode(fit_mode)
+            if up_scale is not None:
+                engine.select_up_scale_algorithm(up_scale)
+            if down_scale is not None:
+                engine.select_down_scale_algorithm(down_scale)
+
+        file_path, data = archive[i]
+        if file_path is None:
+            return None, None
+        image = engine.decode(file_path, data)
+        return file_path, engine.resize_image(image, size, div)
+
+    def decode(self, file_path, data=None):
+        suffix = Path(file_path).suffix.lower()
+        if suffix not in ArchiveBase.support_image_type:
+            logger.debug("Not image.:%s", suffix)
+            return None
+        if suffix == ".svg" and not isinstance(data, Image.Image):
+            return self.decode_svg(file_path, data)
+        register_plugin(file_path)
+
+        if data is None:
+            return Image.open(file_path)
+
+        if hasattr(data, "read"):
+            return Image.open(data)
+
+        # if PIL.Image
+        return data
+
+    def decode_svg(self, file_path, data=None):
+        if "cairosvg" not in globals():
+            global cairosvg
+            import cairosvg
+
+        if data is None:
+            svg = cairosvg.svg2png(url=str(file_path))
+        else:
+            svg = cairosvg.svg2png(file_obj=data)
+        svg = io.BytesIO(svg)
+        return Image.open(svg)
+
+    def target_size(self, image_size, size, div=1):
+        # size of image after resize_image without decoding it.
+        width = size[0] / div
+        height = size[1]
+        if self.fit_width and self.fit_height:
+            times = min(width / image_size[0], height / image_size[1])
+        elif self.fit_width:
+            times = width / image_size[0]
+        elif self.fit_height:
+            times = height / image_size[1]
+        else:
+            return image_size
+        return (max(1, int(image_size[0] * times)), max(1, int(image_size[1] * times)))
+
+    def resize_image(self, image, size, div=1, fast=False):
+        if image is None:
+            return None
+        if not self.fit_width and not self.fit_height:
+            return image
+        elif self.fit_width and self.fit_height:
+            return self.fit_in_frame(image, size, div, fast)
+        elif self.fit_width and not self.fit_height:
+            return self.fit_in_frame_width(image, size, div, fast)
+        elif not self.fit_width and self.fit_height:
+            return self.fit_in_frame_height(image, size, div, fast)
+        else:
+            logger.debug("Not supported.")
+
+    def fit_in_frame(self, image, size, div=1, fast=False):
+        width = size[0] / div
+        height = size[1]
+        logger.debug("%s, %s", width, height)
+        times = min(width / image.width, height / image.height)
+        if times == 1:
+            return image
+        size = (int(image.width * times), int(image.height * times))
+
+        algo = self.up_scale if times > 1 else self.down_scale
+        return self.resize(image, size, algo, fast)
+
+    def fit_in_frame_width(self, image, size, div=1, fast=False):
+        width = size[0] / div
+        height = size[1]
+        logger.debug("%s, %s", width, height)
+        times = width / image.width
+        if times == 1:
+            return image
+        size = (int(image.width * times), int(image.height * times))
+        algo = self.up_scale if times > 1 else self.down_scale
+        return self.resize(image, size, algo, fast)
+
+    def fit_in_frame_height(self, image, size, div=1, fast=False):
+        width = size[0] / div
+        height = size[1]
+        logger.debug("%s, %s", width, height)
+        times = height / image.height
+        if times == 1:
+            return image
+        size = (int(image.width * times), int(image.height * times))
+        algo = self.up_scale if times > 1 else self.down_scale
+        return self.resize(image, size, algo, fast)
+
+    def resize(self, image, size, algorithm, fast=False):
+        if size[0] == 0 or size[1] == 0:
+            size = (1, 1)
+        if fast:
+            # preview. JPEG is decoded in 1/2, 1/4 or 1/8 scale.
+            image.draft(image.mode, size)
+            return image.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+        # PIL reduces only when reduction is larger than gap
+        gap = self.reducing_gap.get(algorithm)
+        return image.resize(size, algorithm, reducing_gap=gap)
+
+    def merge_image(self, image, image2, size, right2left):
+        if image is None or image2 is None:
+            return image
+
+        width, height = size
+
+        new_image = Image.new("RGB", (width, height))
+        if right2left:
+            image, image2 = image2, image
+
+        # left
+        left = int(width / 2 - image.width)
+        upper = int((height - image.height) / 2)
+        new_image.paste(image, (left, upper))
+        # right
+        left = int(width / 2)
+        upper = int((height - image2.height) / 2)
+        new_image.paste(image2, (left, upper))
+        return new_image
@@ -0,0 +1,132 @@
+import math
+import threading
+import time
+from log import get_logger
+
+logger = get_logger(__name__)
+
+
+# Size of read-ahead window learned from reading.
+# Pages ahead cover `seconds` of reading at the measured dwell time, plus
+# pages turned while one page is fetched and decoded. Pages behind follow
+# how often the reader turns back. Both are limited by memory budget.
+# Until the first turns are measured, fixed prev_cache/next_cache are used.
+class AdaptivePrefetch:
+    enabled = True
+    # seconds of reading kept ready ahead
+    seconds = 20.0
+    # bytes of pages kept by one archive
+    memory_budget = 256 * 1024 * 1024
+    max_pages = 200
+    # weight of new sample in moving averages
+    alpha = 0.3
+    # turns longer than this are breaks, not reading
+    max_dwell = 60.0
+    # dwell time of the last archive. reader does not change with archive.
+    last_dwell = None
+
+    def __init__(self, prev_cache, next_cache, memory_budget=None):
+        self.prev_cache = prev_cache
+        self.next_cache = next_cache
+        if memory_budget is not None:
+            self.memory_budget = memory_budget
+        self.lock = threading.Lock()
+        self.dwell = AdaptivePrefetch.last_dwell
+        self.last_turn = None
+        # seconds to fetch and decode one page
+        self.fetch_cost = None
+        self.decode_cost = None
+        # bytes of one cached page
+        self.page_bytes = None
+        # ratio of turns going back
+        self.back = 0.0
+        # pages per turn. 2 in double page mode.
+        self.step = 1
+
+    def average(self, old, new):
+        if old is None:
+            return new
+        return old + self.alpha * (new - old)
+
+    def turn(self, count, step=1):
+        # count pages moved by one key. negative is back.
+        # moves by repeat count like 100h are jumps. they are not learned as
+        # step and direction, but time since last turn is dwell.
+        now = time.perf_counter()
+        with self.lock:
+            if self.last_turn is not None:
+                dwell = min(now - self.last_turn, self.max_dwell)
+                self.dwell = self.average(self.dwell, dwell)
+                AdaptivePrefetch.last_dwell = self.dwell
+            self.last_turn = now
+            self.step = max(1, step)
+            if count != 0 and abs(count) <= self.step:
+                self.back = self.average(self.back, 1.0 if count < 0 else 0.0)
+
+    def fetched(self, seconds, pages=1, nbytes=0):
+        if pages <= 0:
+            return
+        with self.lock:
+            self.fetch_cost = self.average(self.fetch_cost, seconds / pages)
+            if nbytes > 0:
+                self.page_bytes = self.average(self.page_bytes, nbytes / pages)
+
+    def decoded(self, seconds, pages=1):
+        if pages <= 0:
+            return
+        with self.lock:
+            self.decode_cost = self.average(self.decode_cost, seconds / pages)
+
+    def pages(self):
+        # (pages behind, pages ahead) of current page
+        with self.lock:
+            if not self.enabled or self.dwell is None:
+                return self.prev_cache, self.next_cache
+            dwell = max(self.dwell, 0.01)
+            cost = (self.fetch_cost or 0) + (self.decode_cost or 0)
+            # turns to read in seconds, and turns while one turn is prepared
+            turns = math.ceil(self.seconds / dwell)
+            turns += math.ceil(cost * self.step / dwell)
+            ahead = min(turns * self.step, self.max_pages)
+            # keep one spread behind to turn back
+            behind = max(self.step, math.ceil(ahead * self.back))
+
+            if self.page_bytes:
+                fit = int(self.memory_budget / self.page_bytes)
+                if ahead + behind > fit:
+                    behind = min(behind, max(self.step, fit // 4))
+                    ahead = max(self.step, fit - behind)
+            return behind, ahead
+
+    def window(self, i, direction, n):
+        # range of pages to keep in cache around i
+        behind, ahead = self.pages()
+        if direction >= 0:
+            start, end = i - behind, i + ahead + 1
+        else:
+            start, end = i - ahead, i + behind + 1
+        return max(0, start), min(n, end)
+
+    def batch(self):
+        # pages read at once by preload
+        return max(1, self.pages()[1] // 2)
+
+    def stats(self):
+        behind, ahead = self.pages()
+        with self.lock:
+            stats = {
+                "ahead": ahead,
+                "behind": behind,
+                "step": self.step,
+                "back_rate": round(self.back, 2),
+            }
+            for name, value in [
+                ("dwell_ms", self.dwell),
+                ("fetch_ms", self.fetch_cost),
+                ("decode_ms", self.decode_cost),
+            ]:
+                if value is not None:
+                    stats[name] = round(value * 1000, 1)
+            if self.page_bytes is not None:
+                stats["page_bytes"] = int(self.page_bytes)
+        return stats
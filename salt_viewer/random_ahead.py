@@ -0,0 +1,108 @@
+import threading
+from archive import open_archive
+from page_engine import PageEngine
+from metrics import metrics
+from tracing import tracer
+from log import get_logger
+
+logger = get_logger(__name__)
+
+
+# Archives opened ahead for RandomSelect.
+# Next picks are known from random_list of root directory, so they are opened,
+# listed and their first pages are read and decoded on a thread before they
+# are picked. Preload of opened archives is stopped until they are taken.
+class RandomAhead:
+    # number of next picks opened ahead
+    count = 2
+
+    def __init__(self):
+        self.engine = PageEngine()
+        self.lock = threading.Lock()
+        # file_path: (archive, decoded first page or None)
+        self.opened = {}
+        # file_paths of next picks in order
+        self.wanted = []
+        self.thread = None
+        self.stop = False
+
+    def update(self, file_paths):
+        # open file_paths ahead. archives not in them are closed.
+        with self.lock:
+            self.wanted = list(file_paths)[: self.count]
+            unwanted = [p for p in self.opened if p not in self.wanted]
+            closed = [self.opened.pop(p) for p in unwanted]
+            running = self.thread is not None and self.thread.is_alive()
+            if not running and not self.stop:
+                self.thread = threading.Thread(
+                    target=self.open_thread, name="random ahead", daemon=True
+                )
+                self.thread.start()
+        for archive, _ in closed:
+            archive.close()
+        metrics.count("random_ahead.wasted", len(closed))
+
+    def next_wanted(self):
+        with self.lock:
+            for file_path in self.wanted:
+                if file_path not in self.opened:
+                    return file_path
+        return None
+
+    def open_thread(self):
+        while not self.stop:
+            file_path = self.next_wanted()
+            if file_path is None:
+                break
+            try:
+                with tracer.span("random ahead", path=str(file_path)):
+                    entry = self.open(file_path)
+            except Exception as e:
+                logger.debug("open ahead failed: %s: %s", file_path, e)
+                entry = None
+            with self.lock:
+                if (
+                    entry is not None
+                    and not self.stop
+                    and file_path in self.wanted
+                    and file_path not in self.opened
+                ):
+                    self.opened[file_path] = entry
+                    entry = None
+                elif entry is None and file_path in self.wanted:
+                    # not tried again. SaltViewer opens it and shows the error.
+                    self.wanted.remove(file_path)
+            if entry is not None:
+                entry[0].close()
+
+    def open(self, file_path):
+        # pages other than the first are preloaded after this is picked
+        archive = open_archive(file_path, preload=False)
+        page_path, data = archive.current()
+        image = None
+        if page_path is not None:
+            image = self.engine.decode(page_path, data)
+            if image is not None:
+                image.load()
+        logger.debug("opened ahead: %s", file_path)
+        return archive, image
+
+    def take(self, file_path):
+        # (archive, first page) opened ahead, or None
+        with self.lock:
+            entry = self.opened.pop(file_path, None)
+        if entry is None:
+            metrics.count("random_ahead.miss")
+            return None
+        metrics.count("random_ahead.hit")
+        archive, image = entry
+        if not archive.is_directory:
+            archive.start_preload()
+        return archive, image
+
+    def close(self):
+        with self.lock:
+            self.stop = True
+            entries, self.opened = list(self.opened.values()), {}
+        for archive, _ in entries:
+            archive.close()
@@ -1,36 +1,30 @@
 import argparse
-import csv
 import io
-import logging
-import shutil
+import queue
 import threading
 import time
 import tkinter as tk
-import tkinter.filedialog as filedialog
-import tkinter.messagebox as messagebox
 import tkinter.ttk as ttk
 from pathlib import Path
-from archive import (
-    ArchiveBase,
-    DirectoryArchive,
-    RarArchive,
-    SevenZipArchive,
-    ZipArchive,
-    PdfArchive,
-    TarArchive,
-)
-import pillow_avif
+from archive import ArchiveBase, DirectoryArchive, open_archive
+from memprofile import profiler
+from metrics import metrics
+from page_engine import PageEngine
+from prefetch import AdaptivePrefetch
+from tracing import tracer
 from PIL import Image, ImageTk
+import log
+from log import get_logger
 
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
+logger = get_logger(__name__)
 
-ch = logging.StreamHandler()
-formatter = logging.Formatter(
-    "%(asctime)s:%(name)s:%(funcName)s:%(lineno)d:%(levelname)s:%(message)s"
-)
-ch.setFormatter(formatter)
-logger.addHandler(ch)
+
+def load_messagebox():
+    # only needed when something goes wrong. not imported at startup.
+    if "messagebox" not in globals():
+        global messagebox
+        import tkinter.messagebox as messagebox
+    return messagebox
 
 
 class ArchiveTree:
@@ -74,7 +68,7 @@ class ArchiveTree:
             file_path = archive.file_path
             next_file_path, data = archive.next()
             logger.debug(
-                f"i,file_path,next_file_path = {i},{file_path},{next_file_path}"
+                "i,file_path,next_file_path = %s,%s,%s", i, file_path, next_file_path
             )
             if file_path == next_file_path:
                 logger.debug("go to parent")
@@ -82,7 +76,7 @@ class ArchiveTree:
                 continue
 
             # archive.start_preload()
-            logger.debug(f"next_file_path = {next_file_path}")
+            logger.debug("next_file_path = %s", next_file_path)
             return next_file_path, data, archive
 
         logger.debug("not found")
@@ -98,7 +92,7 @@ class ArchiveTree:
             file_path = archive.file_path
             next_file_path, data = archive.prev()
             logger.debug(
-                f"i,file_path,next_file_path = {i},{file_path},{next_file_path}"
+                "i,file_path,next_file_path = %s,%s,%s", i, file_path, next_file_path
             )
             if file_path == next_file_path:
                 logger.debug("go to parent")
@@ -111,15 +105,6 @@ class ArchiveTree:
 
 
 class ImageFrame(tk.Canvas):
-    algorithm = {
-        "Nearest": Image.Resampling.NEAREST,
-        "Box": Image.Resampling.BOX,
-        "Bilinear": Image.Resampling.BILINEAR,
-        "Hamming": Image.Resampling.HAMMING,
-        "Bicubic": Image.Resampling.BICUBIC,
-        "Lanczos": Image.Resampling.LANCZOS,
-    }
-
     def __init__(self, master):
         super().__init__(master, highlightthickness=0, bg="black")
         self.master = master
@@ -128,96 +113,99 @@ class ImageFrame(tk.Canvas):
         self.image = None
         self.image2 = None
         self.tk_image = None
+        # merged image on canvas. None while animation is shown.
+        self.shown_image = None
 
-        self.master.bind(
-            "<Configure>", lambda *kw: self.display(self.image, self.image2)
-        )
+        self.master.bind("<Configure>", lambda *kw: self.redisplay())
 
         self.duration = 0
 
         # self.stop = True
         self.after_id = None
+        # seconds to decode and resize the last page
+        self.decode_time = 0.0
 
-        self.fit_width = True
-        self.fit_height = True
         self.title = ""
 
-        self.up_scale = Image.Resampling.NEAREST
-        self.down_scale = Image.Resampling.NEAREST
+        self.engine = PageEngine()
 
-    def select_up_scale_algorithm(self, up):
-        algo = self.algorithm.get(up)
-        if algo is not None:
-            self.up_scale = algo
-        else:
-            logger.warning("UpScale = {up} is not supported.")
+        self.disk_cache = None
 
-    def select_down_scale_algorithm(self, down):
-        algo = self.algorithm.get(down)
-        if algo is not None:
-            self.down_scale = algo
-        else:
-            logger.warning("DownScale = {down} is not supported.")
-
-    def resize_image(self, image, div=1):
-        if image is None:
+    def render_key(self, div=1):
+        # window is not mapped yet.
+        if self.width() <= 1 or self.height() <= 1:
             return None
-        if not self.fit_width and not self.fit_height:
-            return image
-        elif self.fit_width and self.fit_height:
-            return self.fit_in_frame(image, div)
-        elif self.fit_width and not self.fit_height:
-            return self.fit_in_frame_width(image, div)
-        elif not self.fit_width and self.fit_height:
-            return self.fit_in_frame_height(image, div)
-        else:
-            logger.debug("Not supported.")
+        return self.engine.render_key(self.frame_size(), div)
 
-    def merge_image(self, image, image2, right2left):
-        if image is None or image2 is None:
-            return image
+    def redisplay(self):
+        # renders from caches are made for the old window size. ask SaltViewer
+        # to read the page again instead of resizing them.
+        if self.stale(self.image) or self.stale(self.image2):
+            self.event_generate("<<StaleRender>>")
+            return
+        self.display(self.image, self.image2)
 
-        width = self.width()
-        height = self.height()
+    def stale(self, image):
+        key = getattr(image, "render_key", None)
+        return key is not None and key not in [self.render_key(1), self.render_key(2)]
+
+    def save_render(self, image, resized, div):
+        if self.disk_cache is None or image is None or resized is None:
+            return
+        render_id = getattr(image, "render_id", None)
+        if render_id is None or getattr(image, "from_disk_cache", False):
+            return
+        render_key = self.render_key(div)
+        if render_key is None:
+            return
+        self.disk_cache.put(render_id, render_key, resized)
 
-        new_image = Image.new("RGB", (width, height))
-        if right2left:
-            image, image2 = image2, image
+    def resize_image(self, image, div=1, fast=False):
+        return self.engine.resize_image(image, self.frame_size(), div, fast)
 
-        # left
-        left = int(width / 2 - image.width)
-        upper = int((height - image.height) / 2)
-        new_image.paste(image, (left, upper))
-        # right
-        left = int(width / 2)
-        upper = int((height - image2.height) / 2)
-        new_image.paste(image2, (left, upper))
-        return new_image
+    def merge_image(self, image, image2, right2left):
+        return self.engine.merge_image(image, image2, self.frame_size(), right2left)
 
-    def display(self, image, image2=None, right2left=True):
+    def display(self, image, image2=None, right2left=True, fast=False):
         self.stop = True
         if self.after_id is not None:
             self.after_cancel(self.after_id)
         self.after_id
         self.image = image
         self.image2 = image2
+        self.shown_image = None
         if getattr(image, "is_animated", False):
             self.stop = False
             self.start = time.perf_counter()
             if image.info.get("duration") is not None:
                 duration = image.info["duration"]
-                logger.debug(f"duration = {duration}")
+                logger.debug("duration = %s", duration)
                 return self.display_animation(image, 0)
 
         if image is not None:
             div = 1 if image2 is None else 2
-            image = self.resize_image(image, div)
-            image2 = self.resize_image(image2, div)
-
-            new_image = self.merge_image(image, image2, right2left)
+            started = time.perf_counter()
+            if not fast:
+                # Image.open only reads header. separate decoding from resize.
+                with tracer.span("decode"):
+                    image.load()
+                    if image2 is not None:
+                        image2.load()
+            with tracer.span("resize"):
+                resized = self.resize_image(image, div, fast)
+                resized2 = self.resize_image(image2, div, fast)
+            self.decode_time = time.perf_counter() - started
+            if not fast:
+                self.save_render(image, resized, div)
+                self.save_render(image2, resized2, div)
+            image, image2 = resized, resized2
+
+            with tracer.span("merge"):
+                new_image = self.merge_image(image, image2, right2left)
             del self.tk_image
-            self.tk_image = ImageTk.PhotoImage(image=new_image)
-            del new_image
+            with tracer.span("photoimage"):
+                self.tk_image = ImageTk.PhotoImage(image=new_image)
+            self.shown_image = new_image
             if self.item is not None:
                 self.delete(self.item)
 
@@ -240,7 +228,7 @@ class ImageFrame(tk.Canvas):
             self.stop = False
             return
 
-        logger.debug(f"counter={counter}")
+        logger.debug("counter=%s", counter)
         counter %= image.n_frames
         image.seek(counter)
 
@@ -274,7 +262,7 @@ class ImageFrame(tk.Canvas):
         logger.debug("time count")
         end = time.perf_counter()
         self.duration = int(duration - (end - start) * 1000)
-        logger.debug(f"self.duration = {self.duration} or 0")
+        logger.debug("self.duration = %s or 0", self.duration)
         # if self.duration == 0, image will not be updated.
         self.duration = max(1, self.duration)
 
@@ -295,56 +283,23 @@ class ImageFrame(tk.Canvas):
     def height(self):
         return self.master.winfo_height()
 
-    def fit_in_frame(self, image, div=1):
-        width = self.width() / div
-        height = self.height()
-        logger.debug(f"{width}, {height}")
-        times = min(width / image.width, height / image.height)
-        if times == 1:
-            return image
-        size = (int(image.width * times), int(image.height * times))
-
-        algo = self.up_scale if times > 1 else self.down_scale
-        return self.resize(image, size, algo)
-
-    def resize(self, image, size, algorithm):
-        if size[0] == 0 or size[1] == 0:
-            size = (1, 1)
-        return image.resize(size, algorithm)
-
-    def fit_in_frame_width(self, image, div):
-        width = self.width() / div
-        height = self.height()
-        logger.debug(f"{width}, {height}")
-        times = width / image.width
-        if times == 1:
-            return image
-        size = (int(image.width * times), int(image.height * times))
-        algo = self.up_scale if times > 1 else self.down_scale
-        return self.resize(image, size, algo)
-
-    def fit_in_frame_height(self, image, div):
-        width = self.width() / div
-        height = self.height()
-        logger.debug(f"{width}, {height}")
-        times = height / image.height
-        if times == 1:
-            return image
-        size = (int(image.width * times), int(image.height * times))
-        algo = self.up_scale if times > 1 else self.down_scale
-        return self.resize(image, size, algo)
+    def frame_size(self):
+        return self.width(), self.height()
 
 
 class MoveFile:
     def __init__(self):
         self.ret = False
-        pass
+        # destination chosen. SaltViewer moves the file in background.
+        self.to = None
 
     def move_file(self, move_to_list, file_path):
         self.file_path = file_path
         self.move_to_list = move_to_list
         if len(self.move_to_list) == 0:
-            messagebox.showwarning("No place is registered", "No place is registered")
+            load_messagebox().showwarning(
+                "No place is registered", "No place is registered"
+            )
             return
 
         self.child = tk.Toplevel()
@@ -380,7 +335,7 @@ class MoveFile:
 
         to = self.move_to_list.get(key)
         if to is None:
-            messagebox.showwarning(
+            load_messagebox().showwarning(
                 "Such place is not in list.", f"Such place is not in list. {key}"
             )
             self.ret = False
@@ -389,7 +344,7 @@ class MoveFile:
         to = Path(to)
 
         if not to.exists():
-            messagebox.showwarning(
+            load_messagebox().showwarning(
                 "Such directory does not exist.", f"Such directory does not exist. {to}"
             )
             self.ret = False
@@ -399,16 +354,16 @@ class MoveFile:
             return
 
         to = to / file_path.name
-        if to.exists() and not messagebox.askokcancel(
+        if to.exists() and not load_messagebox().askokcancel(
             "File exists.", "File exists. Overwrite?"
         ):
             logger.debug("Do not overwrite.")
             self.ret = False
             return
 
-        logger.debug(f"Move {file_path} -> {to}")
+        logger.debug("Move %s -> %s", file_path, to)
 
-        shutil.move(file_path, to)
+        self.to = to
         self.ret = True
 
 
@@ -424,6 +379,15 @@ DefaultFullScreen = True
 DefaultPrevCache = 4
 DefaultNextCache = 10
 
+# Learn number of pages to read ahead from your reading speed,
+# time to read and decode pages and memory.
+# DefaultPrevCache and DefaultNextCache are used until it is learned.
+AdaptivePrefetch = True
+# Seconds of reading to read ahead.
+PrefetchSeconds = 20
+# Max MB of pages read ahead by one archive.
+PrefetchMemory = 256
+
 # true or false.
 DoublePage = False
 
@@ -442,6 +406,39 @@ PageOrder  = right2left
 UpScale     = Lanczos
 DownScale   = Lanczos
 
+# Large reduction first averages pixels down to gap times of window size,
+# then resizes the rest by DownScale. Larger gap is slower and sharper.
+# Comma separated algorithm:gap. 0 resizes from full size.
+ReducingGap = Bilinear:2,Hamming:2,Bicubic:2.5,Lanczos:2.5
+
+# Read and decode next images in background when viewing images in directory.
+DirectoryPrefetch = True
+
+# Decode AVIF, WebP and PNG pages read ahead in this number of processes.
+# 0 means disabled.
+DecodeProcesses = 0
+
+# Open this number of next RandomSelect picks ahead. 0 means disabled.
+RandomAhead = 2
+
+# Remember positions of files in this directory, and show the last page at
+# once when they are opened again. Without path, the file read last is opened.
+# Empty means disabled. e.g. ~/.svsession
+SessionDir  =
+
+# Open files in running SaltViewer instead of starting new one.
+SingleInstance = False
+
+# Save resized pages to this directory and reuse them next time.
+# Empty means disabled. Several SaltViewer can share one directory.
+CacheDir    =
+# Max size of CacheDir in MB. Least recently used pages are removed.
+CacheSize   = 1024
+
+# Share resized pages and page sizes with other SaltViewer processes through
+# a cache daemon. Max size of its shared memory in MB. 0 means disabled.
+SharedCacheSize = 0
+
 [Keymap]
 
 DoublePage  = d
@@ -475,6 +472,15 @@ Reload       = r
 
 RandomSelect = n
 
+# Thumbnails of all pages. hjkl to move, Enter to open, q to close.
+Gallery      = t
+
+# Show time taken by each stage of the last page turn on status bar.
+Hud          = i
+
+# Show cache hit rate, memory held by caches and queue length.
+Stats        = s
+
 [MoveToList]
 
 # When you press MoveFile key, then press key registered.
@@ -505,6 +511,9 @@ RandomSelect = n
                 self._load(f)
 
     def _load(self, f):
+        if "csv" not in globals():
+            global csv
+            import csv
         config = None
         reader = csv.reader(f, delimiter="=")
         for row in reader:
@@ -540,6 +549,11 @@ RandomSelect = n
 
 
 class SaltViewer(tk.Tk):
+    # key repeat of OS fires every 30-50ms
+    repeat_interval = 0.15
+    # ms. render in full quality when no key is pressed in this time.
+    settle_time = 200
+
     def __init__(self, config_path, args):
         logger.debug("tk.Tk init")
         super().__init__()
@@ -581,6 +595,9 @@ class SaltViewer(tk.Tk):
             "Head": self.head,
             "Tail": self.tail,
             "RandomSelect": self.random_select,
+            "Gallery": self.gallery,
+            "Hud": self.toggle_hud,
+            "Stats": self.toggle_stats,
         }
 
         logger.debug("style")
@@ -597,21 +614,167 @@ class SaltViewer(tk.Tk):
         self.config.open(config_path)
 
         self.num = 0
+        # pages shown now. 2 if pages are paired in double page mode.
+        self.shown_pages = 1
 
         self.tree = ArchiveTree()
 
+        # text of status bar without HUD
+        self.status = "SaltViewer"
+
+        self.thumbnail_pool = None
+        self.decode_pool = None
+        self.random_ahead = None
+        self.session = None
+        # trash, move and rename in background
+        self.file_ops = None
+        self.file_ops_id = None
+        # InstanceServer receiving paths in single instance mode
+        self.instance = None
+        # [(page, name)] of archives to open on resume
+        self.resume_pages = []
+
+        # asynchronous open
+        self.open_id = 0
+        self.open_queue = queue.Queue()
+        self.poll_id = None
+        self.loading = False
+        # [name, count] of keys pressed while loading or rendering
+        self.pending = []
+
+        # key repeat coalescing
+        self.flush_id = None
+        self.settle_id = None
+        self.last_navigate = 0
+        self.repeating = False
+        self.preview = False
+
+        self.stats_label = None
+        self.stats_id = None
+        metrics.collector("archive", self._archive_stats)
+        metrics.collector("queue", self._queue_stats)
+        profiler.in_use = lambda: [self.archive, self.root_dir, *self.tree.root]
+
         self.load_config(args)
 
+    def gallery(self, event):
+        _ = event
+        if self.loading or self.archive is None:
+            logger.info("Archive is None")
+            return
+        # thumbnail imports multiprocessing. load it on first use.
+        from gallery import Gallery
+        from thumbnail import ThumbnailPool
+
+        if self.thumbnail_pool is None:
+            self.thumbnail_pool = ThumbnailPool()
+        Gallery(self, self.thumbnail_pool, self.archive, self.jump)
+
+    def toggle_hud(self, event):
+        _ = event
+        tracer.toggle_hud()
+        self.show_hud()
+
+    def toggle_stats(self, event):
+        _ = event
+        if self.stats_label is not None:
+            self.after_cancel(self.stats_id)
+            self.stats_label.destroy()
+            self.stats_label = None
+            return
+        self.stats_label = tk.Label(
+            self.main_frame,
+            justify="left",
+            anchor="nw",
+            font="TkFixedFont",
+            bg="black",
+            fg="white",
+        )
+        self.stats_label.place(x=0, y=0)
+        self._update_stats()
+
+    def _update_stats(self):
+        self.stats_label.configure(text=metrics.text())
+        self.stats_id = self.after(500, self._update_stats)
+
+    def _archive_stats(self):
+        stats = {}
+        if self.archive is not None:
+            for k, v in self.archive.memory().items():
+                stats[f"current.{k}"] = v
+        # parent archives of nested archive. they keep their data alive.
+        parents = [a for a in self.tree.root if a is not self.archive]
+        stats["tree.archives"] = len(parents)
+        for archive in parents:
+            for k, v in archive.memory().items():
+                stats[f"tree.{k}"] = stats.get(f"tree.{k}", 0) + v
+        stats["prefetch.bytes"] = DirectoryArchive.prefetch_memory_used()
+        if self.archive is not None:
+            for k, v in self.archive.lookahead.stats().items():
+                stats[f"lookahead.{k}"] = v
+        return stats
+
+    def _queue_stats(self):
+        stats = {"open": self.open_queue.qsize(), "pending_keys": len(self.pending)}
+        if self.image.disk_cache is not None:
+            for k, v in self.image.disk_cache.stats().items():
+                stats[f"disk_cache.{k}"] = v
+        if self.thumbnail_pool is not None:
+            for k, v in self.thumbnail_pool.stats().items():
+                stats[f"thumbnail.{k}"] = v
+        return stats
+
+    def show_hud(self):
+        text = self.status
+        if tracer.hud:
+            text += " " + tracer.summary()
+        if self.file_ops is not None:
+            progress = self.file_ops.progress()
+            if progress is not None:
+                text += f" [{progress}]"
+        self.statusbar.configure(text=text)
+
+    def jump(self, i):
+        if self.archive is None:
+            return
+        self.archive.i = self.archive.in_range(i)
+        self.current_page()
+
     def random_select(self, event):
         logger.debug("random_select called")
+        self._leave_archive()
         self._load_root_dir_thread(self.file_path)
         self.tree.reset()
         if self.archive is not None:
             self.archive.close()
         self.archive = None
-        self.open(*self.root_dir.random_select())
+        if len(self.root_dir.random_list) == 0:
+            load_messagebox().showwarning("reset random_list", "reset random_list")
+        file_path, data = self.root_dir.random_select()
+        ready = None
+        random_ahead = self.open_random_ahead()
+        if random_ahead is not None:
+            ready = random_ahead.take(file_path)
+            # random_select pops from the end
+            picks = self.root_dir.random_list[::-1][: random_ahead.count]
+            random_ahead.update([self.root_dir.file_list[j] for j in picks])
+        self.open(file_path, data, ready)
+
+    def open_random_ahead(self):
+        if self.random_ahead is None:
+            count = int(self.config.setting.get("RandomAhead", 2))
+            if count <= 0:
+                return None
+            from random_ahead import RandomAhead
+
+            self.random_ahead = RandomAhead()
+            self.random_ahead.count = count
+        return self.random_ahead
 
     def move_file(self, event):
+        if self.loading:
+            logger.info("loading")
+            return
         fullscreen = self.attributes("-fullscreen")
         self.attributes("-fullscreen", False)
 
@@ -623,27 +786,29 @@ class SaltViewer(tk.Tk):
             file_path = Path(top.file_path)
 
         move_to_list = self.config.move_to_list
-        logger.debug(f"{file_path}, {move_to_list}")
+        logger.debug("%s, %s", file_path, move_to_list)
 
         if self.root_dir is None:
             logger.debug("Directory Archive")
             self.root_dir = DirectoryArchive(file_path)
             self.root_dir.stop = True
 
-        if not MoveFile().move_file(move_to_list, file_path):
+        move_file = MoveFile()
+        if not move_file.move_file(move_to_list, file_path):
             logger.debug("move failed")
             self.attributes("-fullscreen", fullscreen)
             return
 
+        # close before moving. archive reads the file.
+        if self.archive is not None:
+            self.archive.close()
+        self.archive = None
+        self.submit_file_op("move", file_path, move_file.to)
+
         if len(self.root_dir) == 1:
-            if self.archive is not None:
-                self.archive.close()
             self.quit(None)
             return
 
-        if self.archive is not None:
-            self.archive.close()
-        self.archive = None
         self.tree.reset()
 
         self.root_dir.remove(file_path)
@@ -665,9 +830,39 @@ class SaltViewer(tk.Tk):
         next_file_path = current[0]
 
         self.attributes("-fullscreen", fullscreen)
-        logger.debug(f"open {next_file_path}")
+        logger.debug("open %s", next_file_path)
         self.open(next_file_path)
 
+    def submit_file_op(self, op, src, dst=None):
+        # file is removed from root_dir already. it runs in background.
+        if self.file_ops is None:
+            from file_ops import FileOps
+
+            self.file_ops = FileOps()
+        self.file_ops.submit(op, src, dst)
+        if self.file_ops_id is None:
+            self.file_ops_id = self.after(200, self._poll_file_ops)
+
+    def _poll_file_ops(self):
+        for op, src, dst, error in self.file_ops.take_results():
+            if error is None:
+                continue
+            # the file is still there. keep it in directory and current page.
+            if (
+                src.exists()
+                and self.root_dir is not None
+                and src.parent == Path(self.root_dir.file_path).parent
+            ):
+                self.root_dir.add(src)
+            load_messagebox().showwarning(
+                f"{op} failed.", f"{op} failed.\n{src}\n{error}"
+            )
+        self.show_hud()
+        if self.file_ops.busy():
+            self.file_ops_id = self.after(200, self._poll_file_ops)
+        else:
+            self.file_ops_id = None
+
     def reload(self, event):
         _ = event
         if self.archive is None:
@@ -706,6 +901,8 @@ class SaltViewer(tk.Tk):
             if v is None:
                 continue
             self.config.setting[k] = v
+        # given on command line. session does not override them.
+        self.explicit_settings = {k for k, v in args.items() if v is not None}
 
         for name, key in self.config.keymap.items():
             func = self.binding.get(name)
@@ -719,25 +916,11 @@ class SaltViewer(tk.Tk):
                 print(f"Not supported.: {name} = {key}")
 
         for name, key in self.config.setting.items():
-            match name:
-                case "DefaultFullScreen":
-                    self.attributes("-fullscreen", key == "True")
-                case "DefaultPrevCache":
-                    ArchiveBase.prev_cache = int(key)
-                case "DefaultNextCache":
-                    ArchiveBase.next_cache = int(key)
-                case "DefaultFitMode":
-                    self._change_image_fit_mode(key)
-                case "DoublePage":
-                    self.double_page = True if key == "true" else False
-                case "PageOrder":
-                    self.right2left = True if key == "right2left" else False
-                case "UpScale":
-                    self.image.select_up_scale_algorithm(key)
-                case "DownScale":
-                    self.image.select_down_scale_algorithm(key)
-                case _:
-                    print(f"Not supported.: {name} = {key}")
+            self.apply_setting(name, key)
+
+        self.open_disk_cache()
+        self.open_decode_pool()
+        self.open_session()
 
         self.bind("<Escape>", self.reset_num)
         self.bind("[", self.reset_num)
@@ -745,45 +928,257 @@ class SaltViewer(tk.Tk):
             self.bind(f"<KeyPress-{i}>", self.num_key)
         logger.debug("return")
 
+    def apply_setting(self, name, key):
+        match name:
+            case "DefaultFullScreen":
+                self.attributes("-fullscreen", key == "True")
+            case "DefaultPrevCache":
+                ArchiveBase.prev_cache = int(key)
+            case "DefaultNextCache":
+                ArchiveBase.next_cache = int(key)
+            case "AdaptivePrefetch":
+                AdaptivePrefetch.enabled = key == "True"
+            case "PrefetchSeconds":
+                AdaptivePrefetch.seconds = float(key)
+            case "PrefetchMemory":
+                AdaptivePrefetch.memory_budget = int(key) * 1024 * 1024
+            case "DefaultFitMode":
+                self._change_image_fit_mode(key)
+            case "DoublePage":
+                self.double_page = str(key).lower() == "true"
+            case "PageOrder":
+                self.right2left = True if key == "right2left" else False
+            case "UpScale":
+                self.image.engine.select_up_scale_algorithm(key)
+            case "DownScale":
+                self.image.engine.select_down_scale_algorithm(key)
+            case "ReducingGap":
+                self.image.engine.select_reducing_gap(key)
+            case "DirectoryPrefetch":
+                DirectoryArchive.prefetch = key == "True"
+            case "CacheDir" | "CacheSize" | "SharedCacheSize":
+                pass
+            case "DecodeProcesses" | "RandomAhead":
+                pass
+            case "SessionDir" | "SingleInstance":
+                pass
+            case _:
+                print(f"Not supported.: {name} = {key}")
+
+    def open_disk_cache(self):
+        disk_cache = None
+        cache_dir = self.config.setting.get("CacheDir")
+        if cache_dir is not None and cache_dir != "":
+            cache_size = int(self.config.setting.get("CacheSize", 1024))
+            logger.debug("disk cache %s, %sMB", cache_dir, cache_size)
+            from page_cache import DiskCache
+
+            disk_cache = DiskCache(cache_dir, cache_size * 1024 * 1024)
+        shared_size = int(self.config.setting.get("SharedCacheSize", 0))
+        if shared_size > 0:
+            logger.debug("shared cache %sMB", shared_size)
+            from cache_daemon import SharedCache
+
+            try:
+                # disk cache is read on miss of shared cache
+                disk_cache = SharedCache(shared_size, disk_cache)
+                ArchiveBase.shared_cache = disk_cache
+            except OSError as e:
+                logger.warning(f"shared cache is disabled: {e}")
+        if disk_cache is None:
+            return
+        ArchiveBase.disk_cache = disk_cache
+        self.image.disk_cache = disk_cache
+
+    def open_session(self):
+        session_dir = self.config.setting.get("SessionDir")
+        if session_dir is None or session_dir == "":
+            return
+        from session import Session
+
+        try:
+            self.session = Session(session_dir)
+        except OSError as e:
+            logger.warning(f"session is disabled: {e}")
+
+    def last_session(self):
+        # file read last, or None
+        if self.session is None:
+            return None
+        return self.session.last()
+
+    def session_position(self):
+        # (top level file, pages, names) of current page. pages and names are
+        # of each archive from the top level archive to the current one.
+        archive = self.archive
+        if archive is None or archive.file_path is None or len(archive) == 0:
+            return None
+        if archive.is_directory:
+            return archive.file_list[archive.i], [], []
+        archives = self.tree.root + [archive]
+        if archives[0].data is not None:
+            return None
+        pages = [a.i for a in archives]
+        names = [str(a.file_list[a.i]) for a in archives]
+        return archives[0].file_path, pages, names
+
+    def save_session(self, render=False):
+        if self.session is None:
+            return
+        position = self.session_position()
+        if position is None:
+            return
+        file_path, pages, names = position
+        image = self.image.shown_image if render and not self.loading else None
+        try:
+            self.session.update(
+                file_path,
+                pages,
+                names,
+                self.image.engine.fit_mode_name(),
+                self.double_page,
+                image is not None,
+            )
+            if image is not None:
+                self.session.save_render(file_path, image)
+        except OSError as e:
+            logger.warning(f"failed to update session: {e}")
+            return
+        self.session.save()
+
+    def resume(self, file_path, explicit=()):
+        # open file_path at the page where it was left last time.
+        # settings in explicit and on command line are kept.
+        entry = None if self.session is None else self.session.get(file_path)
+        if entry is None:
+            self.open(file_path)
+            return
+        logger.debug("resume %s", entry)
+        keep = self.explicit_settings.union(explicit)
+        if "DefaultFitMode" not in keep:
+            self._change_image_fit_mode(entry["fit_mode"])
+        if "DoublePage" not in keep:
+            self.double_page = entry["double_page"]
+        self.resume_pages = list(zip(entry["pages"], entry["names"]))
+        render = None
+        if entry.get("render"):
+            render = self.session.load_render(entry["path"])
+        self.open(Path(entry["path"]))
+        if render is not None:
+            self._show_resume_render(render, self.open_id)
+
+    def _show_resume_render(self, render, open_id):
+        # shown until the page is read from the archive
+        if open_id != self.open_id or not self.loading:
+            return
+        if self.image.width() <= 1:
+            # window is not mapped yet
+            self.after(5, self._show_resume_render, render, open_id)
+            return
+        self.image.display(render)
+
+    def _resume_position(self, archive):
+        # move archive opened on resume to the page of last session
+        if len(self.resume_pages) == 0 or archive.is_directory:
+            return
+        page, name = self.resume_pages.pop(0)
+        names = [str(f) for f in archive.file_list]
+        if 0 <= page < len(names) and names[page] == name:
+            archive.i = page
+        elif name in names:
+            archive.i = names.index(name)
+        else:
+            # archive is changed. nested archives are not the same.
+            self.resume_pages = []
+
+    def serve(self, instance):
+        # open paths sent by later salt-viewer runs
+        self.instance = instance
+        self.after(100, self._poll_instance)
+
+    def _poll_instance(self):
+        for request in self.instance.take():
+            self._open_request(request)
+        self.after(100, self._poll_instance)
+
+    def _open_request(self, request):
+        logger.debug("request %s", request)
+        settings = request.get("settings") or {}
+        for name, key in settings.items():
+            self.apply_setting(name, key)
+        self.deiconify()
+        self.lift()
+        self.focus_force()
+        if request.get("path") is None:
+            return
+        self._leave_archive()
+        self.tree.reset()
+        if self.archive is not None:
+            self.archive.close()
+        self.archive = None
+        # root directory of the new path
+        if self.root_dir is not None:
+            self.root_dir.stop = True
+        self.root_dir = None
+        self.resume(Path(request["path"]), settings.keys())
+
+    def _leave_archive(self):
+        self.resume_pages = []
+        self.save_session()
+
+    def open_decode_pool(self):
+        processes = int(self.config.setting.get("DecodeProcesses", 0))
+        if processes <= 0:
+            return
+        logger.debug("decode pool %s processes", processes)
+        from decode_pool import DecodePool
+
+        self.decode_pool = DecodePool(self.image.engine, processes)
+        ArchiveBase.decode_pool = self.decode_pool
+
+    def close_decode_pool(self):
+        if self.decode_pool is None:
+            return
+        ArchiveBase.decode_pool = None
+        self.decode_pool.shutdown()
+        self.decode_pool = None
+
+    def _update_render_key(self):
+        div = 2 if self.double_page else 1
+        ArchiveBase.render_key = self.image.render_key(div)
+        # spreads are shown alone and rendered as in single page mode
+        ArchiveBase.spread_render_key = None
+        if div == 2:
+            ArchiveBase.spread_render_key = self.image.render_key(1)
+        if ArchiveBase.render_key is None:
+            ArchiveBase.render_size = None
+        else:
+            ArchiveBase.render_size = (self.image.frame_size(), div)
+
     def num_key(self, event):
         self.num *= 10
         self.num += int(event.char)
-        logger.debug(f"num = {self.num}")
+        logger.debug("num = %s", self.num)
 
     def reset_num(self, event):
         self.num = 0
-        logger.debug(f"num = {self.num}")
+        logger.debug("num = %s", self.num)
 
     def _change_image_fit_mode(self, key):
-        match key:
-            case "Both":
-                self.image.fit_width = True
-                self.image.fit_height = True
-            case "Width":
-                self.image.fit_width = True
-                self.image.fit_height = False
-            case "Height":
-                self.image.fit_width = False
-                self.image.fit_height = True
-            case "None":
-                self.image.fit_width = False
-                self.image.fit_height = False
+        self.image.engine.select_fit_mode(key)
 
     def head(self, event):
         _ = event
-        if self.archive is None:
-            return
-        self.archive.head()
-        self.current_page()
+        self._navigate("Head")
 
     def tail(self, event):
         _ = event
-        if self.archive is None:
-            return
-        self.archive.tail()
-        self.current_page()
+        self._navigate("Tail")
 
     def next_archive(self, event):
+        if self.loading or len(self.pending) != 0:
+            self._queue("NextArchive")
+            return
         if self.archive is None:
             logger.info("Archive is None")
             return
@@ -796,6 +1191,7 @@ class SaltViewer(tk.Tk):
             self.next_page(event)
             return
 
+        self._leave_archive()
         next_file_path, data, archive = self.tree.next_archive()
         if next_file_path in ["", self.archive.file_path]:
             top = self.tree.top()
@@ -815,10 +1211,13 @@ class SaltViewer(tk.Tk):
 
         self.archive.close()
         self.archive = None
-        logger.debug(f"next_file_path = {next_file_path}")
+        logger.debug("next_file_path = %s", next_file_path)
         self.open(next_file_path, data)
 
     def prev_archive(self, event):
+        if self.loading or len(self.pending) != 0:
+            self._queue("PrevArchive")
+            return
         if self.archive is None:
             logger.info("Archive is None")
             return
@@ -831,6 +1230,7 @@ class SaltViewer(tk.Tk):
             self.prev_page(event)
             return
 
+        self._leave_archive()
         next_file_path, data, archive = self.tree.prev_archive()
         if next_file_path in ["", self.archive.file_path]:
             top = self.tree.top()
@@ -850,7 +1250,7 @@ class SaltViewer(tk.Tk):
 
         self.archive.close()
         self.archive = None
-        logger.debug(f"next_file_path = {next_file_path}")
+        logger.debug("next_file_path = %s", next_file_path)
         self.open(next_file_path, data)
 
     def construct_gui(self):
@@ -862,6 +1262,7 @@ class SaltViewer(tk.Tk):
 
         self.image = ImageFrame(self.main_frame)
         self.image.grid(row=0, column=0, sticky="wens")
+        self.image.bind("<<StaleRender>>", lambda *kw: self.current_page())
 
         dummy_img = Image.new("RGB", (10, 10), color="black")
         self.image.mode = "Raw"
@@ -875,6 +1276,9 @@ class SaltViewer(tk.Tk):
         logger.debug("return")
 
     def rename(self, event):
+        if self.loading:
+            logger.info("loading")
+            return
         fullscreen = self.attributes("-fullscreen")
         self.attributes("-fullscreen", False)
 
@@ -888,7 +1292,10 @@ class SaltViewer(tk.Tk):
         if top is not None:
             file_path = Path(top.file_path)
 
-        logger.debug(f"file_path = {file_path}")
+        logger.debug("file_path = %s", file_path)
+        if "filedialog" not in globals():
+            global filedialog
+            import tkinter.filedialog as filedialog
         file_name = filedialog.asksaveasfilename(
             initialdir=file_path.parent,
             initialfile=file_path.name,
@@ -897,7 +1304,7 @@ class SaltViewer(tk.Tk):
         if file_name is None or file_name == "" or file_name == ():
             logger.debug("file_name is None")
             return
-        logger.debug(file_name)
+        logger.debug("%s", file_name)
 
         if self.root_dir is None:
             self.root_dir = DirectoryArchive(file_path)
@@ -907,21 +1314,22 @@ class SaltViewer(tk.Tk):
         self.root_dir.remove(file_path)
         # logger.debug(f"root_dir file_list = {self.root_dir.file_list}")
         file_name = Path(file_name)
-        if file_name.exists() and not messagebox.askokcancel(
+        if file_name.exists() and not load_messagebox().askokcancel(
             "Overwrite?", "Overwrite File?"
         ):
             logger.debug("Cancel overwriting")
+            self.root_dir.add(file_path)
             return
-        shutil.move(file_path, file_name)
+
+        self.archive.close()
+        self.archive = None
+        self.submit_file_op("rename", file_path, file_name)
 
         if len(self.root_dir) == 0:
             logger.debug("directory is empty")
             self.quit(None)
             return
 
-        self.archive.close()
-        self.archive = None
-
         self.root_dir.cache = {}
 
         next_file_path, data = self.root_dir.current()
@@ -930,11 +1338,14 @@ class SaltViewer(tk.Tk):
             next_file_path, data = self.root_dir.prev()
 
         self.tree.reset()
-        logger.debug(f"next_file_path = {next_file_path}")
+        logger.debug("next_file_path = %s", next_file_path)
         self.open(next_file_path, data)
         self.attributes("-fullscreen", fullscreen)
 
     def trash(self, event):
+        if self.loading:
+            logger.info("loading")
+            return
         fullscreen = self.attributes("-fullscreen")
         self.attributes("-fullscreen", False)
 
@@ -943,15 +1354,12 @@ class SaltViewer(tk.Tk):
             return
 
         file_path = self.archive.file_path
-        logger.debug(f"file_path = {file_path}")
+        logger.debug("file_path = %s", file_path)
         top = self.tree.top()
         if top is not None:
             file_path = Path(top.file_path)
-        logger.debug(f"file_path = {file_path}")
-        if messagebox.askokcancel("Trash file?", f"Trash file?\n{file_path}"):
-            global send2trash
-            from send2trash import send2trash
-
+        logger.debug("file_path = %s", file_path)
+        if load_messagebox().askokcancel("Trash file?", f"Trash file?\n{file_path}"):
             if self.root_dir is None:
                 self.root_dir = DirectoryArchive(file_path)
                 self.root_dir.stop = True
@@ -959,16 +1367,15 @@ class SaltViewer(tk.Tk):
             # logger.debug(f"root_dir file_list = {self.root_dir.file_list}")
             self.root_dir.remove(file_path)
             # logger.debug(f"root_dir file_list = {self.root_dir.file_list}")
-            send2trash(str(file_path))
+            self.archive.close()
+            self.archive = None
+            self.submit_file_op("trash", file_path)
 
             if len(self.root_dir) == 0:
                 logger.debug("directory is empty")
                 self.quit(None)
                 return
 
-            self.archive.close()
-            self.archive = None
-
             self.root_dir.cache = {}
             next_file_path, data = self.root_dir.current()
 
@@ -976,7 +1383,7 @@ class SaltViewer(tk.Tk):
                 next_file_path, data = self.root_dir.prev()
 
             self.tree.reset()
-            logger.debug(f"next_file_path = {next_file_path}")
+            logger.debug("next_file_path = %s", next_file_path)
             self.attributes("-fullscreen", fullscreen)
 
             self.open(next_file_path, data)
@@ -986,7 +1393,7 @@ class SaltViewer(tk.Tk):
 
     def toggle_page_mode(self, event):
         self.double_page = not self.double_page
-        logger.debug(f"DoublePage:{self.double_page}")
+        logger.debug("DoublePage:%s", self.double_page)
         self.current_page()
 
     def toggle_order(self, event):
@@ -994,23 +1401,54 @@ class SaltViewer(tk.Tk):
         self.right2left = not self.right2left
 
     def current_page(self):
+        if self.loading:
+            logger.debug("loading")
+            return
         if self.archive is None:
             logger.info("Archive is None")
             return
-        file_path, data = self.archive.current()
-        if file_path == "":
-            logger.debug("file_path is empty")
-            return None
-        image = self.open_file(file_path, data)
-        image2 = None
-        if self.double_page:
-            image2 = self._open_next()
-            # back to current
-            self.archive.prev()
-        logger.debug("----------------------------------")
-        logger.debug("current")
-        logger.debug("----------------------------------")
-        self.image.display(image, image2, self.right2left)
+        self._update_render_key()
+        with tracer.page(page=self.archive.i, preview=self.preview):
+            file_path, data = self.archive.current()
+            if file_path == "":
+                logger.debug("file_path is empty")
+                return None
+            image = self.open_file(file_path, data)
+            image2 = None
+            i = self.archive.i
+            # wide page is a spread. it is shown alone and not paired.
+            if (
+                self.double_page
+                and not self.loading
+                and i + 1 < len(self.archive)
+                and not self._is_spread(image, i)
+                and not self.archive.is_spread(i + 1)
+            ):
+                direction = self.archive.direction
+                image2 = self._open_next()
+                # back to current. reading direction is not changed.
+                self.archive.prev()
+                self.archive.direction = direction
+                if self._is_spread(image2, i + 1):
+                    image2 = None
+            self.shown_pages = 1 if image2 is None else 2
+            if self.loading:
+                logger.debug("nested archive")
+                return
+            logger.debug("----------------------------------")
+            logger.debug("current")
+            logger.debug("----------------------------------")
+            self.image.display(image, image2, self.right2left, fast=self.preview)
+            if not self.preview:
+                self.archive.lookahead.decoded(
+                    self.image.decode_time, 1 if image2 is None else 2
+                )
+            if tracer.enabled:
+                with tracer.span("canvas"):
+                    # draw now to include drawing in this page turn
+                    self.image.update_idletasks()
+        self.show_hud()
+        profiler.page_turn()
 
     def _open_next(self, c=1):
         logger.debug("called")
@@ -1021,89 +1459,243 @@ class SaltViewer(tk.Tk):
         if file_path == "":
             logger.debug("file_path is empty")
             return None
-        logger.debug(f"file_path={file_path}")
+        logger.debug("file_path=%s", file_path)
         return self.open_file(file_path, data)
 
+    def _is_spread(self, image, i):
+        if isinstance(image, Image.Image):
+            return image.width > image.height
+        return self.archive.is_spread(i)
+
+    def _spread_step(self, d):
+        # pages to move to next or previous spread in double page mode.
+        # pages shown now to go next. to go back, previous two pages unless
+        # one of them is a wide page.
+        if not self.double_page or self.archive is None:
+            return 1
+        if d > 0:
+            return self.shown_pages
+        i = self.archive.i
+        if i < 2 or self.archive.is_spread(i - 1) or self.archive.is_spread(i - 2):
+            return 1
+        return 2
+
     def next_page(self, event):
+        _ = event
         logger.debug("called")
-        # back to the second page then next
-        if self.archive is None:
-            logger.info("Archive is None")
-            return
-        if self.double_page:
-            logger.debug("double_page")
-            self.archive.next()
-
-        image = self._open_next(self.num)
-        self.num = 0
-        image2 = None
-        if self.double_page:
-            image2 = self._open_next()
-            # in order to set index as first page
-
-            self.archive.prev()
-        logger.debug("-------------------------------------")
-        logger.debug("next_page")
-        logger.debug("-------------------------------------")
-        self.image.display(image, image2, self.right2left)
-
-    def _open_prev(self, c=1):
-        if self.archive is None:
-            logger.info("Archive is None")
-            return
-        file_path, data = self.archive.prev(c)
-        if file_path == "":
-            logger.debug("file_path is empty")
-            return None
-        logger.debug(f"file_path={file_path}")
-        logger.debug(f"self.archive.file_path={self.archive.file_path}")
-        return self.open_file(file_path, data)
+        self._navigate("Page", max(1, self.num) - 1 + self._spread_step(1))
 
     def prev_page(self, event):
+        _ = event
         logger.debug("called")
-        image = self._open_prev(self.num)
+        self._navigate("Page", -(max(1, self.num) - 1 + self._spread_step(-1)))
+
+    def _navigate(self, name, count=0):
+        # Moves are not rendered at once. They are queued and rendered at
+        # idle time, so that moves fired by key repeat while rendering are
+        # collapsed and only the last page is rendered.
+        tracer.instant("key", target=name, count=count)
         self.num = 0
-        image2 = None
-        if self.double_page:
-            image2 = self._open_prev()
-        logger.debug("-------------------------------------")
-        logger.debug("prev_page")
-        logger.debug("-------------------------------------")
-        self.image.display(image, image2, not self.right2left)
+        now = time.perf_counter()
+        self.repeating = now - self.last_navigate < self.repeat_interval
+        self.last_navigate = now
+        self._queue(name, count)
+        if not self.loading and self.flush_id is None:
+            self.flush_id = self.after_idle(self._flush_navigation)
+
+    def _flush_navigation(self):
+        self.flush_id = None
+        if self.loading:
+            return
+        # while key is held, show quick preview and render it in full quality
+        # after key is released.
+        self.preview = self.repeating
+        self._apply_pending()
+        self.preview = False
+        if self.repeating:
+            if self.settle_id is not None:
+                self.after_cancel(self.settle_id)
+            self.settle_id = self.after(self.settle_time, self._settle)
+
+    def _settle(self):
+        self.settle_id = None
+        elapsed = int((time.perf_counter() - self.last_navigate) * 1000)
+        if elapsed < self.settle_time:
+            self.settle_id = self.after(self.settle_time - elapsed, self._settle)
+            return
+        self.repeating = False
+        self.current_page()
 
     def quit(self, event):
         _ = event
+        self.save_session(render=True)
         if self.archive is not None:
             self.archive.close()
+        if self.thumbnail_pool is not None:
+            self.thumbnail_pool.shutdown()
+        self.close_decode_pool()
+        if self.random_ahead is not None:
+            self.random_ahead.close()
         self.destroy()
 
-    def open(self, file_path, data=None):
-        if self.archive is not None:
-            self.archive.stop = True
+    def open(self, file_path, data=None, ready=None):
+        # ready is (archive, decoded first page) opened ahead by RandomAhead.
+        # current archive is stopped when new one is opened. if open fails,
+        # it is kept and keeps reading ahead.
         if self.root_dir is None:
             logger.debug("self.root_dir is None load directory")
             self._load_root_dir(file_path)
         self.file_path = file_path
+        self._update_render_key()
+
+        # archive is opened on other thread so that window is not frozen.
+        # newer open supersedes older one.
+        self.open_id += 1
+        self.loading = True
+        self.statusbar.configure(text=f"Loading {file_path} ...")
+        if ready is not None:
+            self.open_queue.put((self.open_id, file_path, ready[0], None, ready[1]))
+        else:
+            t = threading.Thread(
+                target=self._open_thread, args=(self.open_id, file_path, data)
+            )
+            t.start()
+        if self.poll_id is None:
+            self.poll_id = self.after(10, self._poll_open)
+
+    def _open_thread(self, open_id, file_path, data):
+        # newer open may be requested while this is opening. superseded
+        # archive is closed here without reading.
+        archive = None
+        error = None
+        try:
+            if open_id != self.open_id:
+                logger.debug("superseded: %s", file_path)
+                return
+            archive = self.open_archive(file_path, data, preload=False)
+            if open_id != self.open_id:
+                logger.debug("superseded: %s", file_path)
+                archive.close()
+                return
+            self._resume_position(archive)
+            if not archive.is_directory:
+                archive.start_preload()
+            # read the first page here. it is cached in archive.
+            archive.current()
+        except Exception as e:
+            logger.warning(f"open failed: {file_path}: {e}")
+            error = e
+        self.open_queue.put((open_id, file_path, archive, error, None))
+
+    def _poll_open(self):
+        while not self.open_queue.empty():
+            self._finish_open(*self.open_queue.get_nowait())
+        if self.loading:
+            self.poll_id = self.after(10, self._poll_open)
+        else:
+            self.poll_id = None
 
-        self.archive = self.open_archive(file_path, data)
-        if self.archive is None:
-            logger.debug("archive is None")
+    def _finish_open(self, open_id, file_path, archive, error, image=None):
+        if open_id != self.open_id:
+            logger.debug("superseded: %s", file_path)
+            if archive is not None:
+                archive.close()
             return
+        self.loading = False
+
+        if error is not None:
+            self.pending = []
+            load_messagebox().showwarning(
+                "Open failed.", f"Open failed.\n{file_path}\n{error}"
+            )
+            return
+
+        # in the case of nested archive
+        if self.archive is not None:
+            self.archive.stop = True
+            self.tree.append(self.archive)
+        self.archive = archive
+        profiler.watch(archive)
+        profiler.archive_switch(self.archive.file_path)
+        if self.archive.is_directory and DirectoryArchive.prefetch:
+            self.archive.start_prefetch()
+
         file_path, data = self.archive.current()
-        logger.debug(f"file_path={file_path}")
+        if image is not None:
+            data = image
+        logger.debug("file_path=%s", file_path)
         if file_path is None and data is None:
             logger.debug("file may be empty.")
             self.destroy()
+            return
         image = self.open_file(file_path, data)
         logger.debug("-------------------------------------")
         logger.debug("open")
-        logger.debug(image)
+        logger.debug("%s", image)
         logger.debug("-------------------------------------")
+        if self.loading:
+            logger.debug("nested archive")
+            return
+        if len(self.pending) != 0:
+            self._apply_pending()
+            return
         if image is None:
             logger.debug("image is None")
             return
+        self.shown_pages = 1
         self.image.display(image)
-        return image
+
+    def _queue(self, name, count=0):
+        # keys pressed while loading. page moves are collapsed into one.
+        if name == "Page" and len(self.pending) != 0 and self.pending[-1][0] == "Page":
+            self.pending[-1][1] += count
+        elif name in ["Head", "Tail"]:
+            # jump makes page moves before it meaningless
+            while len(self.pending) != 0 and self.pending[-1][0] in [
+                "Page",
+                "Head",
+                "Tail",
+            ]:
+                self.pending.pop()
+            self.pending.append([name, count])
+        else:
+            self.pending.append([name, count])
+        logger.debug("pending = %s", self.pending)
+        if self.loading:
+            queued = " ".join(f"{name}:{count}" for name, count in self.pending)
+            self.statusbar.configure(text=f"Loading {self.file_path} ... ({queued})")
+
+    def _apply_pending(self):
+        if self.archive is None:
+            logger.info("Archive is None")
+            self.pending = []
+            return
+        moved = False
+        while len(self.pending) != 0 and not self.loading:
+            name, count = self.pending.pop(0)
+            if name in ["Page", "Head", "Tail"]:
+                self.archive.lookahead.turn(count, 2 if self.double_page else 1)
+            match name:
+                case "Page":
+                    if count > 0:
+                        self.archive.next(count)
+                    elif count < 0:
+                        self.archive.prev(-count)
+                    moved = True
+                case "Head":
+                    self.archive.head()
+                    moved = True
+                case "Tail":
+                    self.archive.tail()
+                    moved = True
+                case "NextArchive":
+                    moved = False
+                    self.next_archive(None)
+                case "PrevArchive":
+                    moved = False
+                    self.prev_archive(None)
+        if moved and not self.loading:
+            self.current_page()
 
     def _load_root_dir_thread(self, file_path):
         if self.root_dir is None:
@@ -1114,42 +1706,10 @@ class SaltViewer(tk.Tk):
         t = threading.Thread(target=self._load_root_dir_thread, args=(file_path,))
         t.start()
 
-    def open_archive(self, file_path, data=None):
+    def open_archive(self, file_path, data=None, preload=True):
         logger.debug("called")
         print(file_path)
-        suffix = Path(file_path).suffix.lower()
-
-        match suffix:
-            case ".zip":
-                logger.debug("zip")
-                archive = ZipArchive(file_path, data)
-            case ".rar":
-                logger.debug("rar")
-                archive = RarArchive(file_path, data)
-            case ".7z":
-                logger.debug("7z")
-                archive = SevenZipArchive(file_path, data)
-            case ".pdf":
-                logger.debug("pdf")
-                archive = PdfArchive(file_path, data)
-            case ".tar" | ".gz":
-                logger.debug("tar or gz")
-                archive = TarArchive(file_path, data)
-            case _:
-                logger.debug("directory")
-                archive = DirectoryArchive(file_path, data)
-
-        # in the case of nested archive
-        if self.archive is None:
-            return archive
-
-        # logger.debug(f"self.archive file_list = {self.archive.file_list}")
-        # logger.debug(f"archive file_list = {archive.file_list}")
-        # if not self.archive.is_directory and not archive.is_directory:
-        #     logger.debug("self.tree.append")
-        self.tree.append(self.archive)
-
-        return archive
+        return open_archive(file_path, data, preload)
 
     def open_file(self, file_path, data=None):
         if self.archive is None:
@@ -1169,44 +1729,45 @@ class SaltViewer(tk.Tk):
             title = f"{self.archive.file_path}/" + title
         page = f"({self.archive.i + 1}/{len(self.archive)}):"
 
-        logger.debug(page)
-        logger.debug(title)
+        logger.debug("%s", page)
+        logger.debug("%s", title)
 
         self.title(page + title)
-        self.statusbar.configure(text=f"{page} {self.archive.file_path}/{title}")
+        self.status = f"{page} {self.archive.file_path}/{title}"
+        self.statusbar.configure(text=self.status)
         self.image.title = title
 
-        logger.debug(file_path)
+        logger.debug("%s", file_path)
         suffix = file_path.suffix.lower()
-        logger.debug(suffix)
+        logger.debug("%s", suffix)
         if suffix in ArchiveBase.support_image_type:
-            return self.open_image(file_path, data)
+            image = self.open_image(file_path, data)
+            self._set_render_id(image)
+            return image
         # elif suffix in [".tiff"]:
         #    # can have multi images
         #    pass
-        elif suffix in [".svg"]:
-            return self.open_svg(file_path, data)
         elif suffix in ArchiveBase.support_type:
             return self.open(file_path, data)
         else:
-            logger.debug(f"Not supported.:{suffix}")
+            logger.debug("Not supported.:%s", suffix)
             return None
 
-    def _open_by_path_or_data(self, path, data=None):
-        if data is None:
-            return Image.open(path)
-
-        if isinstance(data, io.BytesIO):
-            return Image.open(data)
-
-        # if PIL.Image
-        return data
+    def _set_render_id(self, image):
+        # ImageFrame saves the resized image with this id to disk cache.
+        if image is None or self.image.disk_cache is None:
+            return
+        try:
+            image.render_id = self.archive.render_id(self.archive.i)
+        except (OSError, IndexError):
+            logger.debug("render_id failed")
 
     def open_image(self, image_path, data=None):
         logger.debug("called")
-        image = self._open_by_path_or_data(image_path, data)
+        with tracer.span("open"):
+            image = self.image.engine.decode(image_path, data)
         if image is None:
-            messagebox.showwarning("Image open failed.", "Image open failed.")
+            load_messagebox().showwarning("Image open failed.", "Image open failed.")
             return None
 
         # Force single page mode when animation
@@ -1216,22 +1777,22 @@ class SaltViewer(tk.Tk):
         logger.debug("return")
         return image
 
-    def open_svg(self, image_path, data=None):
-        if "cairosvg" not in globals():
-            global cairosvg
-            import cairosvg
-
-        if data is None:
-            svg = cairosvg.svg2png(url=str(image_path))
-        else:
-            svg = cairosvg.svg2png(file_obj=data)
-        svg = io.BytesIO(svg)
-        return Image.open(svg)
-
     def mainloop(self):
         super().mainloop()
+        metrics.save()
+        profiler.report()
+        # closed by quit() if quit by key
+        self.save_session(render=True)
         if self.archive is not None:
             self.archive.close()
+        self.close_decode_pool()
+        if self.random_ahead is not None:
+            self.random_ahead.close()
+        if self.instance is not None:
+            self.instance.close()
+        if self.file_ops is not None:
+            self.file_ops.join()
+        tracer.save()
 
 
 def main():
@@ -1241,7 +1802,11 @@ def main():
         description="SaltViewer. Simple (archived) image viewer (https://github.com/GuiltyCat/SaltViewer)"
     )
     parser.add_argument(
-        "path", help="image file or archive file", type=str, default=None
+        "path",
+        help="image file or archive file. Default is the file read last",
+        type=str,
+        nargs="?",
+        default=None,
     )
     parser.add_argument(
         "--config",
@@ -1255,7 +1820,13 @@ def main():
         action="store_true",
     )
     parser.add_argument(
-        "--debug", help="run as debug mode. All log is printed.", action="store_true"
+        "--debug",
+        help="print debug log of comma separated subsystems or all."
+        + f" {','.join(log.subsystems)}. Default is all",
+        nargs="?",
+        const="all",
+        default=None,
+        metavar="SUBSYSTEMS",
     )
     parser.add_argument(
         "--fullscreen", help="run as fullscreen mode", action="store_true", default=None
@@ -1272,6 +1843,18 @@ def main():
         type=int,
         default=None,
     )
+    parser.add_argument(
+        "--prefetch_seconds",
+        help="seconds of reading to read ahead. Default is 20",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--prefetch_memory",
+        help="max MB of pages read ahead by one archive. Default is 256",
+        type=int,
+        default=None,
+    )
     parser.add_argument(
         "--fit_mode",
         help="fit_mode. Both, Raw, Width, Height.  Default is Both",
@@ -1298,34 +1881,153 @@ def main():
         help="Downscale algorithm. Nearest, Box, Bilinear, Hamming, Bicubic, Lanczos. Default is Lanczos",
         default=None,
     )
+    parser.add_argument(
+        "--reducing_gap",
+        help="algorithm:gap of reduction before resize. e.g. Lanczos:3,Bicubic:0",
+        default=None,
+    )
+    parser.add_argument(
+        "--cache_dir",
+        help="directory of on-disk page cache. Default is disabled.",
+        default=None,
+    )
+    parser.add_argument(
+        "--trace",
+        help="write time taken by each stage of page turns to FILE as Chrome trace JSON",
+        metavar="FILE",
+        default=None,
+    )
+    parser.add_argument(
+        "--stats",
+        help="write cache statistics to FILE as JSON at exit",
+        metavar="FILE",
+        default=None,
+    )
+    parser.add_argument(
+        "--memprofile",
+        help="trace memory on archive switch and every N page turns,"
+        + " and write summary to FILE as JSON at exit",
+        metavar="FILE",
+        default=None,
+    )
+    parser.add_argument(
+        "--memprofile_every",
+        help="page turns between memory snapshots. Default is 20",
+        metavar="N",
+        type=int,
+        default=20,
+    )
+    parser.add_argument(
+        "--cache_size",
+        help="max size of on-disk page cache in MB. Default is 1024",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--shared_cache_size",
+        help="MB of pages shared with other SaltViewer processes. Default is 0 (disabled)",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--session_dir",
+        help="directory to remember positions, e.g. ~/.svsession. Default is disabled",
+        default=None,
+    )
+    parser.add_argument(
+        "--single_instance",
+        help="open path in running SaltViewer if any, or listen for later runs",
+        action="store_true",
+        default=None,
+    )
+    parser.add_argument(
+        "--random_ahead",
+        help="number of next RandomSelect picks opened ahead. Default is 2",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--decode_processes",
+        help="processes decoding AVIF, WebP and PNG pages. Default is 0 (disabled)",
+        type=int,
+        default=None,
+    )
 
     args = parser.parse_args()
 
-    args.path = Path(args.path)
-
+    # "--debug book.zip" takes path as subsystems
+    if args.path is None and args.debug is not None and args.debug != "all":
+        if args.debug.split(",")[0] not in log.subsystems:
+            args.path = args.debug
+            args.debug = "all"
     if args.default_config:
+        if args.path is None:
+            parser.error("the following arguments are required: path")
         logger.debug("write default config")
-        Config().write_default_config(args.path)
+        Config().write_default_config(Path(args.path))
         return
 
-    if args.debug:
-        # logger.debug("setLevel DEBUG")
-        # logger.setLevel(logging.DEBUG)
-        pass
+    if args.debug is not None:
+        log.enable_debug(args.debug)
 
     sv_args = {
         "DefaultFitMode": args.fit_mode,
+        "DoublePage": args.double,
         "DefaultFullScreen": args.fullscreen,
         "DefaultPrevCache": args.prev_cache,
         "DefaultNextCache": args.next_cache,
+        "PrefetchSeconds": args.prefetch_seconds,
+        "PrefetchMemory": args.prefetch_memory,
         "UpScale": args.upscale,
         "DownScale": args.downscale,
+        "ReducingGap": args.reducing_gap,
+        "CacheDir": args.cache_dir,
+        "CacheSize": args.cache_size,
+        "SharedCacheSize": args.shared_cache_size,
+        "DecodeProcesses": args.decode_processes,
+        "RandomAhead": args.random_ahead,
+        "SessionDir": args.session_dir,
     }
 
+    instance = None
+    config = Config()
+    config.open(args.config)
+    if args.single_instance or config.setting.get("SingleInstance") == "True":
+        from instance import InstanceServer, send
+
+        settings = {k: str(v) for k, v in sv_args.items() if v is not None}
+        if send(args.path, settings):
+            logger.debug("sent to running SaltViewer")
+            return
+        try:
+            instance = InstanceServer()
+        except OSError as e:
+            # another SaltViewer started listening at the same time
+            if send(args.path, settings):
+                logger.debug("sent to running SaltViewer")
+                return
+            logger.warning(f"single instance is disabled: {e}")
+
+    if args.trace is not None:
+        tracer.start(args.trace)
+    if args.stats is not None:
+        metrics.start(args.stats)
+    if args.memprofile is not None:
+        profiler.start(args.memprofile, args.memprofile_every)
+
     logger.debug("SaltViewer Init")
     sv = SaltViewer(args.config, sv_args)
+    # without path, resume the file read last
+    file_path = args.path if args.path is not None else sv.last_session()
+    if file_path is None:
+        sv.destroy()
+        if instance is not None:
+            instance.close()
+        parser.error("the following arguments are required: path")
     logger.debug("opee args.path")
-    sv.open(Path(args.path))
+    sv.resume(Path(file_path))
+    if instance is not None:
+        sv.serve(instance)
     logger.debug("mainloop")
     sv.mainloop()
 
@@ -0,0 +1,460 @@
+import bisect
+import collections
+import io
+import struct
+import tempfile
+import threading
+from log import get_logger
+
+logger = get_logger(__name__)
+
+
+# Random access to compressed streams made of independent blocks.
+# zstd frames, xz blocks and bzip2 blocks are decompressed independently,
+# so reading a member of .tar.zst only decompresses the blocks holding it.
+# A stream compressed as one block is decompressed once to a temporary file.
+
+
+class Block:
+    __slots__ = ["coffset", "csize", "uoffset", "usize", "extra"]
+
+    def __init__(self, coffset, csize, uoffset=None, usize=None, extra=None):
+        # compressed offset and size in file.
+        self.coffset = coffset
+        self.csize = csize
+        # offset and size after decompression. None until decompressed
+        # if the format does not record them.
+        self.uoffset = uoffset
+        self.usize = usize
+        self.extra = extra
+
+
+class BlockStream(io.RawIOBase):
+    # bytes of decompressed blocks kept in memory
+    cache_bytes = 64 * 1024 * 1024
+    # larger blocks are written to temporary file instead of memory.
+    max_memory_block = 32 * 1024 * 1024
+    chunk_size = 1024 * 1024
+
+    def __init__(self, fp):
+        super().__init__()
+        if hasattr(fp, "read"):
+            self.file = fp
+            self.own_file = False
+        else:
+            self.file = open(fp, "rb")
+            self.own_file = True
+        self.file.seek(0, io.SEEK_END)
+        self.file_size = self.file.tell()
+        self.pos = 0
+        self.lock = threading.RLock()
+        self.cache = collections.OrderedDict()
+        # block index: file object of spilled blocks
+        self.spilled = {}
+        self.blocks = self.scan()
+        if len(self.blocks) == 0:
+            raise ValueError("no compressed block found")
+        self.blocks[0].uoffset = 0
+        self.resolve_offsets()
+        logger.debug("%s blocks", len(self.blocks))
+
+    def scan(self):
+        # return list of Block
+        raise NotImplementedError
+
+    def decode(self, block):
+        # yield decompressed chunks of block
+        raise NotImplementedError
+
+    def read_compressed(self, offset, size):
+        with self.lock:
+            self.file.seek(offset)
+            return self.file.read(size)
+
+    def compressed_chunks(self, offset, size):
+        end = offset + size
+        while offset < end:
+            n = min(self.chunk_size, end - offset)
+            data = self.read_compressed(offset, n)
+            if len(data) == 0:
+                raise ValueError("unexpected end of file")
+            offset += len(data)
+            yield data
+
+    def resolve_offsets(self):
+        for prev, block in zip(self.blocks, self.blocks[1:]):
+            if prev.uoffset is None or prev.usize is None:
+                return
+            block.uoffset = prev.uoffset + prev.usize
+
+    def size(self):
+        last = self.blocks[-1]
+        while last.usize is None:
+            self.load(self.first_unknown())
+        return last.uoffset + last.usize
+
+    def first_unknown(self):
+        for i, block in enumerate(self.blocks):
+            if block.usize is None:
+                return i
+        return None
+
+    def find(self, offset):
+        # index of block holding offset. decompress blocks of unknown size
+        # in order until offset is found.
+        while True:
+            known = [b.uoffset for b in self.blocks if b.uoffset is not None]
+            i = bisect.bisect_right(known, offset) - 1
+            block = self.blocks[i]
+            if block.usize is None:
+                self.load(i)
+                continue
+            if offset < block.uoffset + block.usize or i == len(self.blocks) - 1:
+                return i
+            if self.blocks[i + 1].uoffset is None:
+                self.load(self.first_unknown())
+                continue
+            return i + 1
+
+    def load(self, i):
+        # decompressed data of block i as bytes or file
+        with self.lock:
+            data = self.cache.get(i)
+            if data is not None:
+                self.cache.move_to_end(i)
+                return data
+            if i in self.spilled:
+                return self.spilled[i]
+
+            block = self.blocks[i]
+            buf = io.BytesIO()
+            spill = None
+            for chunk in self.decode(block):
+                if spill is None and buf.tell() + len(chunk) > self.max_memory_block:
+                    spill = tempfile.TemporaryFile()
+                    spill.write(buf.getvalue())
+                    buf = None
+                (spill or buf).write(chunk)
+            size = spill.tell() if spill is not None else buf.tell()
+            if block.usize is not None and block.usize != size:
+                raise ValueError(f"block {i} size mismatch {size} != {block.usize}")
+            block.usize = size
+            self.resolve_offsets()
+
+            if spill is not None:
+                logger.debug("spill block %s: %s bytes", i, size)
+                self.spilled[i] = spill
+                return spill
+            data = buf.getvalue()
+            self.cache[i] = data
+            cached = sum(len(d) for d in self.cache.values())
+            while len(self.cache) > 1 and cached > self.cache_bytes:
+                cached -= len(self.cache.popitem(last=False)[1])
+            return data
+
+    def pread(self, offset, size):
+        # read without changing position. safe from several threads.
+        out = bytearray()
+        with self.lock:
+            while size > 0:
+                i = self.find(offset)
+                block = self.blocks[i]
+                if offset >= block.uoffset + block.usize:
+                    # end of stream
+                    break
+                data = self.load(i)
+                start = offset - block.uoffset
+                n = min(size, block.usize - start)
+                if isinstance(data, bytes):
+                    out += data[start : start + n]
+                else:
+                    data.seek(start)
+                    out += data.read(n)
+                offset += n
+                size -= n
+        return bytes(out)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        else:
+            self.pos = self.size() + offset
+        return self.pos
+
+    def readinto(self, b):
+        data = self.pread(self.pos, len(b))
+        b[: len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def close(self):
+        with self.lock:
+            for f in self.spilled.values():
+                f.close()
+            self.spilled = {}
+            self.cache.clear()
+            if self.own_file:
+                self.file.close()
+        super().close()
+
+
+class ZstdStream(BlockStream):
+    # https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md
+    # https://github.com/facebook/zstd/blob/dev/contrib/seekable_format/zstd_seekable_compression_format.md
+    frame_magic = 0xFD2FB528
+    seekable_magic = 0x8F92EAB1
+    skippable_mask = 0xFFFFFFF0
+    skippable_magic = 0x184D2A50
+
+    def scan(self):
+        if "zstandard" not in globals():
+            global zstandard
+            import zstandard
+        blocks = self.seek_table()
+        if blocks is not None:
+            logger.debug("zstd seek table")
+            return blocks
+        return self.frames()
+
+    def seek_table(self):
+        if self.file_size < 9:
+            return None
+        footer = self.read_compressed(self.file_size - 9, 9)
+        frames, descriptor, magic = struct.unpack("<IBI", footer)
+        if magic != self.seekable_magic:
+            return None
+        entry_size = 12 if descriptor & 0x80 else 8
+        table_size = frames * entry_size
+        table = self.read_compressed(self.file_size - 9 - table_size, table_size)
+        blocks = []
+        coffset = 0
+        uoffset = 0
+        for i in range(frames):
+            csize, usize = struct.unpack_from("<II", table, i * entry_size)
+            blocks.append(Block(coffset, csize, uoffset, usize))
+            coffset += csize
+            uoffset += usize
+        return blocks
+
+    def frames(self):
+        blocks = []
+        offset = 0
+        while offset < self.file_size:
+            magic = struct.unpack("<I", self.read_compressed(offset, 4))[0]
+            if magic & self.skippable_mask == self.skippable_magic:
+                size = struct.unpack("<I", self.read_compressed(offset + 4, 4))[0]
+                offset += 8 + size
+                continue
+            if magic != self.frame_magic:
+                raise ValueError(f"not a zstd frame at {offset}")
+            csize, usize = self.frame_size(offset)
+            blocks.append(Block(offset, csize, None, usize))
+            offset += csize
+        return blocks
+
+    def frame_size(self, offset):
+        # (compressed size, content size or None) of frame at offset
+        descriptor = self.read_compressed(offset + 4, 1)[0]
+        fcs_flag = descriptor >> 6
+        single_segment = (descriptor >> 5) & 1
+        checksum = (descriptor >> 2) & 1
+        did_size = [0, 1, 2, 4][descriptor & 3]
+        fcs_size = [1 if single_segment else 0, 2, 4, 8][fcs_flag]
+        header_size = 5 + (0 if single_segment else 1) + did_size + fcs_size
+
+        usize = None
+        if fcs_size != 0:
+            fcs = self.read_compressed(offset + header_size - fcs_size, fcs_size)
+            usize = int.from_bytes(fcs, "little")
+            if fcs_size == 2:
+                usize += 256
+
+        position = offset + header_size
+        while True:
+            header = int.from_bytes(self.read_compressed(position, 3), "little")
+            last = header & 1
+            block_type = (header >> 1) & 3
+            block_size = header >> 3
+            # RLE block has one byte repeated block_size times
+            position += 3 + (1 if block_type == 1 else block_size)
+            if last:
+                break
+        if checksum:
+            position += 4
+        return position - offset, usize
+
+    def decode(self, block):
+        d = zstandard.ZstdDecompressor().decompressobj()
+        for data in self.compressed_chunks(block.coffset, block.csize):
+            out = d.decompress(data)
+            if len(out) != 0:
+                yield out
+
+
+class XzStream(BlockStream):
+    # https://tukaani.org/xz/xz-file-format.txt
+    header_magic = b"\xfd7zXZ\x00"
+    footer_magic = b"YZ"
+
+    def scan(self):
+        if "lzma" not in globals():
+            global lzma
+            import lzma
+        streams = []
+        end = self.file_size
+        while end > 0:
+            # stream padding
+            while end >= 4 and self.read_compressed(end - 4, 4) == b"\0\0\0\0":
+                end -= 4
+            if end == 0:
+                break
+            start, blocks = self.scan_stream(end)
+            streams.append(blocks)
+            end = start
+        return [block for blocks in reversed(streams) for block in blocks]
+
+    def scan_stream(self, end):
+        footer = self.read_compressed(end - 12, 12)
+        if footer[10:] != self.footer_magic:
+            raise ValueError("not a xz file")
+        backward_size = (struct.unpack_from("<I", footer, 4)[0] + 1) * 4
+        index_start = end - 12 - backward_size
+        index = self.read_compressed(index_start, backward_size)
+        if index[0] != 0:
+            raise ValueError("broken xz index")
+        pos = 1
+        count, pos = self.varint(index, pos)
+        records = []
+        for _ in range(count):
+            unpadded, pos = self.varint(index, pos)
+            usize, pos = self.varint(index, pos)
+            records.append((unpadded, usize))
+
+        total = sum((unpadded + 3) // 4 * 4 for unpadded, _ in records)
+        start = index_start - total - 12
+        header = self.read_compressed(start, 12)
+        if header[:6] != self.header_magic:
+            raise ValueError("broken xz stream header")
+
+        blocks = []
+        coffset = start + 12
+        for unpadded, usize in records:
+            csize = (unpadded + 3) // 4 * 4
+            blocks.append(Block(coffset, csize, None, usize, extra=header))
+            coffset += csize
+        return start, blocks
+
+    def varint(self, buf, pos):
+        value = 0
+        shift = 0
+        while True:
+            b = buf[pos]
+            pos += 1
+            value |= (b & 0x7F) << shift
+            shift += 7
+            if b & 0x80 == 0:
+                return value, pos
+
+    def decode(self, block):
+        # stream header then one block. index and footer are not needed.
+        d = lzma.LZMADecompressor(lzma.FORMAT_XZ)
+        out = d.decompress(block.extra)
+        if len(out) != 0:
+            yield out
+        for data in self.compressed_chunks(block.coffset, block.csize):
+            out = d.decompress(data)
+            if len(out) != 0:
+                yield out
+
+
+class Bz2Stream(BlockStream):
+    # bzip2 blocks start with 48 bits magic, not aligned to byte.
+    # a block is decompressed by shifting it into a new stream with its CRC
+    # as the stream CRC.
+    block_magic = 0x314159265359
+    end_magic = 0x177245385090
+    scan_size = 16 * 1024 * 1024
+
+    def scan(self):
+        if "bz2" not in globals():
+            global bz2
+            import bz2
+        if self.read_compressed(0, 3) != b"BZh":
+            raise ValueError("not a bzip2 file")
+        starts = self.find_bits(self.block_magic)
+        ends = self.find_bits(self.end_magic)
+        marks = sorted([(s, True) for s in starts] + [(e, False) for e in ends])
+        blocks = []
+        for (bit, is_block), (next_bit, _) in zip(marks, marks[1:]):
+            if is_block:
+                blocks.append(Block(bit, next_bit - bit))
+        return blocks
+
+    def find_bits(self, magic):
+        # bit offsets of 48 bits magic in file
+        patterns = []
+        for shift in range(8):
+            nbytes = (shift + 48 + 7) // 8
+            pad = nbytes * 8 - shift - 48
+            value = (magic << pad).to_bytes(nbytes, "big")
+            mask = (((1 << 48) - 1) << pad).to_bytes(nbytes, "big")
+            # bytes not shared with other data
+            patterns.append((shift, value, mask, value[1:5]))
+
+        found = set()
+        offset = 0
+        while offset < self.file_size:
+            buf = self.read_compressed(offset, self.scan_size + 8)
+            for shift, value, mask, key in patterns:
+                i = buf.find(key, 1)
+                while i != -1:
+                    start = i - 1
+                    window = buf[start : start + len(value)]
+                    if len(window) == len(value) and all(
+                        w & m == v for w, m, v in zip(window, mask, value)
+                    ):
+                        found.add((offset + start) * 8 + shift)
+                    i = buf.find(key, i + 1)
+            offset += self.scan_size
+        return sorted(found)
+
+    def decode(self, block):
+        first = block.coffset // 8
+        last = (block.coffset + block.csize + 7) // 8
+        buf = self.read_compressed(first, last - first)
+        bits = int.from_bytes(buf, "big")
+        # drop bits before and after block
+        bits >>= len(buf) * 8 - (block.coffset + block.csize - first * 8)
+        bits &= (1 << block.csize) - 1
+        crc = (bits >> (block.csize - 48 - 32)) & 0xFFFFFFFF
+
+        stream = int.from_bytes(b"BZh9", "big")
+        stream = (stream << block.csize) | bits
+        stream = (stream << 48) | self.end_magic
+        stream = (stream << 32) | crc
+        nbits = 32 + block.csize + 48 + 32
+        pad = -nbits % 8
+        stream <<= pad
+        yield bz2.decompress(stream.to_bytes((nbits + pad) // 8, "big"))
+
+
+streams = {
+    ".zst": ZstdStream,
+    ".xz": XzStream,
+    ".bz2": Bz2Stream,
+}
+
+
+def open_stream(fp, suffix):
+    return streams[suffix](fp)
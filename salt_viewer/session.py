@@ -0,0 +1,169 @@
+from pathlib import Path
+import hashlib
+import json
+import os
+import time
+from PIL import Image
+from archive import ArchiveBase
+from page_cache import file_identity
+from log import get_logger
+
+logger = get_logger(__name__)
+
+
+# Positions of files read before, and renders of the pages shown last.
+# An entry is keyed by the top level archive, or by the directory of images.
+# Its position is the page index in each archive from the top level archive
+# to the nested archive shown, so nested archives are opened again on resume.
+# Previews of the pages are small jpeg files, and shown before the archive opens.
+class Session:
+    file_name = "session.json"
+    max_entries = 200
+    # total bytes of previews. previews of the oldest entries are removed.
+    max_preview_bytes = 32 * 1024 * 1024
+    preview_quality = 80
+
+    def __init__(self, session_dir):
+        self.session_dir = Path(session_dir).expanduser()
+        self.session_dir.mkdir(parents=True, exist_ok=True)
+        self.entries = self.load()
+
+    def load(self):
+        try:
+            with open(self.session_dir / self.file_name) as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.debug("no session: %s", e)
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+    def save(self):
+        path = self.session_dir / self.file_name
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        try:
+            with open(tmp, "w") as f:
+                json.dump(self.entries, f, indent=1)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning(f"failed to write session {path}: {e}")
+
+    def key(self, file_path):
+        # images in a directory share one entry
+        file_path = Path(file_path).resolve()
+        if file_path.is_file() and not is_archive(file_path):
+            return str(file_path.parent)
+        return str(file_path)
+
+    def identity(self, file_path):
+        if not is_archive(file_path):
+            return None
+        try:
+            return file_identity(file_path)
+        except OSError:
+            return None
+
+    def get(self, file_path):
+        # entry of file_path, or None if it is not read or changed since.
+        try:
+            file_path = Path(file_path).resolve()
+            key = self.key(file_path)
+        except OSError:
+            return None
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        # an image in the directory is asked for. open it, not the one read last.
+        if key != str(file_path) and entry["path"] != str(file_path):
+            return None
+        if not Path(entry["path"]).exists():
+            return None
+        if entry.get("identity") != self.identity(entry["path"]):
+            logger.debug("changed since last session: %s", key)
+            return None
+        return entry
+
+    def last(self):
+        # file_path read last
+        entries = sorted(self.entries.values(), key=lambda e: e.get("time", 0))
+        for entry in reversed(entries):
+            if Path(entry["path"]).exists():
+                return Path(entry["path"])
+        return None
+
+    def update(self, file_path, pages, names, fit_mode, double_page, render=False):
+        # render is True if the preview of this page is saved with it
+        file_path = Path(file_path).resolve()
+        key = self.key(file_path)
+        if not render:
+            # preview of the page left before
+            self.render_path(key).unlink(missing_ok=True)
+        self.entries[key] = {
+            "path": str(file_path),
+            "identity": self.identity(file_path),
+            "pages": pages,
+            "names": names,
+            "fit_mode": fit_mode,
+            "double_page": double_page,
+            "render": render,
+            "time": time.time(),
+        }
+        if len(self.entries) > self.max_entries:
+            old = sorted(self.entries, key=lambda k: self.entries[k].get("time", 0))
+            for k in old[: len(self.entries) - self.max_entries]:
+                del self.entries[k]
+                self.render_path(k).unlink(missing_ok=True)
+
+    def render_path(self, key):
+        name = hashlib.sha1(key.encode()).hexdigest()
+        return self.session_dir / (name + ".jpg")
+
+    def save_render(self, file_path, image):
+        key = self.key(file_path)
+        path = self.render_path(key)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        try:
+            image.save(tmp, "JPEG", quality=self.preview_quality)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning(f"failed to write session render {path}: {e}")
+            tmp.unlink(missing_ok=True)
+            return
+        self.limit_previews(key)
+
+    def limit_previews(self, keep):
+        # remove previews of the oldest entries over max_preview_bytes
+        total = 0
+        for key in sorted(
+            self.entries, key=lambda k: self.entries[k].get("time", 0), reverse=True
+        ):
+            entry = self.entries[key]
+            if not entry.get("render"):
+                continue
+            try:
+                size = self.render_path(key).stat().st_size
+            except OSError:
+                entry["render"] = False
+                continue
+            total += size
+            if total > self.max_preview_bytes and key != keep:
+                logger.debug("remove session render: %s", key)
+                self.render_path(key).unlink(missing_ok=True)
+                entry["render"] = False
+
+    def load_render(self, file_path):
+        try:
+            with open(self.render_path(self.key(file_path)), "rb") as f:
+                image = Image.open(f)
+                image.load()
+            return image
+        except (OSError, ValueError) as e:
+            logger.debug("no session render: %s", e)
+            return None
+
+
+def is_archive(file_path):
+    return Path(file_path).suffix.lower() in ArchiveBase.support_archive_type
@@ -0,0 +1,172 @@
+from pathlib import Path
+import concurrent.futures
+import functools
+import io
+import multiprocessing
+import os
+import queue
+import threading
+from PIL import Image
+from log import get_logger
+
+
+logger = get_logger(__name__)
+
+
+# low dpi is enough for thumbnail and much faster than default 200.
+pdf_thumbnail_dpi = 36
+
+
+def open_source(source, size):
+    # source is a picklable tuple made by ArchiveBase.source.
+    # ("path", file_path), ("bytes", file_name, bytes) or
+    # ("pdf", file_path or None, bytes or None, page)
+    kind = source[0]
+    if kind == "pdf":
+        import pdf2image
+
+        _, file_path, data, page = source
+        if file_path is not None:
+            images = pdf2image.convert_from_path(
+                file_path, dpi=pdf_thumbnail_dpi, first_page=page, last_page=page
+            )
+        else:
+            images = pdf2image.convert_from_bytes(
+                data, dpi=pdf_thumbnail_dpi, first_page=page, last_page=page
+            )
+        return images[0] if len(images) != 0 else None
+
+    if kind == "path":
+        file_name = source[1]
+        fp = file_name
+    else:
+        file_name = source[1]
+        fp = io.BytesIO(source[2])
+
+    suffix = Path(file_name).suffix.lower()
+    if suffix == ".svg":
+        import cairosvg
+
+        if isinstance(fp, io.BytesIO):
+            png = cairosvg.svg2png(file_obj=fp, output_width=size[0])
+        else:
+            png = cairosvg.svg2png(url=str(fp), output_width=size[0])
+        return Image.open(io.BytesIO(png))
+    if suffix == ".avif":
+        import pillow_avif  # noqa: F401
+
+    image = Image.open(fp)
+    # JPEG can be decoded in 1/2, 1/4 or 1/8 scale. It is much faster.
+    image.draft("RGB", size)
+    return image
+
+
+def make_thumbnail(source, size):
+    # run in worker process. return raw pixels because it is cheaper to pickle
+    # than PIL.Image.
+    image = open_source(source, size)
+    if image is None:
+        return None
+    image.thumbnail(size, Image.Resampling.BILINEAR)
+    if image.mode not in ["RGB", "RGBA"]:
+        has_alpha = "A" in image.mode or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+    return image.mode, image.size, image.tobytes()
+
+
+def mp_context():
+    # fork is not safe with Tk and preload threads running.
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+# Generate thumbnails in worker processes.
+# Reading page from archive runs on one reader thread and decoding runs in
+# worker processes. Requests not yet started are replaced by each request(),
+# so only the thumbnails on screen are generated.
+class ThumbnailPool:
+    def __init__(self, size=(200, 200), max_workers=None):
+        self.size = size
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.max_workers, mp_context=mp_context()
+        )
+
+        self.cond = threading.Condition()
+        self.pending = {}
+        self.running = set()
+        self.stop = False
+
+        # (key, (mode, size, bytes) or None)
+        self.results = queue.Queue()
+
+        t = threading.Thread(target=self.reader_thread, daemon=True)
+        t.start()
+
+    def request(self, requests):
+        # requests is a list of (key, source function) in priority order.
+        with self.cond:
+            self.pending = {
+                key: source_fn
+                for key, source_fn in requests
+                if key not in self.running
+            }
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {"pending": len(self.pending), "running": len(self.running)}
+
+    def cancel(self):
+        with self.cond:
+            self.pending = {}
+
+    def shutdown(self):
+        with self.cond:
+            self.stop = True
+            self.pending = {}
+            self.cond.notify_all()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def reader_thread(self):
+        while True:
+            with self.cond:
+                while not self.stop and (
+                    len(self.pending) == 0
+                    or len(self.running) >= self.max_workers * 2
+                ):
+                    self.cond.wait()
+                if self.stop:
+                    return
+                key = next(iter(self.pending))
+                source_fn = self.pending.pop(key)
+                self.running.add(key)
+
+            try:
+                source = source_fn()
+            except Exception as e:
+                logger.warning(f"read failed: {key}: {e}")
+                source = None
+            if source is None:
+                self._done(key, None)
+                continue
+
+            try:
+                future = self.executor.submit(make_thumbnail, source, self.size)
+            except RuntimeError:
+                # executor is shutdown
+                return
+            future.add_done_callback(functools.partial(self._done, key))
+
+    def _done(self, key, future):
+        result = None
+        if future is not None and not future.cancelled():
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.debug("thumbnail failed: %s: %s", key, e)
+        with self.cond:
+            self.running.discard(key)
+            self.cond.notify_all()
+        self.results.put((key, result))
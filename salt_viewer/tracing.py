@@ -0,0 +1,156 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from log import get_logger
+
+
+logger = get_logger(__name__)
+
+
+# returned by span() when tracing is off. entering it does nothing.
+null_span = contextlib.nullcontext()
+
+
+class Span:
+    __slots__ = ["tracer", "name", "args", "start"]
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.add(self.name, self.start, time.perf_counter_ns(), self.args)
+        return False
+
+
+# Record how long each stage of page turn takes.
+# Events are written as Chrome trace event JSON, which can be opened by
+# chrome://tracing or https://ui.perfetto.dev
+# The last page turn on main thread is kept as breakdown for HUD.
+class Tracer:
+    # events over this are dropped to bound memory.
+    max_events = 1_000_000
+
+    def __init__(self):
+        self.enabled = False
+        self.file_path = None
+        self.events = []
+        # tid: name. threads may be finished when saved.
+        self.threads = {}
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter_ns()
+        self.main_thread = threading.main_thread().ident
+        # name: ms of current page turn
+        self.breakdown = {}
+        self.last_breakdown = {}
+        self.recording = False
+        self.hud = False
+
+    def start(self, file_path):
+        self.file_path = file_path
+        self.update()
+
+    def update(self):
+        # keep tracing while HUD is shown even without trace file.
+        self.enabled = self.file_path is not None or self.hud
+
+    def toggle_hud(self):
+        self.hud = not self.hud
+        self.update()
+        return self.hud
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return null_span
+        return Span(self, name, args)
+
+    def instant(self, name, **args):
+        if not self.enabled:
+            return
+        self.add(name, time.perf_counter_ns(), None, args)
+
+    def add(self, name, start, end, args):
+        tid = threading.get_ident()
+        if end is not None and self.recording and tid == self.main_thread:
+            ms = (end - start) / 1_000_000
+            self.breakdown[name] = self.breakdown.get(name, 0) + ms
+        if self.file_path is None:
+            return
+        event = {
+            "name": name,
+            "ph": "X" if end is not None else "i",
+            "ts": (start - self.origin) / 1000,
+            "pid": os.getpid(),
+            "tid": tid,
+        }
+        if end is not None:
+            event["dur"] = (end - start) / 1000
+        else:
+            event["s"] = "t"
+        if len(args) != 0:
+            event["args"] = {k: str(v) for k, v in args.items()}
+        with self.lock:
+            if tid not in self.threads:
+                self.threads[tid] = threading.current_thread().name
+            if len(self.events) < self.max_events:
+                self.events.append(event)
+
+    @contextlib.contextmanager
+    def page(self, **args):
+        # a page turn. stages on main thread are summed up for HUD.
+        if not self.enabled:
+            yield
+            return
+        self.breakdown = {}
+        self.recording = True
+        try:
+            with self.span("page", **args):
+                yield
+        finally:
+            self.recording = False
+            self.last_breakdown = self.breakdown
+
+    def summary(self):
+        b = self.last_breakdown
+        if len(b) == 0:
+            return ""
+        total = b.get("page", 0)
+        stages = " ".join(
+            f"{name}={ms:.1f}" for name, ms in b.items() if name != "page"
+        )
+        return f"[{total:.1f}ms {stages}]"
+
+    def save(self):
+        if self.file_path is None:
+            return
+        with self.lock:
+            events = list(self.events)
+            threads = [
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": os.getpid(),
+                    "tid": tid,
+                    "args": {"name": name},
+                }
+                for tid, name in self.threads.items()
+            ]
+        try:
+            with open(self.file_path, "w") as f:
+                json.dump(
+                    {"traceEvents": threads + events, "displayTimeUnit": "ms"}, f
+                )
+        except OSError as e:
+            logger.warning(f"failed to write trace {self.file_path}: {e}")
+            return
+        logger.info(f"trace is written to {self.file_path}")
+
+
+tracer = Tracer()